@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import resource
+import socket
+import time
+import numpy as np
+
+import tensorflow as tf
+from keras.backend import tensorflow_backend as K
+from keras.optimizers import Adam
+
+from model_utils import build_model
+
+BATCH_SIZE_CANDIDATES = [4, 8, 16, 24, 32, 48, 64, 96, 128, 192, 256]
+DEFAULT_CACHE = 'checkpoint/autotune.json'
+
+parser = argparse.ArgumentParser(
+    description='Find the fastest batch size that fits into memory')
+parser.add_argument(
+    '--model-name',
+    type=str,
+    help='model to be tuned')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+parser.add_argument(
+    '--mode',
+    default='predict',
+    choices=['predict', 'train'],
+    type=str)
+parser.add_argument(
+    '--memory-limit',
+    default=0.8,
+    type=float,
+    help='peak RSS ceiling as a fraction of the physical memory')
+parser.add_argument(
+    '--cache',
+    default=DEFAULT_CACHE,
+    type=str,
+    metavar='PATH',
+    help='JSON file of tuned batch sizes')
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help='probe again even when a tuned batch size is cached')
+
+
+def total_memory_bytes():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def host_key():
+    return '{}-{}cpu-{}GB'.format(
+        socket.gethostname(), os.cpu_count(),
+        int(round(total_memory_bytes() / 1024. ** 3)))
+
+
+def cache_key(model_name, input_shape, mode):
+    return '{}|{}x{}|{}|{}'.format(
+        model_name, input_shape[0], input_shape[1], mode, host_key())
+
+
+def load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_cache(cache_path, cache):
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(cache_path + '.tmp', cache_path)
+
+
+def probe(model, input_shape, batch_size, mode='predict', steps=3):
+    """Images per second of `model` on random batches of `batch_size`
+    images, after one warm-up step that builds the graph and allocates
+    the activations."""
+    x = np.random.rand(batch_size, input_shape[1], input_shape[0], 3).astype(np.float32)
+    num_classes = model.output_shape[-1]
+    y = np.eye(num_classes, dtype=np.float32)[np.random.randint(num_classes, size=batch_size)]
+    step = model.predict_on_batch if mode == 'predict' else lambda x: model.train_on_batch(x, y)
+    step(x)
+    start = time.time()
+    for _ in range(steps):
+        step(x)
+    return steps * batch_size / (time.time() - start)
+
+
+def tune(model, input_shape, mode='predict', candidates=BATCH_SIZE_CANDIDATES,
+         memory_limit=0.8, steps=3):
+    """Probe increasing batch sizes until one runs out of memory or would
+    push the peak RSS above `memory_limit` of the physical memory, and
+    return the fastest batch size seen before that along with every
+    measurement.
+
+    The peak RSS only grows, so the probes have to go from small to large
+    batches. A probe that overshoots could already be killed by the OOM
+    killer, so each candidate is skipped when the marginal RSS growth per
+    image between consecutive probes predicts it would cross the ceiling.
+    The first probe also pays for building the graph and the optimizer
+    state and only serves as the starting point. Out of memory errors of
+    the device are caught as well.
+    """
+    ceiling = memory_limit * total_memory_bytes()
+    rss_per_image = 0.
+    results = []
+    for batch_size in candidates:
+        if results:
+            last = results[-1]
+            predicted = last['peak_rss'] + rss_per_image * (batch_size - last['batch_size'])
+            if predicted > ceiling:
+                print('Batch size {}: skipped, predicted peak RSS {:.2f} GB'.format(
+                    batch_size, predicted / 1024. ** 3))
+                break
+        try:
+            images_per_sec = probe(model, input_shape, batch_size, mode, steps)
+        except (MemoryError, tf.errors.ResourceExhaustedError):
+            print('Batch size {}: out of memory'.format(batch_size))
+            break
+        rss = peak_rss_bytes()
+        print('Batch size {}: {:.1f} images/s, peak RSS {:.2f} GB'.format(
+            batch_size, images_per_sec, rss / 1024. ** 3))
+        if rss > ceiling:
+            break
+        if results:
+            last = results[-1]
+            rss_per_image = max(rss_per_image, (rss - last['peak_rss']) /
+                                float(batch_size - last['batch_size']))
+        results.append({'batch_size': batch_size,
+                        'images_per_sec': images_per_sec,
+                        'peak_rss': rss})
+    if not results:
+        raise RuntimeError('No batch size fits under {:.2f} GB'.format(ceiling / 1024. ** 3))
+    best = max(results, key=lambda result: result['images_per_sec'])
+    return best['batch_size'], results
+
+
+def tuned_batch_size(model_name, input_shape, mode='predict', model=None,
+                     cache_path=DEFAULT_CACHE, memory_limit=0.8, force=False):
+    """Cached batch size of `model_name` for `input_shape` on this host,
+    tuned first when the cache has none. Training is tuned on a throwaway
+    copy of the model with every layer trainable, the most memory hungry
+    phase of train.py, so `model` is only used for predictions."""
+    key = cache_key(model_name, input_shape, mode)
+    cache = load_cache(cache_path)
+    if key in cache and not force:
+        print('Tuned batch size {} from {}'.format(cache[key]['batch_size'], cache_path))
+        return cache[key]['batch_size']
+
+    print('Tuning the batch size of {} for {}'.format(model_name, mode))
+    throwaway = model is None or mode == 'train'
+    if throwaway:
+        model = build_model(model_name)
+        if mode == 'train':
+            for layer in model.layers:
+                layer.trainable = True
+            model.compile(optimizer=Adam(lr=1e-5), loss='categorical_crossentropy')
+    batch_size, results = tune(model, input_shape, mode, memory_limit=memory_limit)
+    if throwaway:
+        K.clear_session()
+
+    cache = load_cache(cache_path)
+    cache[key] = {'batch_size': batch_size, 'results': results}
+    save_cache(cache_path, cache)
+    print('Tuned batch size: {}'.format(batch_size))
+    return batch_size
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    tuned_batch_size(args.model_name, tuple(args.input_shape), args.mode,
+                     cache_path=args.cache, memory_limit=args.memory_limit,
+                     force=args.force)
@@ -0,0 +1,242 @@
+import cv2
+import os
+import threading
+import numpy as np
+
+
+# cv2 equivalents of the padding modes imgaug picks from with mode=ia.ALL;
+# the ramp/statistics based numpy modes have no cv2 counterpart and are
+# covered by constant and edge padding
+BORDER_MODES = np.array([cv2.BORDER_CONSTANT,
+                         cv2.BORDER_REPLICATE,
+                         cv2.BORDER_REFLECT,
+                         cv2.BORDER_REFLECT_101,
+                         cv2.BORDER_WRAP])
+INTERPOLATIONS = np.array([cv2.INTER_NEAREST, cv2.INTER_LINEAR])
+
+# RGB <-> YIQ, used to rotate hue and scale saturation with one 3x3 matrix
+# per image. Indices are reversed since the loaders produce BGR images.
+_RGB_TO_YIQ = np.array([[0.299, 0.587, 0.114],
+                        [0.596, -0.274, -0.322],
+                        [0.211, -0.523, 0.312]])
+_BGR_TO_YIQ = _RGB_TO_YIQ[:, ::-1]
+_YIQ_TO_BGR = np.linalg.inv(_RGB_TO_YIQ)[::-1, :]
+
+NUM_COLOR_OPS = 6
+
+
+class BatchAugmenter(object):
+    """Numpy/cv2 version of the AUGMENTATION_SPEC recipe in data.py that
+    works on a whole (N, H, W, 3) uint8 batch at once.
+
+    Flip, crop/pad and affine parameters are folded into a single matrix per
+    image, so every image is warped at most once with `cv2.warpAffine` into a
+    preallocated output buffer. The SomeOf colour augmenters (blur, gaussian
+    noise, brightness, hue/saturation, multiply or frequency-noise blend,
+    contrast) are sampled per image and applied to the batch with
+    broadcasting on a float32 work buffer.
+
+    The returned array is a view of a buffer owned by the calling thread and
+    is overwritten by that thread's next call.
+    """
+    def __init__(self, seed=None, owner_pid=None):
+        self.seed = seed
+        # the process the seed belongs to, copies in other processes derive
+        # their own seed from it
+        self.owner_pid = os.getpid() if owner_pid is None else owner_pid
+        self._local = threading.local()
+        self._rng = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'seed': self.seed, 'owner_pid': self.owner_pid}
+
+    def __setstate__(self, state):
+        self.__init__(state['seed'], state.get('owner_pid'))
+
+    def _random_state(self):
+        # same reasoning as ProcessLocalAugmenter: forked, spawned or
+        # unpickled workers must not share the parent's random state. With a
+        # fixed seed every other process mixes its pid into it, so the
+        # workers differ from each other and the owner keeps its stream.
+        if self._pid != os.getpid():
+            if self.seed is None:
+                seed = np.random.RandomState().randint(0, 2 ** 31 - 1)
+            elif os.getpid() == self.owner_pid:
+                seed = self.seed
+            else:
+                seed = [self.seed, os.getpid()]
+            self._rng = np.random.RandomState(seed)
+            self._pid = os.getpid()
+        return self._rng
+
+    def _buffers(self, shape):
+        local = self._local
+        if getattr(local, 'out', None) is None or local.out.shape[0] < shape[0] \
+                or local.out.shape[1:] != shape[1:]:
+            local.out = np.empty(shape, dtype=np.uint8)
+            local.work = np.empty(shape, dtype=np.float32)
+        return local.out[:shape[0]], local.work[:shape[0]]
+
+    def augment_images(self, images):
+        images = np.asarray(images)
+        rng = self._random_state()
+        out, work = self._buffers(images.shape)
+        self._geometric(images, out, rng)
+        np.copyto(work, out)
+        self._color(work, rng)
+        np.clip(work, 0, 255, out=work)
+        np.rint(work, out=work)
+        np.copyto(out, work, casting='unsafe')
+        return out
+
+    def _geometric(self, images, out, rng):
+        n, h, w = images.shape[:3]
+        flip = rng.rand(n) < 0.5
+        crop = rng.rand(n) < 0.5
+        affine = rng.rand(n) < 0.5
+
+        # Fliplr(0.5)
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        matrices[flip, 0, 0] = -1
+        matrices[flip, 0, 2] = w - 1
+
+        # Sometimes(0.5, CropAndPad(percent=(-0.05, 0.1))), positive values
+        # pad and negative values crop, then the result is resized back
+        pad = rng.uniform(-0.05, 0.1, size=(n, 4)) * np.array([h, w, h, w])
+        pad = np.where(crop[:, None], np.round(pad), 0)
+        top, right, bottom, left = pad.T
+        scale_x = w / (w + left + right)
+        scale_y = h / (h + top + bottom)
+        crop_pad = np.tile(np.eye(3), (n, 1, 1))
+        crop_pad[:, 0, 0] = scale_x
+        crop_pad[:, 0, 2] = left * scale_x
+        crop_pad[:, 1, 1] = scale_y
+        crop_pad[:, 1, 2] = top * scale_y
+        matrices = np.matmul(crop_pad, matrices)
+
+        # Sometimes(0.5, Affine(...)) around the image center
+        scale = rng.uniform(0.8, 1.2, size=(n, 2))
+        translate = rng.uniform(-0.2, 0.2, size=(n, 2)) * np.array([w, h])
+        rotate = np.deg2rad(rng.uniform(20, 30, size=n))
+        cx, cy = (w - 1) / 2., (h - 1) / 2.
+        cos, sin = np.cos(rotate), np.sin(rotate)
+        warp = np.tile(np.eye(3), (n, 1, 1))
+        warp[:, 0, 0] = scale[:, 0] * cos
+        warp[:, 0, 1] = -scale[:, 1] * sin
+        warp[:, 1, 0] = scale[:, 0] * sin
+        warp[:, 1, 1] = scale[:, 1] * cos
+        warp[:, 0, 2] = cx - warp[:, 0, 0] * cx - warp[:, 0, 1] * cy + translate[:, 0]
+        warp[:, 1, 2] = cy - warp[:, 1, 0] * cx - warp[:, 1, 1] * cy + translate[:, 1]
+        warp[~affine] = np.eye(3)
+        matrices = np.matmul(warp, matrices)
+
+        interpolation = rng.choice(INTERPOLATIONS, size=n)
+        interpolation[~affine] = cv2.INTER_LINEAR
+        border = rng.choice(BORDER_MODES, size=n)
+        cval = rng.randint(0, 256, size=n)
+
+        warped = crop | affine
+        still = ~warped
+        out[still & ~flip] = images[still & ~flip]
+        out[still & flip] = images[still & flip, :, ::-1]
+        for i in np.where(warped)[0]:
+            cv2.warpAffine(images[i], matrices[i, :2], (w, h), dst=out[i],
+                           flags=int(interpolation[i]),
+                           borderMode=int(border[i]),
+                           borderValue=(int(cval[i]),) * 3)
+
+    def _color(self, work, rng):
+        n, h, w = work.shape[:3]
+        # SomeOf((0, 5), [...]): a random subset of 0 to 5 of the 6 ops
+        num_ops = rng.randint(0, 6, size=n)
+        ranks = rng.rand(n, NUM_COLOR_OPS).argsort(axis=1).argsort(axis=1)
+        selected = ranks < num_ops[:, None]
+
+        def per_channel_values(low, high, idx):
+            values = rng.uniform(low, high, size=(len(idx), 1, 1, 3))
+            shared = rng.rand(len(idx)) >= 0.5
+            values[shared] = values[shared, ..., :1]
+            return values.astype(np.float32)
+
+        # OneOf([GaussianBlur, AverageBlur, MedianBlur]), only small kernels
+        for i in np.where(selected[:, 0])[0]:
+            kind = rng.randint(3)
+            if kind == 0:
+                sigma = rng.uniform(0, 0.5)
+                if sigma > 0.01:
+                    cv2.GaussianBlur(work[i], (0, 0), sigma, dst=work[i])
+            elif kind == 1:
+                k = rng.randint(1, 4)
+                if k > 1:
+                    cv2.blur(work[i], (k, k), dst=work[i])
+            elif rng.rand() < 0.5:
+                work[i] = cv2.medianBlur(work[i], 3)
+
+        # AdditiveGaussianNoise(scale=(0, 0.03 * 255), per_channel=0.5)
+        idx = np.where(selected[:, 1])[0]
+        if len(idx):
+            noise = rng.standard_normal(size=(len(idx), h, w, 3)).astype(np.float32)
+            shared = rng.rand(len(idx)) >= 0.5
+            noise[shared] = noise[shared, ..., :1]
+            noise *= rng.uniform(0, 0.03 * 255, size=(len(idx), 1, 1, 1)).astype(np.float32)
+            work[idx] += noise
+
+        # Add((-10, 10), per_channel=0.5)
+        idx = np.where(selected[:, 2])[0]
+        if len(idx):
+            work[idx] += np.round(per_channel_values(-10, 10, idx))
+
+        # AddToHueAndSaturation((-20, 20)): 8-bit hue units are 2 degrees
+        idx = np.where(selected[:, 3])[0]
+        if len(idx):
+            value = rng.randint(-20, 21, size=len(idx))
+            angle = np.deg2rad(2. * value)
+            saturation = 1 + value / 128.
+            rotation = np.tile(np.eye(3), (len(idx), 1, 1))
+            rotation[:, 1, 1] = saturation * np.cos(angle)
+            rotation[:, 1, 2] = -saturation * np.sin(angle)
+            rotation[:, 2, 1] = saturation * np.sin(angle)
+            rotation[:, 2, 2] = saturation * np.cos(angle)
+            transform = np.matmul(np.matmul(_YIQ_TO_BGR, rotation), _BGR_TO_YIQ)
+            pixels = work[idx].reshape(len(idx), -1, 3)
+            work[idx] = np.matmul(pixels, transform.transpose(0, 2, 1).astype(np.float32)) \
+                .reshape(len(idx), h, w, 3)
+
+        # OneOf([Multiply, FrequencyNoiseAlpha(Multiply, ContrastNormalization)])
+        idx = np.where(selected[:, 4])[0]
+        if len(idx):
+            blend = rng.rand(len(idx)) < 0.5
+            multiply_idx = idx[~blend]
+            if len(multiply_idx):
+                work[multiply_idx] *= per_channel_values(0.5, 1.5, multiply_idx)
+            blend_idx = idx[blend]
+            if len(blend_idx):
+                alpha = self._low_frequency_masks(len(blend_idx), h, w, rng)
+                first = work[blend_idx] * rng.uniform(
+                    0.5, 1.5, size=(len(blend_idx), 1, 1, 3)).astype(np.float32)
+                second = (work[blend_idx] - 128) * rng.uniform(
+                    0.5, 2.0, size=(len(blend_idx), 1, 1, 1)).astype(np.float32) + 128
+                work[blend_idx] = alpha * first + (1 - alpha) * second
+
+        # ContrastNormalization((1.4, 1.6), per_channel=0.5)
+        idx = np.where(selected[:, 5])[0]
+        if len(idx):
+            work[idx] = (work[idx] - 128) * per_channel_values(1.4, 1.6, idx) + 128
+
+    def _low_frequency_masks(self, n, h, w, rng):
+        """Smooth per-image alpha masks in [0, 1], standing in for the
+        frequency noise of FrequencyNoiseAlpha(exponent=(-4, 0)). Coarser
+        grids correspond to more negative exponents. Masks sharing a grid size
+        are upscaled together as channels of one `cv2.resize` call.
+        """
+        masks = np.empty((n, h, w, 1), dtype=np.float32)
+        grid_sizes = rng.choice([2, 4, 8, 16], size=n)
+        for grid_size in np.unique(grid_sizes):
+            idx = np.where(grid_sizes == grid_size)[0]
+            for start in range(0, len(idx), 512):
+                chunk = idx[start:start + 512]
+                coarse = rng.rand(grid_size, grid_size, len(chunk)).astype(np.float32)
+                fine = cv2.resize(coarse, (w, h), interpolation=cv2.INTER_CUBIC)
+                masks[chunk, ..., 0] = np.clip(fine, 0, 1).reshape(h, w, -1).transpose(2, 0, 1)
+        return masks
@@ -0,0 +1,55 @@
+# Per-batch augmentation time of rebuilding the imgaug pipeline on every
+# batch (the old AugmentedDataset behaviour) against reusing one pipeline.
+# Run from the repository root: python -m benchmarks.augmentation_benchmark
+import argparse
+import time
+import numpy as np
+
+from data import AUGMENTATION_SPEC, ProcessLocalAugmenter, build_augmenter
+
+parser = argparse.ArgumentParser(
+    description='Augmentation micro-benchmark')
+parser.add_argument(
+    '--batch-size',
+    default=16,
+    type=int,
+    metavar='N',
+    help='mini-batch size')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+parser.add_argument(
+    '--num-batches',
+    default=50,
+    type=int,
+    metavar='N')
+
+
+def time_batches(augment, images, num_batches):
+    augment(images)  # warm up
+    start = time.time()
+    for _ in range(num_batches):
+        augment(images)
+    return (time.time() - start) / num_batches
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    images = np.random.randint(
+        0, 256, size=(args.batch_size, args.input_shape[1], args.input_shape[0], 3),
+        dtype=np.uint8)
+
+    rebuilt = time_batches(
+        lambda batch: build_augmenter(AUGMENTATION_SPEC).augment_images(batch),
+        images, args.num_batches)
+    augmenter = ProcessLocalAugmenter()
+    cached = time_batches(augmenter.augment_images, images, args.num_batches)
+    construction = time_batches(
+        lambda batch: build_augmenter(AUGMENTATION_SPEC), images, args.num_batches)
+
+    print('Pipeline construction: {:.2f} ms'.format(construction * 1000))
+    print('Rebuilt per batch: {:.2f} ms/batch'.format(rebuilt * 1000))
+    print('Built once: {:.2f} ms/batch'.format(cached * 1000))
@@ -0,0 +1,86 @@
+# Peak memory and throughput of batch assembly: the old list -> np.array ->
+# _preprocess_numpy_input -> to_categorical path against preprocess_images and
+# to_one_hot writing into reused buffers. Images are resized in memory so the
+# numbers exclude JPEG decoding, which both paths share.
+# Run from the repository root: python -m benchmarks.batch_assembly_benchmark
+import argparse
+import cv2
+import time
+import tracemalloc
+import numpy as np
+from keras.applications.imagenet_utils import _preprocess_numpy_input
+from keras.utils import to_categorical
+
+from data import BatchBufferPool, preprocess_images, to_one_hot
+
+parser = argparse.ArgumentParser(
+    description='Batch assembly benchmark')
+parser.add_argument(
+    '--batch-sizes',
+    nargs='+',
+    default=[16, 32, 64, 128],
+    type=int)
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+parser.add_argument(
+    '--num-batches',
+    default=20,
+    type=int,
+    metavar='N')
+parser.add_argument(
+    '--num-classes',
+    default=128,
+    type=int)
+
+
+def old_batch(source, labels, input_shape, num_classes, buffers):
+    batch_imgs = [cv2.resize(img, input_shape, interpolation=cv2.INTER_LINEAR)
+                  for img in source]
+    batch_imgs = _preprocess_numpy_input(np.array(batch_imgs),
+        data_format='channels_last', mode='torch')
+    return batch_imgs, to_categorical(np.array(labels), num_classes=num_classes)
+
+
+def new_batch(source, labels, input_shape, num_classes, buffers, dtype=np.float32):
+    slot = buffers.acquire()
+    shape = (len(source), input_shape[1], input_shape[0], 3)
+    images = slot.get('images', shape, np.uint8)
+    for i, img in enumerate(source):
+        cv2.resize(img, input_shape, dst=images[i], interpolation=cv2.INTER_LINEAR)
+    batch_imgs = preprocess_images(images, out=slot.get('inputs', shape, dtype))
+    return batch_imgs, to_one_hot(
+        labels, num_classes,
+        out=slot.get('labels', (len(labels), num_classes), np.float32))
+
+
+def measure(make_batch, source, labels, args, buffers, **kwargs):
+    input_shape = tuple(args.input_shape)
+    make_batch(source, labels, input_shape, args.num_classes, buffers, **kwargs)
+    tracemalloc.start()
+    start = time.time()
+    for _ in range(args.num_batches):
+        make_batch(source, labels, input_shape, args.num_classes, buffers, **kwargs)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return args.num_batches * len(source) / elapsed, peak / 1024 ** 2
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print('{:>6} {:>24} {:>24} {:>24}'.format(
+        'batch', 'old img/s | peak MB', 'float32 img/s | peak MB', 'float16 img/s | peak MB'))
+    for batch_size in args.batch_sizes:
+        source = [np.random.randint(0, 256, size=(400, 500, 3), dtype=np.uint8)
+                  for _ in range(batch_size)]
+        labels = np.random.randint(0, args.num_classes, size=batch_size)
+        old = measure(old_batch, source, labels, args, None)
+        new32 = measure(new_batch, source, labels, args, BatchBufferPool(2))
+        new16 = measure(new_batch, source, labels, args, BatchBufferPool(2),
+                        dtype=np.float16)
+        print('{:>6} {:>14.1f} | {:>7.1f} {:>14.1f} | {:>7.1f} {:>14.1f} | {:>7.1f}'.format(
+            batch_size, old[0], old[1], new32[0], new32[1], new16[0], new16[1]))
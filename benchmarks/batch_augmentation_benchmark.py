@@ -0,0 +1,61 @@
+# Throughput of the imgaug and numpy augmentation backends in images/second,
+# plus output pixel statistics to compare the two recipes side by side.
+# Run from the repository root: python -m benchmarks.batch_augmentation_benchmark
+import argparse
+import time
+import numpy as np
+
+from batch_augmentation import BatchAugmenter
+from data import ProcessLocalAugmenter, get_image_paths_and_labels, read_images
+
+parser = argparse.ArgumentParser(
+    description='Batch augmentation throughput benchmark')
+parser.add_argument(
+    '--data-dir',
+    default='data/validation',
+    type=str,
+    metavar='PATH',
+    help='class folders to sample images from')
+parser.add_argument(
+    '--batch-size',
+    default=16,
+    type=int,
+    metavar='N',
+    help='mini-batch size')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+parser.add_argument(
+    '--num-batches',
+    default=50,
+    type=int,
+    metavar='N')
+
+
+def benchmark(augmenter, images, num_batches):
+    augmenter.augment_images(images)  # warm up
+    means, stds = [], []
+    start = time.time()
+    for _ in range(num_batches):
+        batch = np.asarray(augmenter.augment_images(images))
+        means.append(batch.mean())
+        stds.append(batch.std())
+    elapsed = time.time() - start
+    return num_batches * len(images) / elapsed, np.mean(means), np.mean(stds)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    x, _ = get_image_paths_and_labels(args.data_dir)
+    x = np.random.choice(x, args.batch_size, replace=False)
+    images, _ = read_images(x, tuple(args.input_shape))
+    print('Input: mean {:.1f}, std {:.1f}'.format(images.mean(), images.std()))
+
+    for name, augmenter in [('imgaug', ProcessLocalAugmenter()),
+                            ('numpy', BatchAugmenter())]:
+        images_per_sec, mean, std = benchmark(augmenter, images, args.num_batches)
+        print('{}: {:.1f} images/s, output mean {:.1f}, std {:.1f}'.format(
+            name, images_per_sec, mean, std))
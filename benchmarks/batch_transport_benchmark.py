@@ -0,0 +1,128 @@
+# Bytes copied and time per epoch when moving batches from loader processes
+# to the trainer: pickling through a multiprocessing pool (what keras does
+# with use_multiprocessing=True) against the shared memory ring of
+# PrefetchLoader, with and without a consumer-side copy. Every batch is
+# checked against its expected content, and in zero-copy mode the previous
+# batch is re-checked right before its slot is handed back, so a slot reused
+# too early shows up as a failure.
+# Run from the repository root: python -m benchmarks.batch_transport_benchmark
+import argparse
+import multiprocessing
+import pickle
+import time
+import numpy as np
+
+from prefetch import PrefetchLoader
+
+parser = argparse.ArgumentParser(
+    description='Batch transport benchmark')
+parser.add_argument(
+    '--batch-size',
+    default=16,
+    type=int,
+    metavar='N',
+    help='mini-batch size')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+parser.add_argument(
+    '--num-batches',
+    default=64,
+    type=int,
+    metavar='N',
+    help='batches per epoch')
+parser.add_argument(
+    '--num-workers',
+    default=4,
+    type=int,
+    metavar='N')
+parser.add_argument(
+    '--queue-size',
+    default=4,
+    type=int,
+    metavar='N')
+
+
+class SyntheticSequence(object):
+    """Batches shaped like AugmentedDatasetWithSiftFeatures output whose
+    values encode the batch index."""
+    def __init__(self, num_batches, batch_size, input_shape):
+        self.num_batches = num_batches
+        self.batch_size = batch_size
+        self.input_shape = input_shape
+
+    def __len__(self):
+        return self.num_batches
+
+    def on_epoch_end(self):
+        pass
+
+    def __getitem__(self, idx):
+        images = np.full((self.batch_size, self.input_shape[1], self.input_shape[0], 3),
+                         idx, dtype=np.float32)
+        sift = np.full((self.batch_size, 512), idx, dtype=np.float32)
+        labels = np.full((self.batch_size, 128), idx, dtype=np.float32)
+        return [images, sift], labels
+
+
+def check(batch, idx):
+    (images, sift), labels = batch
+    return images[0, 0, 0, 0] == idx and images[-1, -1, -1, -1] == idx \
+        and sift[-1, -1] == idx and labels[-1, -1] == idx
+
+
+_sequence = None
+
+
+def _pickled_batch(idx):
+    return _sequence[idx]
+
+
+def run_pickle(sequence, num_workers):
+    global _sequence
+    _sequence = sequence
+    pool = multiprocessing.get_context('fork').Pool(num_workers)
+    start = time.time()
+    nbytes, ok = 0, True
+    for idx, batch in enumerate(pool.imap(_pickled_batch, range(len(sequence)))):
+        ok &= check(batch, idx)
+        # serialized in the worker, deserialized in the trainer
+        nbytes += 2 * len(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    return elapsed, nbytes, ok
+
+
+def run_ring(sequence, num_workers, queue_size, copy):
+    loader = PrefetchLoader(sequence, num_workers=num_workers,
+                            queue_size=queue_size, copy=copy)
+    start = time.time()
+    ok, previous = True, None
+    for idx in range(len(loader)):
+        if previous is not None and not copy:
+            ok &= check(previous, idx - 1)
+        batch = next(loader)
+        ok &= check(batch, idx)
+        previous = batch
+    elapsed = time.time() - start
+    # zero-copy arrays map the ring, drop them before it is freed
+    del batch, previous
+    loader.close()
+    return elapsed, loader.bytes_copied, ok
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sequence = SyntheticSequence(args.num_batches, args.batch_size, tuple(args.input_shape))
+
+    results = [('pickle', run_pickle(sequence, args.num_workers)),
+               ('shared memory + copy', run_ring(sequence, args.num_workers,
+                                                 args.queue_size, copy=True)),
+               ('shared memory zero-copy', run_ring(sequence, args.num_workers,
+                                                    args.queue_size, copy=False))]
+    for name, (elapsed, nbytes, ok) in results:
+        print('{:>24}: {:.2f}s/epoch, {:.2f} GB copied/epoch, batches {}'.format(
+            name, elapsed, nbytes / 1024 ** 3, 'ok' if ok else 'CORRUPTED'))
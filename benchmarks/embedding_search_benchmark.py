@@ -0,0 +1,93 @@
+# Query latency and recall@k of IVFIndex against the exact blocked search of
+# ExactIndex, for several numbers of probed lists. Uses an exported train
+# split as database and its validation split as queries when --model-name is
+# given, otherwise clustered random unit vectors.
+# Run from the repository root: python -m benchmarks.embedding_search_benchmark
+import argparse
+import time
+import numpy as np
+
+from embedding_store import ExactIndex, IVFIndex, l2_normalize, load_embeddings
+
+parser = argparse.ArgumentParser(
+    description='Embedding search benchmark')
+parser.add_argument(
+    '--model-name',
+    default=None,
+    type=str,
+    help='benchmark the embeddings exported for this model')
+parser.add_argument(
+    '--store-dir',
+    default='data/embeddings',
+    type=str,
+    metavar='PATH')
+parser.add_argument(
+    '--num-vectors',
+    default=200000,
+    type=int,
+    metavar='N',
+    help='synthetic database size')
+parser.add_argument(
+    '--dim',
+    default=256,
+    type=int,
+    help='synthetic embedding size')
+parser.add_argument(
+    '--num-queries',
+    default=1000,
+    type=int,
+    metavar='N')
+parser.add_argument(
+    '--num-lists',
+    default=1024,
+    type=int,
+    metavar='N')
+parser.add_argument(
+    '--nprobes',
+    nargs='+',
+    default=[1, 4, 16, 64],
+    type=int)
+parser.add_argument(
+    '--k',
+    default=10,
+    type=int)
+
+
+def synthetic(num_vectors, num_queries, dim, num_clusters=128, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_clusters, dim)
+    database = centers[rng.randint(num_clusters, size=num_vectors)] + rng.randn(num_vectors, dim)
+    queries = centers[rng.randint(num_clusters, size=num_queries)] + rng.randn(num_queries, dim)
+    return l2_normalize(database).astype(np.float16), queries
+
+
+def recall(found, truth):
+    return np.mean([len(np.intersect1d(f, t)) / float(len(t)) for f, t in zip(found, truth)])
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.model_name is None:
+        database, queries = synthetic(args.num_vectors, args.num_queries, args.dim)
+    else:
+        database, _, _ = load_embeddings(args.store_dir, args.model_name, 'train')
+        queries, _, _ = load_embeddings(args.store_dir, args.model_name, 'validation')
+        queries = np.asarray(queries[:args.num_queries], dtype=np.float32)
+    print('{} vectors of {} dimensions, {} queries'.format(
+        len(database), database.shape[1], len(queries)))
+
+    start = time.time()
+    _, truth = ExactIndex(database).search(queries, args.k)
+    exact_time = time.time() - start
+    print('exact: {:.2f} ms/query'.format(1000 * exact_time / len(queries)))
+
+    start = time.time()
+    index = IVFIndex.build(database, args.num_lists)
+    print('IVF build with {} lists: {:.1f}s'.format(args.num_lists, time.time() - start))
+    for nprobe in args.nprobes:
+        start = time.time()
+        _, found = index.search(queries, args.k, nprobe)
+        ivf_time = time.time() - start
+        print('nprobe {:>4}: {:.2f} ms/query, recall@{} {:.3f}'.format(
+            nprobe, 1000 * ivf_time / len(queries), args.k, recall(found, truth)))
@@ -0,0 +1,123 @@
+# Throughput and p50/p99 latency of single-image requests arriving as a
+# Poisson process at several rates, served one image per predict call
+# against AsyncMicroBatcher with the deadline and eager policies. The model
+# is simulated by a fixed per-call overhead plus a per-image cost unless
+# --model-name builds one of the model_utils backbones.
+# Run from the repository root: python -m benchmarks.micro_batching_benchmark
+import argparse
+import asyncio
+import time
+import numpy as np
+
+from micro_batching import AsyncMicroBatcher
+
+parser = argparse.ArgumentParser(
+    description='Micro-batching benchmark')
+parser.add_argument(
+    '--rates',
+    nargs='+',
+    default=[50, 100, 200, 400],
+    type=float,
+    help='requests per second')
+parser.add_argument(
+    '--duration',
+    default=5.,
+    type=float,
+    help='seconds of load per rate')
+parser.add_argument(
+    '--max-batch-size',
+    default=32,
+    type=int,
+    metavar='N')
+parser.add_argument(
+    '--max-latency-ms',
+    default=10.,
+    type=float)
+parser.add_argument(
+    '--call-overhead-ms',
+    default=8.,
+    type=float,
+    help='simulated cost of one predict call')
+parser.add_argument(
+    '--image-cost-ms',
+    default=1.,
+    type=float,
+    help='simulated cost of every image in a predict call')
+parser.add_argument(
+    '--model-name',
+    default=None,
+    type=str,
+    help='predict with this untrained backbone instead of the simulation')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+
+
+def simulated_predict(call_overhead, image_cost):
+    def predict_batch(items):
+        time.sleep(call_overhead + image_cost * len(items))
+        return [item.sum() for item in items]
+    return predict_batch
+
+
+def model_predict(model_name):
+    from model_utils import build_model
+    model = build_model(model_name)
+    model._make_predict_function()
+
+    def predict_batch(items):
+        return list(model.predict(np.stack(items), batch_size=len(items)))
+    return predict_batch
+
+
+async def generate_load(batcher, image, rate, duration, seed=0):
+    """Send requests with exponential inter-arrival times for `duration`
+    seconds and return the latencies and the completed requests per second."""
+    rng = np.random.RandomState(seed)
+    latencies = []
+
+    async def request():
+        start = time.time()
+        await batcher.predict(image)
+        latencies.append(time.time() - start)
+
+    tasks = []
+    start = time.time()
+    next_arrival = start
+    while next_arrival < start + duration:
+        await asyncio.sleep(max(0., next_arrival - time.time()))
+        tasks.append(asyncio.ensure_future(request()))
+        next_arrival += rng.exponential(1. / rate)
+    await asyncio.gather(*tasks)
+    return np.array(latencies), len(latencies) / (time.time() - start)
+
+
+async def main(args, predict_batch, image):
+    configs = [('one per call', 1, 'eager'),
+               ('deadline', args.max_batch_size, 'deadline'),
+               ('eager', args.max_batch_size, 'eager')]
+    print('{:>8} {:>14} {:>10} {:>10} {:>10} {:>10}'.format(
+        'rate', 'batching', 'req/s', 'p50 ms', 'p99 ms', 'batch'))
+    for rate in args.rates:
+        for name, max_batch_size, policy in configs:
+            batcher = AsyncMicroBatcher(predict_batch, max_batch_size,
+                                        args.max_latency_ms / 1000., policy)
+            latencies, throughput = await generate_load(batcher, image, rate, args.duration)
+            await batcher.close()
+            print('{:>8.0f} {:>14} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                rate, name, throughput,
+                1000 * np.percentile(latencies, 50), 1000 * np.percentile(latencies, 99),
+                batcher.tracker.summary()['mean_batch_size']))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    image = np.random.rand(args.input_shape[1], args.input_shape[0], 3).astype(np.float32)
+    if args.model_name is None:
+        predict_batch = simulated_predict(args.call_overhead_ms / 1000., args.image_cost_ms / 1000.)
+    else:
+        predict_batch = model_predict(args.model_name)
+    asyncio.get_event_loop().run_until_complete(main(args, predict_batch, image))
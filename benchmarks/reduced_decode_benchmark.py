@@ -0,0 +1,67 @@
+# Decode + resize time of full-resolution cv2.imread against imread_reduced
+# over a sample of the training folders. The PSNR between the two resized
+# results shows how much the reduced decode changes what the network sees.
+# Run from the repository root: python -m benchmarks.reduced_decode_benchmark
+import argparse
+import cv2
+import time
+import numpy as np
+
+from data import get_image_paths_and_labels, imread_reduced
+
+parser = argparse.ArgumentParser(
+    description='Reduced-resolution decode benchmark')
+parser.add_argument(
+    '--data-dir',
+    default='data/train',
+    type=str,
+    metavar='PATH',
+    help='class folders to sample images from')
+parser.add_argument(
+    '--num-images',
+    default=500,
+    type=int,
+    metavar='N')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255. ** 2 / mse)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    input_shape = tuple(args.input_shape)
+
+    x, _ = get_image_paths_and_labels(args.data_dir)
+    x = np.random.choice(x, min(args.num_images, len(x)), replace=False)
+
+    full_time, reduced_time, scores = 0., 0., []
+    for img_path in x:
+        start = time.time()
+        full = cv2.resize(cv2.imread(img_path), input_shape,
+                          interpolation=cv2.INTER_LINEAR)
+        full_time += time.time() - start
+
+        start = time.time()
+        reduced = cv2.resize(imread_reduced(img_path, input_shape), input_shape,
+                             interpolation=cv2.INTER_LINEAR)
+        reduced_time += time.time() - start
+        scores.append(psnr(full, reduced))
+
+    scores = np.array(scores)
+    finite = scores[np.isfinite(scores)]
+    print('Full decode: {:.2f} ms/image'.format(1000 * full_time / len(x)))
+    print('Reduced decode: {:.2f} ms/image ({:.2f}x)'.format(
+        1000 * reduced_time / len(x), full_time / reduced_time))
+    print('Identical images: {}/{}'.format(len(scores) - len(finite), len(scores)))
+    if len(finite):
+        print('PSNR vs full decode: mean {:.1f} dB, min {:.1f} dB'.format(
+            finite.mean(), finite.min()))
@@ -0,0 +1,222 @@
+import argparse
+import json
+import numpy as np
+import os
+
+from data import get_image_paths_and_labels
+from ensemble import EPSILON, blend_space
+
+parser = argparse.ArgumentParser(
+    description='Search ensemble weights on validation predictions')
+parser.add_argument(
+    'predictions',
+    nargs='+',
+    type=str,
+    help='.npy files of (num_valid_images, num_classes) predictions of predict_tta.py '
+         '--predict-on holdout, named like the test predictions ensemble.py '
+         '--weights-file is given')
+parser.add_argument(
+    '--valid-dir',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='folder the predictions were made on, for the labels; data/validation is '
+         'part of train.py\'s training set, weights fitted on it favour the most '
+         'overfit model')
+parser.add_argument(
+    '--labels',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='.npy file of 0-based labels, instead of the <prediction>.labels.npy '
+         'predict_tta.py --predict-on writes')
+parser.add_argument(
+    '--method',
+    default='arithmetic',
+    choices=['arithmetic', 'geometric', 'logit'],
+    type=str)
+parser.add_argument(
+    '--objective',
+    default='logloss',
+    choices=['logloss', 'accuracy'],
+    type=str)
+parser.add_argument(
+    '--num-candidates',
+    default=2000,
+    type=int,
+    metavar='N',
+    help='random weightings scored before the coordinate descent')
+parser.add_argument(
+    '--rounds',
+    default=5,
+    type=int,
+    metavar='N',
+    help='coordinate descent passes over the models')
+parser.add_argument(
+    '--seed',
+    default=0,
+    type=int)
+parser.add_argument(
+    '--output',
+    default='submission/ensemble/weights.json',
+    type=str,
+    metavar='PATH',
+    help='JSON file read by ensemble.py --weights-file')
+
+
+def _probabilities(combined, method):
+    """Normalised probabilities from a weighted average taken in the space
+    of `method`, in place, for (..., num_classes) arrays."""
+    if method == 'geometric':
+        combined -= combined.max(axis=-1, keepdims=True)
+        np.exp(combined, out=combined)
+    elif method == 'logit':
+        np.negative(combined, out=combined)
+        np.exp(combined, out=combined)
+        combined += 1
+        np.reciprocal(combined, out=combined)
+    combined /= combined.sum(axis=-1, keepdims=True)
+    return combined
+
+
+class BlendScorer(object):
+    """Scores many weightings of the same prediction matrices at once.
+
+    The predictions are transformed once into the space `method` averages
+    in and stacked to (models, images, classes); a block of candidate
+    weightings is then blended with a single `tensordot`, sized so the
+    (candidates, images, classes) result stays under `max_bytes`.
+    """
+    def __init__(self, predictions, labels, method='arithmetic', max_bytes=256 * 1024 ** 2):
+        self.stack = np.stack([blend_space(np.asarray(p, dtype=np.float32), method)
+                               for p in predictions])
+        self.labels = np.asarray(labels)
+        self.method = method
+        num_images, num_classes = self.stack.shape[1:]
+        self.block_size = max(1, max_bytes // (4 * num_images * num_classes))
+
+    def blend(self, weights):
+        weights = np.asarray(weights, dtype=np.float32)
+        weights = weights / weights.sum(axis=-1, keepdims=True)
+        return _probabilities(np.tensordot(weights, self.stack, axes=(-1, 0)), self.method)
+
+    def score(self, candidates):
+        """Log-loss and accuracy of every row of (num_candidates, num_models)
+        `candidates`."""
+        candidates = np.atleast_2d(candidates)
+        rows = np.arange(len(self.labels))
+        logloss = np.empty(len(candidates))
+        accuracy = np.empty(len(candidates))
+        for start in range(0, len(candidates), self.block_size):
+            probs = self.blend(candidates[start:start + self.block_size])
+            end = start + len(probs)
+            true_probs = probs[:, rows, self.labels]
+            logloss[start:end] = -np.log(np.maximum(true_probs, EPSILON)).mean(axis=1)
+            accuracy[start:end] = (probs.argmax(axis=2) == self.labels).mean(axis=1)
+        return logloss, accuracy
+
+
+def search_weights(scorer, objective='logloss', num_candidates=2000, rounds=5,
+                   grid=np.linspace(0, 1, 21), seed=0):
+    """Random search over the weight simplex followed by coordinate descent:
+    every pass sets each model's weight to the best value of `grid` with the
+    others fixed, scoring the whole grid in one call."""
+    num_models = scorer.stack.shape[0]
+    rng = np.random.RandomState(seed)
+    candidates = np.vstack([np.ones((1, num_models)),
+                            np.eye(num_models),
+                            rng.dirichlet(np.ones(num_models), size=num_candidates)])
+
+    def loss(candidates):
+        logloss, accuracy = scorer.score(candidates)
+        return logloss if objective == 'logloss' else -accuracy
+
+    losses = loss(candidates)
+    weights = candidates[losses.argmin()]
+    best = losses.min()
+    for _ in range(rounds):
+        improved = False
+        for m in range(num_models):
+            candidates = np.tile(weights, (len(grid), 1))
+            candidates[:, m] = grid
+            candidates = candidates[candidates.sum(axis=1) > 0]
+            losses = loss(candidates)
+            if losses.min() < best - 1e-9:
+                best = losses.min()
+                weights = candidates[losses.argmin()]
+                improved = True
+        if not improved:
+            break
+    return weights / weights.sum()
+
+
+def per_class_accuracy(probs, labels, num_classes):
+    correct = np.bincount(labels, weights=probs.argmax(axis=1) == labels, minlength=num_classes)
+    counts = np.bincount(labels, minlength=num_classes)
+    return correct / np.maximum(counts, 1)
+
+
+def holdout_labels(prediction_paths):
+    """Labels predict_tta.py saved next to the predictions. Every model must
+    have been predicted on the same images in the same order, e.g. a holdout
+    shared with train.py --holdout-from."""
+    labels = None
+    for path in prediction_paths:
+        labels_path = '{}.labels.npy'.format(os.path.splitext(path)[0])
+        if not os.path.exists(labels_path):
+            raise ValueError('No labels for {}, run predict_tta.py --predict-on holdout or '
+                             'pass --labels / --valid-dir'.format(path))
+        model_labels = np.load(labels_path)
+        if labels is not None and not np.array_equal(labels, model_labels):
+            raise ValueError('{} was predicted on other images than {}'.format(
+                path, prediction_paths[0]))
+        labels = model_labels
+    return labels
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.labels is not None:
+        labels = np.load(args.labels)
+    elif args.valid_dir is not None:
+        _, labels = get_image_paths_and_labels(args.valid_dir)
+    else:
+        labels = holdout_labels(args.predictions)
+    predictions = [np.load(path, mmap_mode='r') for path in args.predictions]
+    scorer = BlendScorer(predictions, labels, args.method)
+    weights = search_weights(scorer, args.objective, args.num_candidates,
+                             args.rounds, seed=args.seed)
+
+    num_models = len(predictions)
+    singles = np.eye(num_models)
+    single_logloss, single_accuracy = scorer.score(singles)
+    logloss, accuracy = scorer.score(weights)
+    for path, model_logloss, model_accuracy in zip(args.predictions, single_logloss, single_accuracy):
+        print('{}: logloss {:.4f}, accuracy {:.4f}'.format(path, model_logloss, model_accuracy))
+    print('Blend {}: logloss {:.4f}, accuracy {:.4f}'.format(
+        ' '.join('{:.3f}'.format(w) for w in weights), logloss[0], accuracy[0]))
+
+    # per-class accuracy against the best single model
+    num_classes = scorer.stack.shape[2]
+    best_single = single_accuracy.argmax()
+    class_gain = (per_class_accuracy(scorer.blend(weights), labels, num_classes) -
+                  per_class_accuracy(scorer.blend(singles[best_single]), labels, num_classes))
+    print('Per-class accuracy gain over {}:'.format(args.predictions[best_single]))
+    for c in np.argsort(-np.abs(class_gain)):
+        if class_gain[c] == 0:
+            break
+        print('  class {}: {:+.3f}'.format(c + 1, class_gain[c]))
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as f:
+        json.dump({'method': args.method,
+                   'objective': args.objective,
+                   'models': [os.path.basename(path) for path in args.predictions],
+                   'weights': weights.tolist(),
+                   'logloss': float(logloss[0]),
+                   'accuracy': float(accuracy[0]),
+                   'per_class_gain': class_gain.tolist()}, f, indent=2)
+    print('Saved weights to {}'.format(args.output))
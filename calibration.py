@@ -0,0 +1,78 @@
+import json
+import os
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+EPSILON = 1e-7
+
+
+def apply_temperature(probs, temperature):
+    """Softmax of log(probs) / temperature, i.e. the model's softmax with
+    its logits divided by `temperature` (the logits are only known up to a
+    per-row constant, which the softmax ignores)."""
+    logits = np.log(np.maximum(np.asarray(probs, dtype=np.float32), EPSILON)) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=1, keepdims=True)
+    return logits
+
+
+def negative_log_likelihood(probs, labels):
+    return -np.log(np.maximum(probs[np.arange(len(labels)), labels], EPSILON)).mean()
+
+
+def fit_temperature(probs, labels, bounds=(0.05, 20.)):
+    """Temperature minimising the validation log-loss of `probs`."""
+    result = minimize_scalar(
+        lambda t: negative_log_likelihood(apply_temperature(probs, t), labels),
+        bounds=bounds, method='bounded')
+    return float(result.x)
+
+
+def holdout_path(model_name):
+    return 'checkpoint/{}/holdout.npz'.format(model_name)
+
+
+def save_holdout(model_name, paths, labels):
+    """Record the images train.py kept out of training, the only labelled
+    images a temperature can be fitted on without bias."""
+    path = holdout_path(model_name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    np.savez(path, paths=np.asarray(paths, dtype=str), labels=np.asarray(labels, dtype=np.int64))
+
+
+def load_holdout(model_name):
+    """(paths, labels) saved by `save_holdout`, or None when train.py did
+    not record a holdout for `model_name`."""
+    path = holdout_path(model_name)
+    if not os.path.exists(path):
+        return None
+    holdout = np.load(path)
+    return holdout['paths'], holdout['labels']
+
+
+def temperature_path(model_path):
+    return '{}.temperature.json'.format(os.path.splitext(model_path)[0])
+
+
+def load_temperature(model_path, views):
+    """Temperature cached next to `model_path`, or None when there is none
+    for this checkpoint and these TTA views."""
+    path = temperature_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        cached = json.load(f)
+    if cached['checkpoint_mtime'] != os.path.getmtime(model_path) or cached['views'] != list(views):
+        return None
+    return cached['temperature']
+
+
+def save_temperature(model_path, views, temperature, nll_before, nll_after):
+    with open(temperature_path(model_path), 'w') as f:
+        json.dump({'temperature': temperature,
+                   'checkpoint_mtime': os.path.getmtime(model_path),
+                   'views': list(views),
+                   'nll_before': nll_before,
+                   'nll_after': nll_after}, f, indent=2)
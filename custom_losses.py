@@ -0,0 +1,9 @@
+from keras import backend as K
+from keras.losses import categorical_hinge
+
+
+def sparse_categorical_hinge(y_true, y_pred):
+    """`categorical_hinge` for int class indices; the one-hot targets are
+    built on the device instead of in the data loader."""
+    y_true = K.one_hot(K.cast(K.flatten(y_true), 'int32'), K.int_shape(y_pred)[-1])
+    return categorical_hinge(y_true, y_pred)
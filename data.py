@@ -2,15 +2,18 @@ import argparse
 import cv2
 import gc
 import os
+import threading
 import numpy as np
+from io import BytesIO
+from PIL import Image
 from imgaug import augmenters as iaa
-from keras.utils import Sequence, to_categorical
-from keras.applications.imagenet_utils import _preprocess_numpy_input
+from keras.utils import Sequence
 from keras.preprocessing.image import ImageDataGenerator
 
 import imgaug as ia
 from imgaug import augmenters as iaa
-from sklearn.utils import shuffle
+
+from batch_augmentation import BatchAugmenter
 
 
 def get_image_paths_and_labels(data_dir):
@@ -26,6 +29,296 @@ def get_image_paths_and_labels(data_dir):
     return x, y
 
 
+# cv2 flags decoding JPEGs at 1/2, 1/4 and 1/8 of their size via DCT scaling
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                        (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def imread_reduced(img_path, target_size):
+    """Decode `img_path` at the smallest DCT-scaled resolution that still
+    covers `target_size` (width, height), so large JPEGs are never fully
+    decoded just to be downsampled. The header is parsed by PIL from the
+    same bytes cv2 decodes."""
+    with open(img_path, 'rb') as f:
+        buf = f.read()
+    width, height = Image.open(BytesIO(buf)).size
+    flag = cv2.IMREAD_COLOR
+    for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+        if width // factor >= target_size[0] and height // factor >= target_size[1]:
+            flag = reduced_flag
+            break
+    return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flag)
+
+
+def read_images(paths, input_shape, image_store=None, out=None, reduced_decode=False):
+    """Return the (N, h, w, 3) uint8 BGR images of `paths` resized to
+    `input_shape` and the number of bytes read to get them. Batches are
+    sliced out of `image_store` when it holds every path, otherwise the
+    JPEGs are decoded (at reduced resolution with `reduced_decode`) and
+    resized straight into the rows of `out`.
+    """
+    if out is None:
+        out = np.empty((len(paths), input_shape[1], input_shape[0], 3), dtype=np.uint8)
+    if image_store is not None and all(path in image_store for path in paths):
+        image_store.read(paths, out=out)
+        return out, image_store.last_batch_nbytes
+    for i, img_path in enumerate(paths):
+        if reduced_decode:
+            img = imread_reduced(img_path, input_shape)
+        else:
+            img = cv2.imread(img_path)
+        cv2.resize(img,
+                   (input_shape[0], input_shape[1]),
+                   dst=out[i],
+                   interpolation=cv2.INTER_LINEAR)
+    return out, sum(os.path.getsize(img_path) for img_path in paths)
+
+
+# keras' 'torch' preprocessing mode: x / 255 normalized with the ImageNet
+# per-channel mean and std, folded into a single multiply-add
+TORCH_MEAN = np.array([0.485, 0.456, 0.406])
+TORCH_STD = np.array([0.229, 0.224, 0.225])
+_TORCH_SCALE = (1. / (255. * TORCH_STD)).astype(np.float32)
+_TORCH_OFFSET = (-TORCH_MEAN / TORCH_STD).astype(np.float32)
+
+
+def preprocess_images(images, out=None, dtype=np.float32):
+    """Same result as `_preprocess_numpy_input(images, mode='torch')`,
+    computed in place in `out` without float64 intermediates."""
+    if out is None:
+        out = np.empty(np.shape(images), dtype=dtype)
+    np.multiply(images, _TORCH_SCALE, out=out, casting='unsafe')
+    out += _TORCH_OFFSET.astype(out.dtype)
+    return out
+
+
+def to_one_hot(labels, num_classes, out=None):
+    labels = np.asarray(labels)
+    if out is None:
+        out = np.empty((len(labels), num_classes), dtype=np.float32)
+    out.fill(0)
+    out[np.arange(len(labels)), labels] = 1
+    return out
+
+
+def epoch_order(y, ordering='random'):
+    """Permutation of the sample indices for one epoch.
+
+    'random' is a plain shuffle. 'stratified' spreads every class evenly over
+    the epoch so each batch follows the overall class distribution.
+    'balanced' deals the classes round robin (one sample of every class,
+    then the next one, ...) until the small classes run out. Only the
+    returned int array changes, the path, label and feature arrays are never
+    copied. Uses the global numpy random state, so seeding it reproduces the
+    order.
+    """
+    if ordering == 'random':
+        return np.random.permutation(len(y))
+    if ordering not in ('stratified', 'balanced'):
+        raise ValueError('Unknown epoch ordering: {}'.format(ordering))
+    y = np.asarray(y)
+    # rank of every sample within its class after shuffling the class
+    order = np.random.permutation(len(y))
+    order = order[np.argsort(y[order], kind='mergesort')]
+    _, class_start, class_count = np.unique(y[order], return_index=True, return_counts=True)
+    rank = np.arange(len(y)) - np.repeat(class_start, class_count)
+    jitter = np.random.rand(len(y))
+    if ordering == 'stratified':
+        position = (rank + jitter) / np.repeat(class_count, class_count)
+    else:
+        position = rank + jitter
+    return order[np.argsort(position, kind='mergesort')]
+
+
+class ClassSampler(object):
+    """Draws batches with per-class probabilities instead of walking the
+    epoch permutation.
+
+    `sampling` is 'balanced' (every class equally likely), 'sqrt' (classes
+    weighted by the square root of their size) or custom per-class
+    probabilities as an array or a {class: probability} dict. Sample indices
+    are grouped by class once, so a batch costs O(batch_size): pick classes
+    by inverse CDF, then a uniform position inside each class.
+    """
+    def __init__(self, y, sampling, num_classes):
+        y = np.asarray(y)
+        counts = np.bincount(y, minlength=num_classes).astype(np.float64)
+        if sampling == 'balanced':
+            probs = (counts > 0).astype(np.float64)
+        elif sampling == 'sqrt':
+            probs = np.sqrt(counts)
+        elif isinstance(sampling, dict):
+            probs = np.zeros(num_classes)
+            for label, prob in sampling.items():
+                probs[int(label)] = prob
+        else:
+            probs = np.asarray(sampling, dtype=np.float64)
+        probs = np.where(counts > 0, probs, 0)
+        self.probs = probs / probs.sum()
+        self.counts = counts.astype(np.int64)
+        self.class_start = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        self.sorted_idx = np.argsort(y, kind='mergesort')
+        self._cum_probs = np.cumsum(self.probs)
+
+    def sample(self, batch_size, random_state):
+        u = random_state.rand(batch_size) * self._cum_probs[-1]
+        classes = np.minimum(np.searchsorted(self._cum_probs, u, side='right'),
+                             len(self.probs) - 1)
+        within = (random_state.rand(batch_size) * self.counts[classes]).astype(np.int64)
+        return self.sorted_idx[self.class_start[classes] + within]
+
+
+def encode_labels(labels, num_classes, sparse=False, buffers=None):
+    """int32 class indices for sparse losses, otherwise one-hot rows written
+    into the 'labels' array of `buffers` when given."""
+    if sparse:
+        return np.asarray(labels, dtype=np.int32)
+    out = None
+    if buffers is not None:
+        out = buffers.get('labels', (len(labels), num_classes), np.float32)
+    return to_one_hot(labels, num_classes, out=out)
+
+
+class BatchBuffers(object):
+    """Named arrays backing one batch. With `reuse` the arrays are kept and
+    handed out again when the owning pool cycles back to this slot."""
+    def __init__(self, reuse=True):
+        self.reuse = reuse
+        self._arrays = {}
+
+    def get(self, name, shape, dtype):
+        array = self._arrays.get(name)
+        if array is None or array.dtype != dtype or array.shape[0] < shape[0] \
+                or array.shape[1:] != tuple(shape[1:]):
+            array = np.empty(shape, dtype=dtype)
+            if self.reuse:
+                self._arrays[name] = array
+        return array[:shape[0]]
+
+
+class BatchBufferPool(object):
+    """Ring of `num_buffers` reusable batch buffers shared by the loader
+    threads of one Sequence.
+
+    A batch stays valid until the ring wraps around, so `num_buffers` must
+    exceed the number of batches alive at once: with `fit_generator` that is
+    `max_queue_size + workers + 1`. `num_buffers=0` allocates fresh arrays
+    for every batch. Process-based workers pickle their batches, so reuse is
+    always safe there.
+    """
+    def __init__(self, num_buffers=0):
+        self.num_buffers = num_buffers
+        self._slots = [BatchBuffers() for _ in range(num_buffers)]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'num_buffers': self.num_buffers}
+
+    def __setstate__(self, state):
+        self.__init__(state['num_buffers'])
+
+    def acquire(self):
+        if not self.num_buffers:
+            return BatchBuffers(reuse=False)
+        with self._lock:
+            slot = self._slots[self._next]
+            self._next = (self._next + 1) % self.num_buffers
+        return slot
+
+
+# Declarative description of the training augmentation. Every augmenter is a
+# one-key dict {imgaug class name: keyword arguments}; nested augmenters and
+# lists of augmenters are written the same way and 'ALL' stands for ia.ALL.
+# Tuples are kept as tuples since imgaug reads them as ranges to sample from.
+AUGMENTATION_SPEC = {'Sequential': {
+    'children': [
+        # apply the following augmenters to most images
+        {'Fliplr': {'p': 0.5}},  # horizontally flip 50% of all images
+        # crop images by -5% to 10% of their height/width
+        {'Sometimes': {'p': 0.5, 'then_list': {'CropAndPad': {
+            'percent': (-0.05, 0.1),
+            'pad_mode': 'ALL',
+            'pad_cval': (0, 255)}}}},
+        {'Sometimes': {'p': 0.5, 'then_list': {'Affine': {
+            'scale': {'x': (0.8, 1.2), 'y': (0.8, 1.2)},  # scale images to 80-120% of their size, individually per axis
+            'translate_percent': {'x': (-0.2, 0.2), 'y': (-0.2, 0.2)},  # translate by -20 to +20 percent (per axis)
+            'rotate': (20, 30),  # rotate by +20 to +30 degrees
+            'order': [0, 1],  # use nearest neighbour or bilinear interpolation (fast)
+            'cval': (0, 255),  # if mode is constant, use a cval between 0 and 255
+            'mode': 'ALL'}}}},  # use any of scikit-image's warping modes
+        # execute 0 to 5 of the following (less important) augmenters per image
+        # don't execute all of them, as that would often be way too strong
+        {'SomeOf': {
+            'n': (0, 5),
+            'children': [
+                {'OneOf': {'children': [
+                    {'GaussianBlur': {'sigma': (0, 0.5)}},  # blur images with a sigma between 0 and 0.5
+                    {'AverageBlur': {'k': (1, 3)}},  # blur image using local means with kernel sizes between 1 and 3
+                    {'MedianBlur': {'k': (1, 3)}}]}},  # blur image using local medians with kernel sizes between 1 and 3
+                {'AdditiveGaussianNoise': {'loc': 0, 'scale': (0.0, 0.03 * 255), 'per_channel': 0.5}},  # add gaussian noise to images
+                {'Add': {'value': (-10, 10), 'per_channel': 0.5}},  # change brightness of images (by -10 to 10 of original value)
+                {'AddToHueAndSaturation': {'value': (-20, 20)}},  # change hue and saturation
+                # either change the brightness of the whole image (sometimes
+                # per channel) or change the brightness of subareas
+                {'OneOf': {'children': [
+                    {'Multiply': {'mul': (0.5, 1.5), 'per_channel': 0.5}},
+                    {'FrequencyNoiseAlpha': {
+                        'exponent': (-4, 0),
+                        'first': {'Multiply': {'mul': (0.5, 1.5), 'per_channel': True}},
+                        'second': {'ContrastNormalization': {'alpha': (0.5, 2.0)}}}}]}},
+                {'ContrastNormalization': {'alpha': (1.4, 1.6), 'per_channel': 0.5}}],  # improve or worsen the contrast
+            'random_order': True}}],
+    'random_order': True}}
+
+
+def build_augmenter(spec):
+    """Turn a declarative spec such as `AUGMENTATION_SPEC` into imgaug
+    augmenters."""
+    if isinstance(spec, list):
+        return [build_augmenter(child) for child in spec]
+    if isinstance(spec, dict):
+        if len(spec) == 1 and hasattr(iaa, list(spec.keys())[0]):
+            name, kwargs = list(spec.items())[0]
+            return getattr(iaa, name)(**build_augmenter(kwargs))
+        return {key: build_augmenter(value) for key, value in spec.items()}
+    if spec == 'ALL':
+        return ia.ALL
+    return spec
+
+
+class ProcessLocalAugmenter(object):
+    """Builds the augmenter of `spec` once and reuses it for every batch.
+
+    Forked loader workers inherit the augmenter together with its random
+    state, so a process that did not build the augmenter itself rebuilds and
+    reseeds it from fresh entropy on first use. Otherwise every worker would
+    emit the same augmentations.
+    """
+    def __init__(self, spec=None):
+        self.spec = AUGMENTATION_SPEC if spec is None else spec
+        self._augmenter = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_augmenter'] = None
+        state['_pid'] = None
+        return state
+
+    def get(self):
+        if self._pid != os.getpid():
+            augmenter = build_augmenter(self.spec)
+            augmenter.reseed(np.random.RandomState().randint(0, 2 ** 31 - 1))
+            self._augmenter = augmenter
+            self._pid = os.getpid()
+        return self._augmenter
+
+    def augment_images(self, images):
+        return self.get().augment_images(images)
+
+
 class AugmentedDatasetWithSiftFeatures(Sequence):
     def __init__(
             self,
@@ -35,100 +328,86 @@ class AugmentedDatasetWithSiftFeatures(Sequence):
             batch_size,
             input_shape,
             num_classes=128,
-            shuffle=True):
+            shuffle=True,
+            ordering='random',
+            sampling=None,
+            image_store=None,
+            augmentation_spec=None,
+            augmentation_backend='imgaug',
+            augmentation_seed=None,
+            dtype='float32',
+            num_buffers=0,
+            reduced_decode=False,
+            sparse_labels=False,
+            sift_encoder=None):
         self.x, self.y = x_set, y_set
         self.sift_features = sift_features
+        self.sift_encoder = sift_encoder
         self.batch_size = batch_size
         self.input_shape = input_shape
         self.num_classes = num_classes
+        self.image_store = image_store
+        self.last_batch_nbytes = 0
+        self.dtype = np.dtype(dtype)
+        self.buffers = BatchBufferPool(num_buffers)
+        self.reduced_decode = reduced_decode
+        self.sparse_labels = sparse_labels
+        if augmentation_backend == 'numpy':
+            self.augmenter = BatchAugmenter(augmentation_seed)
+        else:
+            self.augmenter = ProcessLocalAugmenter(augmentation_spec)
         self.shuffle = shuffle
+        self.ordering = ordering
+        self.sampler = None
+        if sampling is not None:
+            self.sampler = ClassSampler(self.y, sampling, num_classes)
         self.on_train_begin()
         self.on_epoch_end()
 
     def on_train_begin(self):
-        if self.shuffle:
-            self.x, self.y, self.sift_features = shuffle(self.x, self.y, self.sift_features)
+        self.indices = np.arange(len(self.x))
 
     def on_epoch_end(self):
         if self.shuffle:
-            self.x, self.y, self.sift_features = shuffle(self.x, self.y, self.sift_features)
+            self.indices = epoch_order(self.y, self.ordering)
+        # batch `idx` is drawn from (sample_seed, idx) so loader threads and
+        # processes neither repeat nor depend on each other's batches
+        self.sample_seed = np.random.randint(0, 2 ** 31 - 1)
+
+    def _batch_indices(self, idx):
+        if self.sampler is not None:
+            random_state = np.random.RandomState([self.sample_seed, idx])
+            return self.sampler.sample(self.batch_size, random_state)
+        return self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
 
     def __len__(self):
         return int(np.ceil(len(self.x) / float(self.batch_size)))
         
     def _data_augmentation(self, images):
-        # Sometimes(0.5, ...) applies the given augmenter in 50% of all cases,
-        # e.g. Sometimes(0.5, GaussianBlur(0.3)) would blur roughly every second image.
-        sometimes = lambda aug: iaa.Sometimes(0.5, aug)
-
-        # Define our sequence of augmentation steps that will be applied to every image
-        # All augmenters with per_channel=0.5 will sample one value _per image_
-        # in 50% of all cases. In all other cases they will sample new values
-        # _per channel_.
-        seq = iaa.Sequential(
-            [
-                # apply the following augmenters to most images
-                iaa.Fliplr(0.5), # horizontally flip 50% of all images
-                # crop images by -5% to 10% of their height/width
-                sometimes(iaa.CropAndPad(
-                    percent=(-0.05, 0.1),
-                    pad_mode=ia.ALL,
-                    pad_cval=(0, 255)
-                )),
-                sometimes(iaa.Affine(
-                    scale={"x": (0.8, 1.2), "y": (0.8, 1.2)}, # scale images to 80-120% of their size, individually per axis
-                    translate_percent={"x": (-0.2, 0.2), "y": (-0.2, 0.2)}, # translate by -20 to +20 percent (per axis)
-                    rotate=(20, 30), # rotate by +20 to +30 degrees
-                    order=[0, 1], # use nearest neighbour or bilinear interpolation (fast)
-                    cval=(0, 255), # if mode is constant, use a cval between 0 and 255
-                    mode=ia.ALL # use any of scikit-image's warping modes (see 2nd image from the top for examples)
-                )),
-                # execute 0 to 5 of the following (less important) augmenters per image
-                # don't execute all of them, as that would often be way too strong
-                iaa.SomeOf((0, 5),
-                    [
-                        iaa.OneOf([
-                            iaa.GaussianBlur((0, 0.5)), # blur images with a sigma between 0 and 0.5
-                            iaa.AverageBlur(k=(1, 3)), # blur image using local means with kernel sizes between 1 and 3
-                            iaa.MedianBlur(k=(1, 3)), # blur image using local medians with kernel sizes between 1 and 3
-                        ]),
-                        iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, 0.03*255), per_channel=0.5), # add gaussian noise to images
-                        iaa.Add((-10, 10), per_channel=0.5), # change brightness of images (by -10 to 10 of original value)
-                        iaa.AddToHueAndSaturation((-20, 20)), # change hue and saturation
-                        # either change the brightness of the whole image (sometimes
-                        # per channel) or change the brightness of subareas
-                        iaa.OneOf([
-                            iaa.Multiply((0.5, 1.5), per_channel=0.5),
-                            iaa.FrequencyNoiseAlpha(
-                                exponent=(-4, 0),
-                                first=iaa.Multiply((0.5, 1.5), per_channel=True),
-                                second=iaa.ContrastNormalization((0.5, 2.0))
-                            )
-                        ]),
-                        iaa.ContrastNormalization((1.4, 1.6), per_channel=0.5) # improve or worsen the contrast      
-                    ],
-                    random_order=True
-                )
-            ],
-            random_order=True
-        )
-        return seq.augment_images(images)
+        return self.augmenter.augment_images(images)
 
     def __getitem__(self, idx):
-        batch_x = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_sift = self.sift_features[idx * self.batch_size:(idx + 1) * self.batch_size]
-
-        batch_imgs = [cv2.resize(cv2.imread(img_path), 
-                                 (self.input_shape[0], self.input_shape[1]), 
-                                 interpolation=cv2.INTER_LINEAR) 
-                      for img_path in batch_x]
+        batch_idx = self._batch_indices(idx)
+        batch_x = self.x[batch_idx]
+        batch_y = self.y[batch_idx]
+
+        buffers = self.buffers.acquire()
+        shape = (len(batch_x), self.input_shape[1], self.input_shape[0], 3)
+        batch_imgs, self.last_batch_nbytes = read_images(
+            batch_x, self.input_shape, self.image_store,
+            out=buffers.get('images', shape, np.uint8),
+            reduced_decode=self.reduced_decode)
         batch_imgs = self._data_augmentation(batch_imgs)
-        batch_imgs = _preprocess_numpy_input(np.array(batch_imgs),
-            data_format='channels_last', mode='torch')
+        if self.sift_encoder is not None:
+            # encode what the model sees rather than the original image
+            batch_sift = self.sift_encoder.encode(batch_imgs)
+        else:
+            batch_sift = self.sift_features[batch_idx]
+        batch_imgs = preprocess_images(
+            batch_imgs, out=buffers.get('inputs', shape, self.dtype))
 
-        return [batch_imgs, batch_sift], to_categorical(
-            np.array(batch_y), num_classes=self.num_classes)
+        return [batch_imgs, batch_sift], encode_labels(
+            batch_y, self.num_classes, self.sparse_labels, buffers)
 
 
 class DatasetWithSiftFeatures(Sequence):
@@ -139,12 +418,25 @@ class DatasetWithSiftFeatures(Sequence):
             sift_features,
             batch_size,
             input_shape,
-            num_classes=128):
+            num_classes=128,
+            image_store=None,
+            dtype='float32',
+            num_buffers=0,
+            reduced_decode=False,
+            sparse_labels=False,
+            sift_encoder=None):
         self.x, self.y = x_set, y_set
         self.sift_features = sift_features
+        self.sift_encoder = sift_encoder
         self.batch_size = batch_size
         self.input_shape = input_shape
         self.num_classes = num_classes
+        self.image_store = image_store
+        self.last_batch_nbytes = 0
+        self.dtype = np.dtype(dtype)
+        self.buffers = BatchBufferPool(num_buffers)
+        self.reduced_decode = reduced_decode
+        self.sparse_labels = sparse_labels
 
     def __len__(self):
         return int(np.ceil(len(self.x) / float(self.batch_size)))
@@ -152,17 +444,22 @@ class DatasetWithSiftFeatures(Sequence):
     def __getitem__(self, idx):
         batch_x = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
         batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_sift = self.sift_features[idx * self.batch_size:(idx + 1) * self.batch_size]
 
-        batch_imgs = [cv2.resize(cv2.imread(file_name),
-                                 self.input_shape,
-                                 interpolation=cv2.INTER_LINEAR)
-                      for file_name in batch_x]
-        batch_imgs = _preprocess_numpy_input(np.array(batch_imgs),
-            data_format='channels_last', mode='torch')
+        buffers = self.buffers.acquire()
+        shape = (len(batch_x), self.input_shape[1], self.input_shape[0], 3)
+        batch_imgs, self.last_batch_nbytes = read_images(
+            batch_x, self.input_shape, self.image_store,
+            out=buffers.get('images', shape, np.uint8),
+            reduced_decode=self.reduced_decode)
+        if self.sift_encoder is not None:
+            batch_sift = self.sift_encoder.encode(batch_imgs)
+        else:
+            batch_sift = self.sift_features[idx * self.batch_size:(idx + 1) * self.batch_size]
+        batch_imgs = preprocess_images(
+            batch_imgs, out=buffers.get('inputs', shape, self.dtype))
 
-        return [batch_imgs, batch_sift], to_categorical(
-            np.array(batch_y), num_classes=self.num_classes)
+        return [batch_imgs, batch_sift], encode_labels(
+            batch_y, self.num_classes, self.sparse_labels, buffers)
 
 
 class AugmentedDataset(Sequence):
@@ -173,98 +470,78 @@ class AugmentedDataset(Sequence):
             batch_size,
             input_shape,
             num_classes=128,
-            shuffle=True):
+            shuffle=True,
+            ordering='random',
+            sampling=None,
+            image_store=None,
+            augmentation_spec=None,
+            augmentation_backend='imgaug',
+            augmentation_seed=None,
+            dtype='float32',
+            num_buffers=0,
+            reduced_decode=False,
+            sparse_labels=False):
         self.x, self.y = x_set, y_set
         self.batch_size = batch_size
         self.input_shape = input_shape
         self.num_classes = num_classes
+        self.image_store = image_store
+        self.last_batch_nbytes = 0
+        self.dtype = np.dtype(dtype)
+        self.buffers = BatchBufferPool(num_buffers)
+        self.reduced_decode = reduced_decode
+        self.sparse_labels = sparse_labels
+        if augmentation_backend == 'numpy':
+            self.augmenter = BatchAugmenter(augmentation_seed)
+        else:
+            self.augmenter = ProcessLocalAugmenter(augmentation_spec)
         self.shuffle = shuffle
+        self.ordering = ordering
+        self.sampler = None
+        if sampling is not None:
+            self.sampler = ClassSampler(self.y, sampling, num_classes)
         self.on_train_begin()
         self.on_epoch_end()
 
     def on_train_begin(self):
-        if self.shuffle:
-            self.x, self.y, self.sift_features = shuffle(self.x, self.y, self.sift_features)
+        self.indices = np.arange(len(self.x))
 
     def on_epoch_end(self):
         if self.shuffle:
-            self.x, self.y, self.sift_features = shuffle(self.x, self.y, self.sift_features)
+            self.indices = epoch_order(self.y, self.ordering)
+        # batch `idx` is drawn from (sample_seed, idx) so loader threads and
+        # processes neither repeat nor depend on each other's batches
+        self.sample_seed = np.random.randint(0, 2 ** 31 - 1)
+
+    def _batch_indices(self, idx):
+        if self.sampler is not None:
+            random_state = np.random.RandomState([self.sample_seed, idx])
+            return self.sampler.sample(self.batch_size, random_state)
+        return self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
 
     def __len__(self):
         return int(np.ceil(len(self.x) / float(self.batch_size)))
         
     def _data_augmentation(self, images):
-        # Sometimes(0.5, ...) applies the given augmenter in 50% of all cases,
-        # e.g. Sometimes(0.5, GaussianBlur(0.3)) would blur roughly every second image.
-        sometimes = lambda aug: iaa.Sometimes(0.5, aug)
-
-        # Define our sequence of augmentation steps that will be applied to every image
-        # All augmenters with per_channel=0.5 will sample one value _per image_
-        # in 50% of all cases. In all other cases they will sample new values
-        # _per channel_.
-        seq = iaa.Sequential(
-            [
-                # apply the following augmenters to most images
-                iaa.Fliplr(0.5), # horizontally flip 50% of all images
-                # crop images by -5% to 10% of their height/width
-                sometimes(iaa.CropAndPad(
-                    percent=(-0.05, 0.1),
-                    pad_mode=ia.ALL,
-                    pad_cval=(0, 255)
-                )),
-                sometimes(iaa.Affine(
-                    scale={"x": (0.8, 1.2), "y": (0.8, 1.2)}, # scale images to 80-120% of their size, individually per axis
-                    translate_percent={"x": (-0.2, 0.2), "y": (-0.2, 0.2)}, # translate by -20 to +20 percent (per axis)
-                    rotate=(20, 30), # rotate by +20 to +30 degrees
-                    order=[0, 1], # use nearest neighbour or bilinear interpolation (fast)
-                    cval=(0, 255), # if mode is constant, use a cval between 0 and 255
-                    mode=ia.ALL # use any of scikit-image's warping modes (see 2nd image from the top for examples)
-                )),
-                # execute 0 to 5 of the following (less important) augmenters per image
-                # don't execute all of them, as that would often be way too strong
-                iaa.SomeOf((0, 5),
-                    [
-                        iaa.OneOf([
-                            iaa.GaussianBlur((0, 0.5)), # blur images with a sigma between 0 and 0.5
-                            iaa.AverageBlur(k=(1, 3)), # blur image using local means with kernel sizes between 1 and 3
-                            iaa.MedianBlur(k=(1, 3)), # blur image using local medians with kernel sizes between 1 and 3
-                        ]),
-                        iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, 0.03*255), per_channel=0.5), # add gaussian noise to images
-                        iaa.Add((-10, 10), per_channel=0.5), # change brightness of images (by -10 to 10 of original value)
-                        iaa.AddToHueAndSaturation((-20, 20)), # change hue and saturation
-                        # either change the brightness of the whole image (sometimes
-                        # per channel) or change the brightness of subareas
-                        iaa.OneOf([
-                            iaa.Multiply((0.5, 1.5), per_channel=0.5),
-                            iaa.FrequencyNoiseAlpha(
-                                exponent=(-4, 0),
-                                first=iaa.Multiply((0.5, 1.5), per_channel=True),
-                                second=iaa.ContrastNormalization((0.5, 2.0))
-                            )
-                        ]),
-                        iaa.ContrastNormalization((1.4, 1.6), per_channel=0.5) # improve or worsen the contrast      
-                    ],
-                    random_order=True
-                )
-            ],
-            random_order=True
-        )
-        return seq.augment_images(images)
+        return self.augmenter.augment_images(images)
 
     def __getitem__(self, idx):
-        batch_x = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
-
-        batch_imgs = [cv2.resize(cv2.imread(img_path), 
-                                 (self.input_shape[0], self.input_shape[1]), 
-                                 interpolation=cv2.INTER_LINEAR) 
-                      for img_path in batch_x]
+        batch_idx = self._batch_indices(idx)
+        batch_x = self.x[batch_idx]
+        batch_y = self.y[batch_idx]
+
+        buffers = self.buffers.acquire()
+        shape = (len(batch_x), self.input_shape[1], self.input_shape[0], 3)
+        batch_imgs, self.last_batch_nbytes = read_images(
+            batch_x, self.input_shape, self.image_store,
+            out=buffers.get('images', shape, np.uint8),
+            reduced_decode=self.reduced_decode)
         batch_imgs = self._data_augmentation(batch_imgs)
-        batch_imgs = _preprocess_numpy_input(np.array(batch_imgs),
-            data_format='channels_last', mode='torch')
+        batch_imgs = preprocess_images(
+            batch_imgs, out=buffers.get('inputs', shape, self.dtype))
 
-        return batch_imgs, to_categorical(
-            np.array(batch_y), num_classes=self.num_classes)
+        return batch_imgs, encode_labels(
+            batch_y, self.num_classes, self.sparse_labels, buffers)
 
 
 class Dataset(Sequence):
@@ -274,11 +551,22 @@ class Dataset(Sequence):
             y_set,
             batch_size,
             input_shape,
-            num_classes=128):
+            num_classes=128,
+            image_store=None,
+            dtype='float32',
+            num_buffers=0,
+            reduced_decode=False,
+            sparse_labels=False):
         self.x, self.y = x_set, y_set
         self.batch_size = batch_size
         self.input_shape = input_shape
         self.num_classes = num_classes
+        self.image_store = image_store
+        self.last_batch_nbytes = 0
+        self.dtype = np.dtype(dtype)
+        self.buffers = BatchBufferPool(num_buffers)
+        self.reduced_decode = reduced_decode
+        self.sparse_labels = sparse_labels
 
     def __len__(self):
         return int(np.ceil(len(self.x) / float(self.batch_size)))
@@ -287,12 +575,14 @@ class Dataset(Sequence):
         batch_x = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
         batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
 
-        batch_imgs = [cv2.resize(cv2.imread(file_name),
-                                 self.input_shape,
-                                 interpolation=cv2.INTER_LINEAR)
-                      for file_name in batch_x]
-        batch_imgs = _preprocess_numpy_input(np.array(batch_imgs),
-            data_format='channels_last', mode='torch')
-
-        return batch_imgs, to_categorical(
-            np.array(batch_y), num_classes=self.num_classes)
\ No newline at end of file
+        buffers = self.buffers.acquire()
+        shape = (len(batch_x), self.input_shape[1], self.input_shape[0], 3)
+        batch_imgs, self.last_batch_nbytes = read_images(
+            batch_x, self.input_shape, self.image_store,
+            out=buffers.get('images', shape, np.uint8),
+            reduced_decode=self.reduced_decode)
+        batch_imgs = preprocess_images(
+            batch_imgs, out=buffers.get('inputs', shape, self.dtype))
+
+        return batch_imgs, encode_labels(
+            batch_y, self.num_classes, self.sparse_labels, buffers)
\ No newline at end of file
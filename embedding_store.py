@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+parser = argparse.ArgumentParser(
+    description='Export backbone embeddings for nearest-neighbour search')
+parser.add_argument(
+    '--model-name',
+    type=str,
+    help='model whose checkpoint is encoded')
+parser.add_argument(
+    '--iter',
+    default=1,
+    type=int,
+    help='checkpoint/{model-name}/iter{N}.hdf5')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int)
+parser.add_argument(
+    '--batch-size',
+    default=64,
+    type=int,
+    metavar='N',
+    help='mini-batch size')
+parser.add_argument(
+    '--splits',
+    nargs='+',
+    default=['train', 'validation', 'test'],
+    type=str,
+    help='train and validation are read from data/{split}, test from --test-dir')
+parser.add_argument(
+    '--test-dir',
+    default='data/test/test12703',
+    type=str,
+    metavar='PATH')
+parser.add_argument(
+    '--store-dir',
+    default='data/embeddings',
+    type=str,
+    metavar='PATH')
+parser.add_argument(
+    '--pca-dim',
+    default=0,
+    type=int,
+    metavar='N',
+    help='reduce the embeddings to N dimensions, fitted on the train split (0 keeps all)')
+parser.add_argument(
+    '--num-lists',
+    default=0,
+    type=int,
+    metavar='N',
+    help='also build an IVF index with N lists over the train split')
+
+
+def l2_normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def fit_pca(x, dim, max_rows=50000, seed=0):
+    """Mean and (dim, features) principal axes of a sample of `x`."""
+    rng = np.random.RandomState(seed)
+    if len(x) > max_rows:
+        x = x[np.sort(rng.choice(len(x), max_rows, replace=False))]
+    x = np.asarray(x, dtype=np.float64)
+    mean = x.mean(axis=0)
+    covariance = np.dot((x - mean).T, x - mean) / len(x)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    components = eigenvectors[:, ::-1][:, :dim].T
+    explained = eigenvalues[::-1][:dim].sum() / eigenvalues.sum()
+    return mean.astype(np.float32), components.astype(np.float32), float(explained)
+
+
+def store_path(store_dir, model_name, split):
+    return os.path.join(store_dir, '{}_{}.npy'.format(model_name, split))
+
+
+def write_embeddings(path, features, mean=None, components=None, chunk_size=8192):
+    """Project `features` with the PCA `components` when given, L2-normalise
+    them and write them to a float16 .npy, `chunk_size` rows at a time."""
+    dim = features.shape[1] if components is None else components.shape[0]
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                    shape=(len(features), dim))
+    for start in range(0, len(features), chunk_size):
+        chunk = np.asarray(features[start:start + chunk_size], dtype=np.float32)
+        if components is not None:
+            chunk = np.dot(chunk - mean, components.T)
+        out[start:start + chunk_size] = l2_normalize(chunk)
+    out.flush()
+
+
+def load_embeddings(store_dir, model_name, split):
+    """float16 embeddings (memory-mapped), labels and paths of a split."""
+    path = store_path(store_dir, model_name, split)
+    prefix = path[:-len('.npy')]
+    return (np.load(path, mmap_mode='r'),
+            np.load(prefix + '_labels.npy'),
+            np.load(prefix + '_paths.npy'))
+
+
+def _merge_top_k(scores, indices, block_scores, block_indices, k):
+    scores = np.concatenate([scores, block_scores], axis=1)
+    indices = np.concatenate([indices, block_indices], axis=1)
+    top = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(indices, top, axis=1)
+
+
+def _sort_top_k(scores, indices):
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class ExactIndex(object):
+    """Exact cosine nearest neighbours over L2-normalised embeddings.
+
+    The database is scanned in blocks of `block_size` rows: each block is
+    converted to float32 and scored against all queries with one matrix
+    product, and a running top k is kept with `np.argpartition`, so the
+    float16 store never has to be converted as a whole.
+    """
+    def __init__(self, embeddings, block_size=65536):
+        self.embeddings = embeddings
+        self.block_size = block_size
+
+    def search(self, queries, k=10):
+        queries = l2_normalize(queries)
+        scores = np.empty((len(queries), 0), dtype=np.float32)
+        indices = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.embeddings), self.block_size):
+            block = np.asarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+            block_scores = np.dot(queries, block.T)
+            kk = min(k, block_scores.shape[1])
+            top = np.argpartition(-block_scores, kk - 1, axis=1)[:, :kk]
+            scores, indices = _merge_top_k(
+                scores, indices, np.take_along_axis(block_scores, top, axis=1), top + start, k)
+        return _sort_top_k(scores, indices)
+
+
+class IVFIndex(object):
+    """Inverted file index: the embeddings are clustered into `num_lists`
+    lists with k-means, stored contiguously list by list, and a query only
+    scans the `nprobe` lists whose centroids are closest to it."""
+    def __init__(self, centroids, embeddings, ids, offsets):
+        self.centroids = centroids
+        self.embeddings = embeddings
+        self.ids = ids
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, embeddings, num_lists=1024, max_train_rows=100000, seed=0,
+              chunk_size=65536):
+        rng = np.random.RandomState(seed)
+        sample = np.arange(len(embeddings))
+        if len(sample) > max_train_rows:
+            sample = np.sort(rng.choice(len(embeddings), max_train_rows, replace=False))
+        kmeans = MiniBatchKMeans(n_clusters=num_lists, random_state=seed,
+                                 batch_size=max(1024, 4 * num_lists))
+        kmeans.fit(np.asarray(embeddings[sample], dtype=np.float32))
+        centroids = l2_normalize(kmeans.cluster_centers_)
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+            assignments[start:start + chunk_size] = np.dot(chunk, centroids.T).argmax(axis=1)
+        ids = np.argsort(assignments, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+        return cls(centroids, np.asarray(embeddings[ids], dtype=np.float16), ids, offsets)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, embeddings=self.embeddings,
+                 ids=self.ids, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['centroids'], data['embeddings'], data['ids'], data['offsets'])
+
+    def search(self, queries, k=10, nprobe=8):
+        queries = l2_normalize(queries)
+        nprobe = min(nprobe, len(self.centroids))
+        coarse = np.dot(queries, self.centroids.T)
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, lists in enumerate(probes):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if not len(rows):
+                continue
+            row_scores = np.dot(self.embeddings[rows].astype(np.float32), queries[q])
+            kk = min(k, len(rows))
+            top = np.argpartition(-row_scores, kk - 1)[:kk]
+            scores[q, :kk] = row_scores[top]
+            indices[q, :kk] = self.ids[rows[top]]
+        return _sort_top_k(scores, indices)
+
+
+def knn_classify(scores, indices, labels, num_classes=128):
+    """Class probabilities from the neighbours' labels, each neighbour
+    voting with its (non-negative) similarity."""
+    weights = np.maximum(scores, 0)
+    weights[indices < 0] = 0
+    votes = np.zeros((len(scores), num_classes), dtype=np.float32)
+    rows = np.repeat(np.arange(len(scores)), scores.shape[1])
+    np.add.at(votes, (rows, labels[np.maximum(indices, 0)].ravel()), weights.ravel())
+    return votes / np.maximum(votes.sum(axis=1, keepdims=True), 1e-12)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # imported here so the search classes above work without keras
+    from keras.models import load_model
+
+    from data import get_image_paths_and_labels
+    from feature_cache import backbone_of, extract_features
+    from manifest import load_manifest
+
+    input_shape = tuple(args.input_shape)
+    if not os.path.exists(args.store_dir):
+        os.makedirs(args.store_dir)
+    model_path = 'checkpoint/{}/iter{}.hdf5'.format(args.model_name, args.iter)
+    backbone = backbone_of(load_model(model_path))
+
+    # raw pooled features first, the PCA is fitted on the train split
+    raw_paths = {}
+    for split in args.splits:
+        if split == 'test':
+            paths = np.array(load_manifest(args.test_dir)['paths'])
+            labels = np.full(len(paths), -1, dtype=np.int64)
+        else:
+            paths, labels = get_image_paths_and_labels(os.path.join('data', split))
+        raw_path = store_path(args.store_dir, args.model_name, split + '_raw')
+        print('Encoding {} {} images'.format(len(paths), split))
+        extract_features(backbone, paths, np.maximum(labels, 0), raw_path,
+                         args.batch_size, input_shape)
+        prefix = store_path(args.store_dir, args.model_name, split)[:-len('.npy')]
+        np.save(prefix + '_labels.npy', labels)
+        np.save(prefix + '_paths.npy', paths)
+        os.remove(raw_path[:-len('.npy')] + '_labels.npy')
+        raw_paths[split] = raw_path
+
+    mean = components = None
+    info = {'model_path': model_path, 'input_shape': list(input_shape), 'pca_dim': 0}
+    if args.pca_dim:
+        mean, components, explained = fit_pca(np.load(raw_paths['train'], mmap_mode='r'),
+                                              args.pca_dim)
+        np.savez(os.path.join(args.store_dir, '{}_pca.npz'.format(args.model_name)),
+                 mean=mean, components=components)
+        info.update(pca_dim=args.pca_dim, explained_variance=explained)
+        print('PCA to {} dimensions keeps {:.1%} of the variance'.format(args.pca_dim, explained))
+    for split, raw_path in raw_paths.items():
+        write_embeddings(store_path(args.store_dir, args.model_name, split),
+                         np.load(raw_path, mmap_mode='r'), mean, components)
+        os.remove(raw_path)
+    with open(os.path.join(args.store_dir, '{}.json'.format(args.model_name)), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    if args.num_lists:
+        embeddings, _, _ = load_embeddings(args.store_dir, args.model_name, 'train')
+        index = IVFIndex.build(embeddings, args.num_lists)
+        index.save(os.path.join(args.store_dir, '{}_train_ivf.npz'.format(args.model_name)))
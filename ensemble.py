@@ -0,0 +1,155 @@
+import argparse
+import json
+import numpy as np
+import os
+
+from manifest import load_manifest
+from submission import save_submission
+
+METHODS = ['arithmetic', 'geometric', 'rank', 'logit']
+EPSILON = 1e-7
+
+parser = argparse.ArgumentParser(
+    description='Ensemble')
+parser.add_argument(
+    'predictions',
+    nargs='+',
+    type=str,
+    help='.npy files of (num_test_images, num_classes) predictions')
+parser.add_argument(
+    '--method',
+    default='arithmetic',
+    choices=METHODS,
+    type=str,
+    help='arithmetic/geometric mean of the probabilities, mean of the per-image class ranks or of the logits')
+parser.add_argument(
+    '--weights',
+    nargs='+',
+    default=None,
+    type=float,
+    help='one weight per prediction file, equal weights by default')
+parser.add_argument(
+    '--weights-file',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='JSON written by blend_weights.py, sets --weights and --method; the weights '
+         'are matched to the prediction files by file name')
+parser.add_argument(
+    '--chunk-size',
+    default=2048,
+    type=int,
+    metavar='N',
+    help='number of test images combined at a time')
+parser.add_argument(
+    '--test-dir',
+    default='data/test/test12703',
+    type=str,
+    metavar='PATH',
+    help='folder the predictions were made on, for the image ids')
+parser.add_argument(
+    '--submit-dir',
+    default='submission/ensemble',
+    type=str,
+    help='path to saved submission file')
+parser.add_argument(
+    '--submit-fname',
+    default='ensemble',
+    type=str)
+
+
+def blend_space(chunk, method):
+    """Map a chunk of probabilities to the space the method averages in."""
+    if method == 'geometric':
+        return np.log(np.maximum(chunk, EPSILON))
+    if method == 'logit':
+        chunk = np.clip(chunk, EPSILON, 1 - EPSILON)
+        return np.log(chunk) - np.log1p(-chunk)
+    if method == 'rank':
+        # rank of every class within its image, 0 for the least likely
+        return chunk.argsort(axis=1).argsort(axis=1).astype(np.float32)
+    return chunk
+
+
+def blend_file_weights(blend, predictions):
+    """Weights of a blend_weights.py JSON in the order of the prediction
+    files, matched by file name. Raises ValueError unless the files are
+    exactly the models the weights were searched for."""
+    names = [os.path.basename(path) for path in predictions]
+    if sorted(names) != sorted(blend['models']):
+        raise ValueError('The weights are for {}, got {}'.format(
+            ', '.join(blend['models']), ', '.join(names)))
+    if len(set(names)) != len(names):
+        raise ValueError('Prediction file names are not unique: {}'.format(', '.join(names)))
+    weights = dict(zip(blend['models'], blend['weights']))
+    return [weights[name] for name in names]
+
+
+def combine(predictions, method='arithmetic', weights=None, chunk_size=2048):
+    """Weighted average of `predictions`, a list of .npy paths or arrays of
+    the same shape, `chunk_size` rows at a time.
+
+    Files are memory-mapped, so only one chunk of each is read at any time.
+    Geometric and logit averages are mapped back to probabilities that sum
+    to 1 per image, like blend_weights.py scores them; the rank
+    average returns mean class ranks, which only keep the argmax meaningful.
+    """
+    arrays = [np.load(p, mmap_mode='r') if isinstance(p, str) else p for p in predictions]
+    shape = arrays[0].shape
+    for path, array in zip(predictions, arrays):
+        if array.shape != shape:
+            raise ValueError('{} has shape {}, expected {}'.format(
+                path if isinstance(path, str) else 'array', array.shape, shape))
+    if weights is None:
+        weights = np.ones(len(arrays))
+    weights = np.asarray(weights, dtype=np.float32)
+    if len(weights) != len(arrays):
+        raise ValueError('Got {} weights for {} predictions'.format(len(weights), len(arrays)))
+    weights = weights / weights.sum()
+
+    combined = np.empty(shape, dtype=np.float32)
+    for start in range(0, shape[0], chunk_size):
+        out = combined[start:start + chunk_size]
+        out[...] = 0
+        for weight, array in zip(weights, arrays):
+            chunk = np.asarray(array[start:start + chunk_size], dtype=np.float32)
+            out += weight * blend_space(chunk, method)
+        if method == 'geometric':
+            np.exp(out, out=out)
+            out /= out.sum(axis=1, keepdims=True)
+        elif method == 'logit':
+            np.negative(out, out=out)
+            np.exp(out, out=out)
+            out += 1
+            np.reciprocal(out, out=out)
+            # per-class sigmoids, renormalised into a distribution per image
+            out /= out.sum(axis=1, keepdims=True)
+    return combined
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    method, weights = args.method, args.weights
+    if args.weights_file is not None:
+        with open(args.weights_file) as f:
+            blend = json.load(f)
+        method, weights = blend['method'], blend_file_weights(blend, args.predictions)
+        print('Blending {} with {} weights {}'.format(
+            ', '.join(args.predictions), method, weights))
+
+    test_pred = combine(args.predictions, method, weights, args.chunk_size)
+    if not os.path.exists(args.submit_dir):
+        os.makedirs(args.submit_dir)
+    np.save(
+        os.path.join(
+            args.submit_dir,
+            '{}.npy'.format(args.submit_fname)),
+        test_pred)
+    ids = load_manifest(args.test_dir)['ids']
+    # same fallback label as average.py for the images that failed to download
+    save_submission(
+        os.path.join(
+            args.submit_dir,
+            '{}.csv'.format(args.submit_fname)),
+        ids, test_pred, fallback=101)
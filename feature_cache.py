@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau
+from keras.layers import Dense, Input
+from keras.models import Model
+from keras.optimizers import Adam
+from keras.utils import Sequence
+
+from data import AugmentedDataset, ClassSampler, Dataset, encode_labels
+
+
+def paths_digest(paths):
+    return hashlib.md5('\n'.join(paths).encode('utf-8')).hexdigest()[:12]
+
+
+def decode_settings(dataset_kwargs=None):
+    """The dataset settings that change the inputs the backbone sees."""
+    dataset_kwargs = dataset_kwargs or {}
+    return {'dtype': np.dtype(dataset_kwargs.get('dtype', 'float32')).name,
+            'reduced_decode': bool(dataset_kwargs.get('reduced_decode', False)),
+            'image_store': dataset_kwargs.get('image_store') is not None}
+
+
+def settings_digest(dataset_kwargs=None):
+    return hashlib.md5(json.dumps(decode_settings(dataset_kwargs), sort_keys=True)
+                       .encode('utf-8')).hexdigest()[:8]
+
+
+def feature_cache_path(cache_dir, model_name, input_shape, paths, num_augmentations=0, seed=0,
+                       dataset_kwargs=None):
+    """`{cache_dir}/{model}_{w}x{h}_{digest of paths}_{digest of the decode
+    settings}_aug{K}_seed{seed}.npy`; K = 0 are the features of the plain
+    images."""
+    return os.path.join(cache_dir, '{}_{}x{}_{}_{}_aug{}_seed{}.npy'.format(
+        model_name, input_shape[0], input_shape[1], paths_digest(paths),
+        settings_digest(dataset_kwargs), num_augmentations, seed))
+
+
+def backbone_of(model):
+    """The model up to the pooled features feeding the 'predictions' layer."""
+    return Model(inputs=model.input, outputs=model.get_layer('predictions').input)
+
+
+def extract_features(backbone, x, y, path, batch_size, input_shape,
+                     num_augmentations=0, seed=0, dataset_kwargs=None):
+    """Run `backbone` once over the images `x` and store the pooled features
+    in a float16 memmap at `path`, with the labels next to it.
+
+    Without augmentations every image is encoded once. With
+    `num_augmentations` K, the images are encoded K times through the numpy
+    augmentation backend seeded with `seed + k` for pass k, which gives
+    (K * len(x), dim) features. Batches are produced in order on this
+    thread, so the same seed gives the same features. The features are
+    written to a temporary file which is renamed when complete, so an
+    interrupted run never leaves a truncated cache behind.
+    """
+    dataset_kwargs = dict(dataset_kwargs or {})
+    # only the images are used, keep the labels out of the way
+    dataset_kwargs.pop('sparse_labels', None)
+    if num_augmentations:
+        datasets = [AugmentedDataset(x, y, batch_size=batch_size, input_shape=input_shape,
+                                     shuffle=False, augmentation_backend='numpy',
+                                     augmentation_seed=seed + k, **dataset_kwargs)
+                    for k in range(num_augmentations)]
+    else:
+        datasets = [Dataset(x, y, batch_size=batch_size, input_shape=input_shape,
+                            **dataset_kwargs)]
+
+    dim = int(backbone.output_shape[-1])
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    features = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float16, shape=(len(datasets) * len(x), dim))
+    row = 0
+    for k, dataset in enumerate(datasets):
+        print('Encoding pass {}/{} of {} images'.format(k + 1, len(datasets), len(x)))
+        for idx in range(len(dataset)):
+            batch_imgs, _ = dataset[idx]
+            batch_features = backbone.predict_on_batch(batch_imgs)
+            features[row:row + len(batch_features)] = batch_features
+            row += len(batch_features)
+    features.flush()
+    del features
+    np.save(path[:-len('.npy')] + '_labels.npy', np.tile(np.asarray(y), len(datasets)))
+    os.rename(tmp_path, path)
+
+
+def load_features(path):
+    return np.load(path, mmap_mode='r'), np.load(path[:-len('.npy')] + '_labels.npy')
+
+
+def cached_features(backbone, model_name, x, y, batch_size, input_shape,
+                    cache_dir='data/feature_cache', num_augmentations=0, seed=0,
+                    dataset_kwargs=None):
+    """Features and labels of `x`, extracted on the first call for this
+    model, input shape, image list, decode settings (see `decode_settings`),
+    number of augmentations and seed. Pass
+    the images in a fixed (e.g. sorted) order to reuse the cache across
+    train/validation splits, see `feature_rows`."""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = feature_cache_path(cache_dir, model_name, input_shape, x, num_augmentations, seed,
+                              dataset_kwargs)
+    if not os.path.exists(path):
+        extract_features(backbone, x, y, path, batch_size, input_shape,
+                         num_augmentations, seed, dataset_kwargs)
+        with open(path[:-len('.npy')] + '.json', 'w') as f:
+            json.dump({'model_name': model_name,
+                       'input_shape': list(input_shape),
+                       'num_images': len(x),
+                       'num_augmentations': num_augmentations,
+                       'seed': seed,
+                       'decode_settings': decode_settings(dataset_kwargs)}, f, indent=2)
+    else:
+        print('Using cached features {}'.format(path))
+    return load_features(path)
+
+
+def feature_rows(cached_paths, paths, num_passes=1):
+    """Rows of the features of `paths` in a cache built over the sorted
+    `cached_paths`, in every augmentation pass."""
+    positions = np.searchsorted(cached_paths, paths)
+    return (np.arange(num_passes)[:, None] * len(cached_paths) + positions).ravel()
+
+
+class FeatureDataset(Sequence):
+    """Batches of the cached float16 features in `rows` (all by default),
+    converted to float32 one batch at a time so the memmap never has to be
+    resident. With `sampling` the batches are drawn by class probability
+    like AugmentedDataset's, see `ClassSampler`."""
+    def __init__(self, features, labels, batch_size, rows=None, num_classes=128,
+                 shuffle=True, sparse_labels=False, sampling=None):
+        self.features, self.labels = features, labels
+        self.batch_size = batch_size
+        self.rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
+        self.num_classes = num_classes
+        self.shuffle = shuffle
+        self.sparse_labels = sparse_labels
+        self.sampler = None
+        if sampling is not None:
+            self.sampler = ClassSampler(self.labels[self.rows], sampling, num_classes)
+        self.indices = self.rows
+        self.on_epoch_end()
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.indices = self.rows[np.random.permutation(len(self.rows))]
+        self.sample_seed = np.random.randint(0, 2 ** 31 - 1)
+
+    def _batch_rows(self, idx):
+        if self.sampler is not None:
+            random_state = np.random.RandomState([self.sample_seed, idx])
+            return self.rows[self.sampler.sample(self.batch_size, random_state)]
+        return self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+    def __len__(self):
+        return int(np.ceil(len(self.rows) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        # sorted rows read the memmap front to back
+        batch_idx = np.sort(self._batch_rows(idx))
+        batch_features = np.asarray(self.features[batch_idx], dtype=np.float32)
+        return batch_features, encode_labels(
+            self.labels[batch_idx], self.num_classes, self.sparse_labels)
+
+
+def train_head(model, train_generator, valid_generator, loss, head_path, epochs=5,
+               class_weight=None):
+    """Fit a copy of the 'predictions' layer of `model` on FeatureDataset
+    batches, keep the epoch with the best validation accuracy and copy its
+    weights back into `model`."""
+    predictions = model.get_layer('predictions')
+    inputs = Input(shape=(int(train_generator.features.shape[1]),))
+    head = Model(inputs=inputs,
+                 outputs=Dense(predictions.units, activation=predictions.activation,
+                               name='predictions')(inputs))
+    head.compile(optimizer=Adam(lr=0.001), loss=loss, metrics=['acc'])
+    save_best = ModelCheckpoint(filepath=head_path,
+                                verbose=1,
+                                monitor='val_acc',
+                                save_best_only=True,
+                                save_weights_only=True,
+                                mode='max')
+    reduce_lr = ReduceLROnPlateau(monitor='val_acc',
+                                  factor=0.2,
+                                  patience=2,
+                                  verbose=1)
+    head.fit_generator(generator=train_generator,
+                       epochs=epochs,
+                       callbacks=[save_best, reduce_lr],
+                       validation_data=valid_generator,
+                       class_weight=class_weight)
+    head.load_weights(head_path)
+    predictions.set_weights(head.get_layer('predictions').get_weights())
+    return model
@@ -0,0 +1,132 @@
+import argparse
+import cv2
+import json
+import os
+import numpy as np
+from tqdm import tqdm
+
+from data import get_image_paths_and_labels
+
+parser = argparse.ArgumentParser(
+    description='Pack image folders into pre-resized uint8 memmap shards')
+parser.add_argument(
+    '--data-dirs',
+    nargs='+',
+    default=['data/train', 'data/validation'],
+    type=str,
+    metavar='PATH',
+    help='class folders to pack, one shard per folder')
+parser.add_argument(
+    '--store-dir',
+    default='data/image_store',
+    type=str,
+    metavar='PATH',
+    help='where to write the shards')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    type=int)
+
+
+def shard_name(data_dir, input_shape):
+    split = os.path.basename(os.path.normpath(data_dir))
+    return '{}_{}x{}'.format(split, input_shape[0], input_shape[1])
+
+
+def build_shard(data_dir, store_dir, input_shape):
+    """Decode and resize every image of `data_dir` once into
+    `{store_dir}/{split}_{w}x{h}.npy`, a (N, h, w, 3) uint8 array in the
+    same BGR layout the Sequences get from `cv2.imread`. Paths and labels are
+    saved next to it so batches can be located by image path.
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    name = shard_name(data_dir, input_shape)
+    x, y = get_image_paths_and_labels(data_dir)
+    images_path = os.path.join(store_dir, '{}.npy'.format(name))
+    # write into a temporary file so an interrupted build never leaves a
+    # truncated shard that the Sequences would pick up
+    tmp_path = images_path + '.tmp'
+    images = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.uint8,
+        shape=(len(x), input_shape[1], input_shape[0], 3))
+    for i, img_path in enumerate(tqdm(x)):
+        images[i] = cv2.resize(cv2.imread(img_path),
+                               (input_shape[0], input_shape[1]),
+                               interpolation=cv2.INTER_LINEAR)
+    images.flush()
+    del images
+    np.save(os.path.join(store_dir, '{}_paths.npy'.format(name)), x)
+    np.save(os.path.join(store_dir, '{}_labels.npy'.format(name)), y)
+    os.rename(tmp_path, images_path)
+    with open(os.path.join(store_dir, '{}.json'.format(name)), 'w') as f:
+        json.dump({'data_dir': data_dir,
+                   'input_shape': list(input_shape),
+                   'num_images': len(x)}, f)
+    return images_path
+
+
+class ImageStore(object):
+    """Read-only view over the shards built by `build_shard` for one
+    `input_shape`. Images are looked up by their original path, so the
+    Sequences keep working on path arrays (e.g. after `train_test_split`).
+    """
+    def __init__(self, store_dir, input_shape, data_dirs):
+        self.input_shape = tuple(input_shape)
+        self.shards = []
+        self.index = {}
+        for data_dir in data_dirs:
+            name = shard_name(data_dir, input_shape)
+            images_path = os.path.join(store_dir, '{}.npy'.format(name))
+            paths = np.load(os.path.join(store_dir, '{}_paths.npy'.format(name)))
+            shard_idx = len(self.shards)
+            self.shards.append(np.load(images_path, mmap_mode='r'))
+            for row, path in enumerate(paths):
+                self.index[os.path.normpath(path)] = (shard_idx, row)
+        self.image_nbytes = input_shape[0] * input_shape[1] * 3
+        self.last_batch_nbytes = 0
+        self.total_nbytes = 0
+
+    @classmethod
+    def open(cls, store_dir, input_shape, data_dirs):
+        """Return an `ImageStore`, or None when a shard for `input_shape`
+        is missing so callers can fall back to decoding the JPEGs."""
+        for data_dir in data_dirs:
+            name = shard_name(data_dir, input_shape)
+            if not os.path.exists(os.path.join(store_dir, '{}.npy'.format(name))):
+                print('No image store shard {} in {}, decoding JPEGs instead'.format(
+                    name, store_dir))
+                return None
+        return cls(store_dir, input_shape, data_dirs)
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.index
+
+    def read(self, paths, out=None):
+        """Gather the images of `paths` into a (len(paths), h, w, 3) uint8
+        array. Rows are read in ascending order per shard to keep the page
+        cache access sequential.
+        """
+        if out is None:
+            out = np.empty((len(paths), self.input_shape[1],
+                            self.input_shape[0], 3), dtype=np.uint8)
+        locations = np.array([self.index[os.path.normpath(path)] for path in paths],
+                             dtype=np.int64).reshape(-1, 2)
+        for shard_idx in np.unique(locations[:, 0]):
+            batch_pos = np.where(locations[:, 0] == shard_idx)[0]
+            rows = locations[batch_pos, 1]
+            order = np.argsort(rows)
+            out[batch_pos[order]] = self.shards[shard_idx][rows[order]]
+        self.last_batch_nbytes = len(paths) * self.image_nbytes
+        self.total_nbytes += self.last_batch_nbytes
+        return out
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    for data_dir in args.data_dirs:
+        print('Packing {}'.format(data_dir))
+        images_path = build_shard(data_dir, args.store_dir, tuple(args.input_shape))
+        print('Saved {} ({:.2f} GB)'.format(
+            images_path, os.path.getsize(images_path) / 1024 ** 3))
@@ -0,0 +1,97 @@
+import json
+import os
+from PIL import Image
+
+from tta import list_images
+
+# kept out of the image directories: a file next to them would be listed as
+# one more TTA view folder, one inside them would change their mtime
+MANIFEST_DIR = 'data/manifests'
+
+
+def image_id(path):
+    """Kaggle id of a test image, its file name without extension."""
+    return int(os.path.basename(path).split('.')[0])
+
+
+def manifest_path(directory, cache_dir=MANIFEST_DIR):
+    """`{cache_dir}/{directory with / replaced by _}.manifest.json`."""
+    name = os.path.normpath(directory).strip(os.sep).replace(os.sep, '_')
+    return os.path.join(cache_dir, '{}.manifest.json'.format(name))
+
+
+def directory_mtimes(directory):
+    """Modification times of `directory` and its subdirectories, which change
+    whenever an image is added, removed or renamed."""
+    return {root: os.path.getmtime(root) for root, _, _ in os.walk(directory)}
+
+
+def image_shape(path):
+    """(height, width) from the image header, without decoding the pixels."""
+    try:
+        width, height = Image.open(path).size
+    except IOError:
+        return None
+    return [height, width]
+
+
+def build_manifest(directory):
+    paths = list_images(directory)
+    stats = [os.stat(path) for path in paths]
+    return {'directory': directory,
+            'mtimes': directory_mtimes(directory),
+            'paths': paths,
+            'ids': [image_id(path) for path in paths],
+            'sizes': [stat.st_size for stat in stats],
+            'image_mtimes': [stat.st_mtime for stat in stats],
+            'shapes': [image_shape(path) for path in paths]}
+
+
+def refresh_files(manifest):
+    """Stat every image of `manifest` and read the header again of those
+    whose size or modification time changed. Returns whether any did."""
+    changed = False
+    for i, path in enumerate(manifest['paths']):
+        stat = os.stat(path)
+        if stat.st_size != manifest['sizes'][i] or stat.st_mtime != manifest['image_mtimes'][i]:
+            manifest['sizes'][i] = stat.st_size
+            manifest['image_mtimes'][i] = stat.st_mtime
+            manifest['shapes'][i] = image_shape(path)
+            changed = True
+    return changed
+
+
+def save_manifest(manifest, cache_path):
+    if not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(cache_path + '.tmp', cache_path)
+
+
+def load_manifest(directory, check_files=False):
+    """Paths, ids, file sizes, modification times and (height, width) of the
+    images in `directory`, in the order predictions are made (see
+    tta.list_images). The manifest is cached in MANIFEST_DIR and only
+    built again when a file was added, removed or renamed, so loading it
+    does not touch the images. Unreadable images have a `None` shape.
+
+    Overwriting an image in place leaves the directory mtimes alone, so the
+    paths and ids are always current but the per-file fields may not be.
+    Pass `check_files` when using them: every image is then stat'ed and the
+    entries of the changed ones are refreshed."""
+    directory = os.path.normpath(directory)
+    cache_path = manifest_path(directory)
+    mtimes = directory_mtimes(directory)
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            manifest = json.load(f)
+        if manifest.get('mtimes') == mtimes:
+            if check_files and refresh_files(manifest):
+                print('Refreshed the manifest of {}'.format(directory))
+                save_manifest(manifest, cache_path)
+            return manifest
+    print('Building the manifest of {}'.format(directory))
+    manifest = build_manifest(directory)
+    save_manifest(manifest, cache_path)
+    return manifest
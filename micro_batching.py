@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+POLICIES = ['deadline', 'eager']
+
+
+class LatencyTracker(object):
+    """Latencies of the last `window` requests, with percentiles for a
+    metrics endpoint."""
+    def __init__(self, window=10000):
+        self._latencies = collections.deque(maxlen=window)
+        self._batch_sizes = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def add_batch(self, latencies):
+        with self._lock:
+            self._latencies.extend(latencies)
+            self._batch_sizes.append(len(latencies))
+            self.num_requests += len(latencies)
+            self.num_batches += 1
+
+    def summary(self, percentiles=(50, 90, 99)):
+        with self._lock:
+            latencies = np.array(self._latencies)
+            batch_sizes = np.array(self._batch_sizes)
+        summary = {'requests': self.num_requests,
+                   'batches': self.num_batches,
+                   'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.}
+        for p in percentiles:
+            value = np.percentile(latencies, p) if len(latencies) else 0.
+            summary['p{}_ms'.format(p)] = 1000 * float(value)
+        return summary
+
+
+class _Request(object):
+    def __init__(self, item):
+        self.item = item
+        self.start = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Groups concurrent `submit` calls into batches for `predict_batch`.
+
+    A single worker thread waits for the first pending request, then keeps
+    collecting requests until it has `max_batch_size` of them or
+    `max_latency` seconds have passed since the first one arrived, and calls
+    `predict_batch(items)` once for the whole batch. `predict_batch` returns
+    one result per item. Running every batch on the same thread also keeps
+    the model on one thread, as TensorFlow sessions prefer.
+    """
+    def __init__(self, predict_batch, max_batch_size=32, max_latency=0.01, tracker=None):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.tracker = tracker or LatencyTracker()
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, item):
+        """Block until the batch holding `item` was predicted and return its
+        result."""
+        request = _Request(item)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('MicroBatcher is closed')
+            self._pending.append(request)
+            self._cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            deadline = self._pending[0].start + self.max_latency
+            while len(self._pending) < self.max_batch_size and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._pending.popleft()
+                    for _ in range(min(self.max_batch_size, len(self._pending)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                results = self.predict_batch([request.item for request in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            end = time.time()
+            self.tracker.add_batch([end - request.start for request in batch])
+            for request in batch:
+                request.done.set()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+class AsyncMicroBatcher(object):
+    """asyncio version of MicroBatcher for callers that `await` one image
+    at a time.
+
+    Awaiting `predict(item)` queues the item; a batching task takes up to
+    `max_batch_size` queued items, runs `predict_batch(items)` once in a
+    single worker thread (so the event loop keeps accepting requests and the
+    model stays on one thread) and resolves every caller's future with its
+    own result. With the 'deadline' policy a batch is dispatched once it is
+    full or `max_latency` seconds after its first item arrived; with
+    'eager' it is dispatched as soon as the worker is free, holding whatever
+    queued up during the previous prediction.
+
+    Create it from a running event loop, e.g. in an `async def main()`.
+    """
+    def __init__(self, predict_batch, max_batch_size=32, max_latency=0.01,
+                 policy='deadline', tracker=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy {}, expected one of {}'.format(policy, POLICIES))
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.policy = policy
+        self.tracker = tracker or LatencyTracker()
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def predict(self, item):
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((item, time.time(), future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        if self.policy == 'deadline':
+            deadline = batch[0][1] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            items = [item for item, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.predict_batch, items)
+                for (_, _, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            end = time.time()
+            self.tracker.add_batch([end - start for _, start, _ in batch])
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
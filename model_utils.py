@@ -113,3 +113,11 @@ def build_xception():
             layer.trainable = False
 
     return model
+
+
+def build_model(model_name):
+    builders = {'densenet_201': build_densenet_201,
+                'inception_v3': build_inception_v3,
+                'inception_resnet_v2': build_inception_resnet_v2,
+                'xception': build_xception}
+    return builders[model_name]()
@@ -1,13 +1,20 @@
 import argparse
 import numpy as np
-import pandas as pd
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
 from keras.backend import tensorflow_backend as K
 from keras.layers import Dense, GlobalMaxPooling2D
 from keras.models import load_model
-from keras.preprocessing.image import ImageDataGenerator
+
+from autotune import DEFAULT_CACHE, tuned_batch_size
+from calibration import apply_temperature, fit_temperature, load_holdout, load_temperature, \
+    negative_log_likelihood, save_temperature
+from data import get_image_paths_and_labels
+from manifest import load_manifest
+from prediction_accumulator import PredictionAccumulator
+from submission import save_submission, save_top_k
+from tta import TTA_VIEWS, TTADataset
 
 parser = argparse.ArgumentParser(
     description='Training')
@@ -50,6 +57,64 @@ parser.add_argument(
     default=12,
     type=int,
     help='1: predict using original images, 12: 12-crop prediction')
+parser.add_argument(
+    '--tta-mode',
+    default='folders',
+    choices=['folders', 'memory'],
+    type=str,
+    help='folders: read the pre-cropped view folders, memory: build the views from each decoded test image')
+parser.add_argument(
+    '--dump-views',
+    action='store_true',
+    help='also keep the per-view predictions in a float16 memmap next to the submission')
+parser.add_argument(
+    '--checkpoint-images',
+    default=1024,
+    type=int,
+    metavar='N',
+    help='memory mode: checkpoint the predictions every N test images')
+parser.add_argument(
+    '--autotune',
+    action='store_true',
+    help='use the fastest batch size under --memory-limit, tuned once per model and host')
+parser.add_argument(
+    '--memory-limit',
+    default=0.8,
+    type=float,
+    help='peak RSS ceiling for --autotune as a fraction of the physical memory')
+parser.add_argument(
+    '--autotune-cache',
+    default=DEFAULT_CACHE,
+    type=str,
+    metavar='PATH',
+    help='JSON file of tuned batch sizes')
+parser.add_argument(
+    '--top-k',
+    default=0,
+    type=int,
+    metavar='K',
+    help='also save the K best labels and scores of every image (int16/float16 .npz)')
+parser.add_argument(
+    '--calibrate',
+    action='store_true',
+    help='temperature-scale the probabilities, fitted once per checkpoint on the '
+         'holdout train.py saved for the model (or --valid-dir)')
+parser.add_argument(
+    '--predict-on',
+    default='test',
+    choices=['test', 'holdout', 'valid-dir'],
+    type=str,
+    help='test: the test images and a submission; holdout / valid-dir: the holdout '
+         'train.py saved for the model / --valid-dir, with the labels saved next to '
+         'the predictions for blend_weights.py')
+parser.add_argument(
+    '--valid-dir',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='labelled images the temperature is fitted on (and --predict-on valid-dir '
+         'predicts) instead of the holdout; they '
+         'must not have been trained on, data/validation is part of train.py\'s training set')
 
 
 if __name__ == '__main__':
@@ -60,74 +125,154 @@ if __name__ == '__main__':
     submit_dir = args.submit_dir
     submit_filename = args.submit_fname
 
-    test_folders = sorted(os.listdir(test_data_dir))
+    if args.predict_on == 'test':
+        test_folders = sorted(folder for folder in os.listdir(test_data_dir)
+                              if os.path.isdir(os.path.join(test_data_dir, folder)))
 
-    if args.num_crops == 1:
-        test_dirs = ['data/test/test12703']  
-    elif args.num_crops == 12:
-        test_dirs = [os.path.join(test_data_dir, test_folder) for test_folder in test_folders]
+        if args.num_crops == 1:
+            test_dirs = ['data/test/test12703']  
+        elif args.num_crops == 12:
+            test_dirs = [os.path.join(test_data_dir, test_folder) for test_folder in test_folders]
 
     model_path = 'checkpoint/{}/iter{}.hdf5'.format(args.model_name, args.iter)
+    if args.calibrate:
+        if args.valid_dir is not None:
+            calibration_set = get_image_paths_and_labels(args.valid_dir)
+        else:
+            calibration_set = load_holdout(args.model_name)
+            if calibration_set is None:
+                parser.error('no holdout saved for {}, pass --valid-dir with images the '
+                             'model was not trained on'.format(args.model_name))
 
-    test_datagen = ImageDataGenerator(
-        rescale=1. / 255)
+    tta_mode = args.tta_mode
+    labels = None
+    if args.predict_on != 'test':
+        # only the test images have view folders, crop the views in memory
+        tta_mode = 'memory'
+        views = TTA_VIEWS if args.num_crops == 12 else ['original']
+        if args.predict_on == 'holdout':
+            labelled = load_holdout(args.model_name)
+            if labelled is None:
+                parser.error('no holdout saved for {}'.format(args.model_name))
+        elif args.valid_dir is None:
+            parser.error('--predict-on valid-dir needs --valid-dir')
+        else:
+            labelled = get_image_paths_and_labels(args.valid_dir)
+        filenames, labels = list(labelled[0]), labelled[1]
+    elif tta_mode == 'memory':
+        views = TTA_VIEWS if args.num_crops == 12 else ['original']
+        manifest = load_manifest(os.path.join(test_data_dir, 'test12703'))
+        filenames, ids = manifest['paths'], manifest['ids']
+    else:
+        views = [os.path.basename(test_dir) for test_dir in test_dirs]
+        manifests = [load_manifest(test_dir) for test_dir in test_dirs]
+        filenames, ids = manifests[0]['paths'], manifests[0]['ids']
+        for test_dir, manifest in zip(test_dirs, manifests):
+            if manifest['ids'] != manifests[0]['ids']:
+                raise ValueError('{} and {} hold different images'.format(test_dirs[0], test_dir))
 
-    test_pred = np.zeros((12703, 128))
-    pred_times = 0
     model = load_model(model_path)
-    for test_dir in test_dirs:
-        print('Data {}'.format(test_dir.split('/')[-1]))
-        test_generator = test_datagen.flow_from_directory(
-            test_dir,
-            batch_size=args.batch_size,
-            target_size=(299, 299),
-            class_mode='categorical',
-            shuffle=False)
+    batch_size = args.batch_size
+    if args.autotune:
+        batch_size = tuned_batch_size(
+            args.model_name, (299, 299), mode='predict', model=model,
+            cache_path=args.autotune_cache, memory_limit=args.memory_limit)
+    accumulator = PredictionAccumulator(
+        os.path.join(submit_dir, submit_filename),
+        num_samples=len(filenames),
+        num_classes=model.output_shape[-1],
+        views=views,
+        # a retrained checkpoint at the same path must not resume the old run
+        source='{} mtime {} size {} {} {}'.format(
+            model_path, os.path.getmtime(model_path), os.path.getsize(model_path),
+            tta_mode, args.predict_on),
+        dump_views=args.dump_views)
+    if tta_mode == 'memory':
+        # decode every test image once and predict all of its views together,
+        # a chunk of images at a time so an interrupted run can resume
+        for start in range(accumulator.images_done, len(filenames), args.checkpoint_images):
+            chunk = filenames[start:start + args.checkpoint_images]
+            print('Images {}-{}'.format(start, start + len(chunk)))
+            test_generator = TTADataset(
+                chunk,
+                images_per_batch=max(1, batch_size // len(views)),
+                views=views,
+                target_size=(299, 299))
+            pred = model.predict_generator(
+                generator=test_generator, workers=num_workers, verbose=1)
+            accumulator.add_images(start, pred.reshape(len(chunk), len(views), -1))
+    else:
+        for view, manifest in zip(views, manifests):
+            if view not in accumulator.pending_views():
+                continue
+            print('Data {}'.format(view))
+            # the folder already holds the view, load it like
+            # flow_from_directory with rescale=1/255 would
+            test_generator = TTADataset(
+                manifest['paths'],
+                images_per_batch=batch_size,
+                views=['original'],
+                target_size=(299, 299))
 
-        pred = model.predict_generator(
-            generator=test_generator, workers=num_workers, verbose=1)
-        test_pred += pred
-        pred_times += 1
-        del test_generator
+            pred = model.predict_generator(
+                generator=test_generator, workers=num_workers, verbose=1)
+            accumulator.add_view(view, pred)
+            del test_generator
+
+    if args.calibrate:
+        # fit on the views the folders hold, built from the calibration images
+        calibration_views = TTA_VIEWS if args.num_crops == 12 else ['original']
+        temperature = load_temperature(model_path, calibration_views)
+        if temperature is None:
+            valid_paths, valid_labels = calibration_set
+            print('Fitting the temperature on {} images'.format(len(valid_paths)))
+            valid_generator = TTADataset(
+                list(valid_paths),
+                images_per_batch=max(1, batch_size // len(calibration_views)),
+                views=calibration_views,
+                target_size=(299, 299))
+            valid_pred = model.predict_generator(
+                generator=valid_generator, workers=num_workers, verbose=1)
+            valid_pred = valid_pred.reshape(len(valid_paths), len(calibration_views), -1).mean(axis=1)
+            temperature = fit_temperature(valid_pred, valid_labels)
+            nll_before = negative_log_likelihood(valid_pred, valid_labels)
+            nll_after = negative_log_likelihood(apply_temperature(valid_pred, temperature), valid_labels)
+            print('Validation log-loss {:.4f} -> {:.4f}'.format(nll_before, nll_after))
+            save_temperature(model_path, calibration_views, temperature,
+                             float(nll_before), float(nll_after))
+        print('Temperature {:.3f}'.format(temperature))
     K.clear_session()
 
-    test_pred /= pred_times
+    test_pred = accumulator.mean
     np.save(
         os.path.join(
             submit_dir,
             '{}.npy'.format(submit_filename)),
         test_pred)
-    test_pred = np.argmax(test_pred, axis=1)
-    test_pred = test_pred + 1.
-    # recreate test generator to extract image filenames
-    test_generator = test_datagen.flow_from_directory(
-        test_dir,
-        batch_size=64,
-        target_size=(299, 299),
-        class_mode='categorical',
-        shuffle=False)
-
-    my_submit = pd.concat([pd.Series(test_generator.filenames),
-                           pd.Series(test_pred)], axis=1)
-    my_submit.columns = ['id', 'predicted']
-    my_submit['id'] = my_submit['id'].map(lambda x: int(
-        x.split('/')[-1].split('.')[0]))
-    my_submit['predicted'].fillna(83, inplace=True)
-    my_submit['predicted'] = my_submit['predicted'].astype(int)
-    my_submit['predicted'] = my_submit['predicted']
-
-    sample_submit = pd.read_csv('submission/sample_submission_randomlabel.csv')
-    missing_pictures_idx = list(set.difference(
-        set(sample_submit['id']), set(my_submit['id'])))
-    missing_pictures_pred = sample_submit.loc[sample_submit['id'].isin(
-        missing_pictures_idx)]
-    # substitute random labels with 83, least frequent class in train dataset
-    missing_pictures_pred['predicted'] = 83
-
-    final_submit = my_submit.append(missing_pictures_pred)
-    final_submit.sort_values('id', inplace=True)
-    final_submit.to_csv(
-        os.path.join(
-            submit_dir,
-            '{}.csv'.format(submit_filename)),
-        index=False)
+    if args.calibrate:
+        test_pred = apply_temperature(test_pred, temperature)
+        np.save(
+            os.path.join(
+                submit_dir,
+                '{}.calibrated.npy'.format(submit_filename)),
+            test_pred.astype(np.float16))
+    if labels is not None:
+        # rows follow the labels, blend_weights.py reads them from here
+        np.save(
+            os.path.join(
+                submit_dir,
+                '{}.labels.npy'.format(submit_filename)),
+            np.asarray(labels, dtype=np.int64))
+    else:
+        if args.top_k:
+            save_top_k(
+                os.path.join(
+                    submit_dir,
+                    '{}.topk.npz'.format(submit_filename)),
+                ids, test_pred, args.top_k)
+        # missing images get 83, least frequent class in train dataset
+        save_submission(
+            os.path.join(
+                submit_dir,
+                '{}.csv'.format(submit_filename)),
+            ids, test_pred, fallback=83)
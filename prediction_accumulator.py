@@ -0,0 +1,102 @@
+import json
+import os
+import numpy as np
+
+
+class PredictionAccumulator(object):
+    """Running mean of test-time augmentation predictions that survives a
+    crashed run.
+
+    Predictions come in either one whole view at a time (`add_view`, the
+    folder based TTA) or as all views of a range of images (`add_images`,
+    the in-memory TTA). The float32 mean is kept in `{prefix}.mean.npy` and
+    the finished views / images in `{prefix}.progress.json`, both rewritten
+    after every update, so a new accumulator with the same `prefix`,
+    `source` and shape picks up where the previous run stopped. With
+    `dump_views` the per-view predictions are also stored in the float16
+    memmap `{prefix}.views.npy` of shape (views, samples, classes).
+    """
+    def __init__(self, prefix, num_samples, num_classes, views, source='', dump_views=False):
+        self.prefix = prefix
+        self.num_samples = num_samples
+        self.num_classes = num_classes
+        self.views = list(views)
+        self.source = source
+        self.dump_views = dump_views
+        self.progress_path = '{}.progress.json'.format(prefix)
+        self.mean_path = '{}.mean.npy'.format(prefix)
+        self.views_path = '{}.views.npy'.format(prefix)
+
+        self.finished_views = []
+        self.images_done = 0
+        self.mean = np.zeros((num_samples, num_classes), dtype=np.float32)
+        if os.path.exists(self.progress_path) and os.path.exists(self.mean_path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            if self._describe() == progress['run']:
+                self.finished_views = progress['finished_views']
+                self.images_done = progress['images_done']
+                self.mean = np.load(self.mean_path)
+                print('Resuming predictions: {} views, {} images already done'.format(
+                    len(self.finished_views), self.images_done))
+            else:
+                print('{} belongs to another run, starting over'.format(self.progress_path))
+
+        self.view_predictions = None
+        if dump_views:
+            mode = 'r+' if os.path.exists(self.views_path) and self.is_started() else 'w+'
+            self.view_predictions = np.lib.format.open_memmap(
+                self.views_path, mode=mode, dtype=np.float16,
+                shape=(len(self.views), num_samples, num_classes))
+
+    def _describe(self):
+        return {'source': self.source,
+                'num_samples': self.num_samples,
+                'num_classes': self.num_classes,
+                'views': self.views,
+                'dump_views': self.dump_views}
+
+    def is_started(self):
+        return bool(self.finished_views) or self.images_done > 0
+
+    def pending_views(self):
+        return [view for view in self.views if view not in self.finished_views]
+
+    def add_view(self, view, predictions):
+        """Fold the (num_samples, num_classes) predictions of one view into
+        the running mean."""
+        predictions = np.asarray(predictions, dtype=np.float32)
+        self.mean += (predictions - self.mean) / (len(self.finished_views) + 1)
+        if self.view_predictions is not None:
+            self.view_predictions[self.views.index(view)] = predictions
+            self.view_predictions.flush()
+        self.finished_views.append(view)
+        self._checkpoint()
+
+    def add_images(self, start, predictions):
+        """Store the mean over views of the (n, num_views, num_classes)
+        predictions of images `start` to `start + n`."""
+        predictions = np.asarray(predictions, dtype=np.float32)
+        end = start + len(predictions)
+        self.mean[start:end] = predictions.mean(axis=1)
+        if self.view_predictions is not None:
+            self.view_predictions[:, start:end] = predictions.transpose(1, 0, 2)
+            self.view_predictions.flush()
+        self.images_done = end
+        if end == self.num_samples:
+            self.finished_views = list(self.views)
+        self._checkpoint()
+
+    def is_done(self):
+        return not self.pending_views()
+
+    def _checkpoint(self):
+        # write to temporary files first so a crash mid-write keeps the
+        # previous checkpoint intact
+        np.save(self.mean_path + '.tmp.npy', self.mean)
+        os.rename(self.mean_path + '.tmp.npy', self.mean_path)
+        with open(self.progress_path + '.tmp', 'w') as f:
+            json.dump({'run': self._describe(),
+                       'finished_views': self.finished_views,
+                       'images_done': self.images_done}, f)
+        os.rename(self.progress_path + '.tmp', self.progress_path)
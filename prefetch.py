@@ -0,0 +1,192 @@
+import multiprocessing
+import time
+import traceback
+import numpy as np
+
+from shared_batch_ring import SharedBatchRing, batch_nbytes
+
+
+def flatten_batch(batch):
+    """Split an `(inputs, targets)` batch into a flat list of arrays and the
+    number of model inputs (None for a single input array)."""
+    inputs, targets = batch
+    if isinstance(inputs, (list, tuple)):
+        return [np.asarray(x) for x in inputs] + [np.asarray(targets)], len(inputs)
+    return [np.asarray(inputs), np.asarray(targets)], None
+
+
+def unflatten_batch(arrays, num_inputs):
+    if num_inputs is None:
+        return arrays[0], arrays[1]
+    return list(arrays[:num_inputs]), arrays[num_inputs]
+
+
+def _worker(sequence, ring, task_queue, done_queue, seed):
+    epoch = 0
+    while True:
+        start = time.time()
+        task = task_queue.get()
+        idle = time.time() - start
+        if task is None:
+            break
+        slot, task_epoch, idx = task
+        try:
+            # Replay the epoch ends this worker has not seen with per-epoch
+            # seeds so every worker shuffles its copy of the Sequence the same
+            # way, whichever batches it was handed.
+            while epoch < task_epoch:
+                epoch += 1
+                np.random.seed((seed + epoch) % 2 ** 32)
+                sequence.on_epoch_end()
+            arrays, num_inputs = flatten_batch(sequence[idx])
+            layout = ring.write(slot, arrays)
+            done_queue.put((slot, task_epoch, idx, layout, num_inputs, idle))
+        except Exception:
+            done_queue.put((slot, task_epoch, idx, None, traceback.format_exc(), idle))
+    ring.detach()
+
+
+class PrefetchLoader(object):
+    """Produces the batches of a data.py Sequence in a pool of worker
+    processes, ahead of the training loop.
+
+    Workers write each batch into one of `queue_size` shared memory slots and
+    only send back its layout, so arrays are never pickled. A batch is
+    requested only when a slot is free, which bounds the lookahead and makes
+    producers wait for a slow consumer. Batches are yielded in Sequence order
+    and the loader loops over epochs forever, as `fit_generator` expects; use
+    `len(loader)` as `steps_per_epoch`.
+
+    With `copy=False` the yielded arrays are views into the shared slot and
+    the slot is only handed back to the workers when the next batch is
+    requested, so nothing is copied on the consumer side. That suits
+    `fit_generator(workers=0)`, which is done with a batch before asking for
+    the next one.
+
+    The workers are forked from the process creating the loader, so the
+    Sequence is not pickled either. Each worker calls `on_epoch_end` on its
+    own copy of the Sequence with the same per-epoch seed.
+    """
+    def __init__(self, sequence, num_workers=4, queue_size=8, seed=None, verbose=False,
+                 copy=True):
+        self.sequence = sequence
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.verbose = verbose
+        self.copy = copy
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - 1)
+
+        # size the slots after one batch, the last batch can only be smaller
+        arrays, _ = flatten_batch(sequence[0])
+        self.slot_nbytes = batch_nbytes(arrays)
+        # one extra slot for the batch held by the consumer without copy
+        self.ring = SharedBatchRing(queue_size + (0 if copy else 1), self.slot_nbytes)
+
+        ctx = multiprocessing.get_context('fork')
+        self._task_queue = ctx.Queue()
+        self._done_queue = ctx.Queue()
+        self._workers = [ctx.Process(target=_worker,
+                                     args=(sequence, self.ring, self._task_queue,
+                                           self._done_queue, seed))
+                         for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+        self._held_slot = None
+        self.bytes_copied = 0
+        self._ready = {}
+        self._epoch, self._idx = 0, 0
+        self._submit_epoch, self._submit_idx = 0, 0
+        self._reset_stats()
+        self._fill()
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __iter__(self):
+        return self
+
+    def _reset_stats(self):
+        self._num_batches = 0
+        self._queue_depth = 0
+        self._producer_stall = 0.
+        self._consumer_wait = 0.
+        self._bytes_copied = 0
+
+    def stats(self):
+        """Averages since the start of the current epoch: batches ready when
+        the consumer asked for one, seconds workers spent waiting for a free
+        slot per worker and seconds the consumer spent waiting per batch.
+        `bytes_copied` is the epoch total of batch bytes copied into and out
+        of the shared slots."""
+        num_batches = max(self._num_batches, 1)
+        return {'queue_depth': self._queue_depth / float(num_batches),
+                'producer_stall': self._producer_stall / float(self.num_workers),
+                'consumer_wait': self._consumer_wait / float(num_batches),
+                'bytes_copied': self._bytes_copied}
+
+    def _fill(self):
+        while self.ring.num_free():
+            self._task_queue.put((self.ring.acquire(), self._submit_epoch, self._submit_idx))
+            self._submit_idx += 1
+            if self._submit_idx == len(self.sequence):
+                self._submit_epoch += 1
+                self._submit_idx = 0
+
+    def _wait_for(self, key):
+        start = time.time()
+        self._queue_depth += len(self._ready)
+        while key not in self._ready:
+            slot, epoch, idx, layout, info, idle = self._done_queue.get()
+            self._producer_stall += idle
+            if layout is None:
+                self.close()
+                raise RuntimeError('Loader worker failed on batch {}:\n{}'.format(idx, info))
+            self._ready[(epoch, idx)] = (slot, layout, info)
+        self._consumer_wait += time.time() - start
+        return self._ready.pop(key)
+
+    def __next__(self):
+        if self._held_slot is not None:
+            self.ring.release(self._held_slot)
+            self._held_slot = None
+        slot, layout, num_inputs = self._wait_for((self._epoch, self._idx))
+        arrays = self.ring.read(slot, layout, copy=self.copy)
+        nbytes = sum(array.nbytes for array in arrays)
+        # the worker's write into the slot, plus the copy out of it
+        nbytes = 2 * nbytes if self.copy else nbytes
+        self._bytes_copied += nbytes
+        self.bytes_copied += nbytes
+        if self.copy:
+            self.ring.release(slot)
+        else:
+            self._held_slot = slot
+        self._fill()
+
+        self._num_batches += 1
+        self._idx += 1
+        if self._idx == len(self.sequence):
+            if self.verbose:
+                stats = self.stats()
+                print('\nLoader epoch {}: queue depth {:.1f}, producer stall {:.1f}s, '
+                      'consumer wait {:.1f}ms/batch, {:.2f} GB copied'.format(
+                          self._epoch + 1, stats['queue_depth'], stats['producer_stall'],
+                          1000 * stats['consumer_wait'], stats['bytes_copied'] / 1024 ** 3))
+            self._epoch += 1
+            self._idx = 0
+            self._reset_stats()
+        return unflatten_batch(arrays, num_inputs)
+
+    next = __next__
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        self.ring.close()
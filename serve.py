@@ -0,0 +1,253 @@
+import argparse
+import json
+import numpy as np
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+from io import BytesIO
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+
+import tensorflow as tf
+from keras.models import load_model
+
+from calibration import apply_temperature, load_temperature
+from custom_losses import sparse_categorical_hinge
+from micro_batching import MicroBatcher
+from sift_bow import SiftBowEncoder
+from submission import top_k
+from tta import TTA_VIEWS, make_view, open_rgb
+
+parser = argparse.ArgumentParser(
+    description='Inference server')
+parser.add_argument(
+    '--models',
+    nargs='+',
+    type=str,
+    help='checkpoints to serve as model_name:iter, e.g. xception:2, or '
+         'model_name:checkpoint, e.g. xception:sift_iter1')
+parser.add_argument(
+    '--host',
+    default='127.0.0.1',
+    type=str)
+parser.add_argument(
+    '--port',
+    default=8000,
+    type=int)
+parser.add_argument(
+    '--num-crops',
+    default=1,
+    type=int,
+    help='1: predict the original image, 12: average the 12 TTA views')
+parser.add_argument(
+    '--max-batch-size',
+    default=32,
+    type=int,
+    metavar='N',
+    help='maximum number of images predicted together')
+parser.add_argument(
+    '--max-latency-ms',
+    default=10.,
+    type=float,
+    help='longest a request waits for others to share its batch')
+parser.add_argument(
+    '--calibrate',
+    action='store_true',
+    help='apply the temperature predict_tta.py --calibrate cached for the checkpoint')
+parser.add_argument(
+    '--sift-store',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='store built by sift_extractor.py, used by the models trained with SIFT features')
+
+
+def decode_views(image_bytes, views, target_size=(299, 299)):
+    """(num_views, height, width, 3) float32 batch of the TTA `views` of an
+    encoded image, rescaled by 1/255 like predict_tta.py."""
+    image = open_rgb(BytesIO(image_bytes))
+    batch = np.empty((len(views), target_size[1], target_size[0], 3), dtype=np.float32)
+    for i, view in enumerate(views):
+        batch[i] = np.asarray(make_view(image, view, target_size))
+    batch *= 1. / 255
+    return batch
+
+
+class ServedModel(object):
+    """A loaded checkpoint behind a MicroBatcher. Requests are decoded into
+    their views on the calling thread; the batcher's thread stacks the views
+    of every image in the batch, predicts them in one call and averages
+    each image's views.
+
+    Models with two inputs (train_with_sift_features.py) get the SIFT
+    features of every view as their second input, computed on the calling
+    thread with `sift_encoder`. Single-input models ignore the encoder.
+    """
+    def __init__(self, model_path, views, max_batch_size=32, max_latency=0.01,
+                 temperature=None, sift_encoder=None):
+        self.model_path = model_path
+        self.views = views
+        self.temperature = temperature
+        # train_with_sift_features.py --sparse-labels compiles with a custom loss
+        self.model = load_model(
+            model_path, custom_objects={'sparse_categorical_hinge': sparse_categorical_hinge})
+        self.sift_encoder = None
+        if len(self.model.inputs) == 2:
+            if sift_encoder is None:
+                raise ValueError('{} takes SIFT features, serve it with --sift-store'.format(
+                    model_path))
+            self.sift_encoder = sift_encoder
+        # build the predict function now, it is called from the batcher's
+        # thread which does not see this thread's default graph
+        self.model._make_predict_function()
+        self.num_classes = int(self.model.output_shape[-1])
+        self.graph = tf.get_default_graph()
+        self.batcher = MicroBatcher(self._predict_batch, max_batch_size, max_latency)
+
+    def _predict_batch(self, batches):
+        if self.sift_encoder is not None:
+            x = [np.concatenate([views for views, _ in batches]),
+                 np.concatenate([sift for _, sift in batches])]
+        else:
+            x = np.concatenate(batches)
+        with self.graph.as_default():
+            pred = self.model.predict(x, batch_size=len(batches) * len(self.views))
+        pred = pred.reshape(len(batches), len(self.views), -1).mean(axis=1)
+        if self.temperature is not None:
+            pred = apply_temperature(pred, self.temperature)
+        return list(pred)
+
+    def predict(self, image_bytes):
+        views = decode_views(image_bytes, self.views)
+        if self.sift_encoder is not None:
+            images = np.round(views * 255).astype(np.uint8)
+            return self.batcher.submit((views, self.sift_encoder.encode(images, rgb=True)))
+        return self.batcher.submit(views)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(models):
+    class Handler(BaseHTTPRequestHandler):
+        """POST /predict/<model_name:iter>?top_k=5 with the image bytes as
+        body returns the class probabilities (and the top k 1-based labels);
+        the bare model name works when only one of its checkpoints is
+        served. GET /metrics returns the latency percentiles of every
+        model."""
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                self._send_json(200, {name: model.batcher.tracker.summary()
+                                      for name, model in models.items()})
+            elif path == '/models':
+                self._send_json(200, {name: {'checkpoint': model.model_path,
+                                             'views': model.views,
+                                             'temperature': model.temperature}
+                                      for name, model in models.items()})
+            else:
+                self._send_json(404, {'error': 'unknown path {}'.format(path)})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if parts[0] != 'predict' or len(parts) > 2:
+                self._send_json(404, {'error': 'unknown path {}'.format(url.path)})
+                return
+            if len(parts) == 2:
+                name = unquote(parts[1])
+                matches = [spec for spec in models if spec.split(':')[0] == name]
+                if name not in models and len(matches) == 1:
+                    name = matches[0]
+                elif name not in models and matches:
+                    self._send_json(400, {'error': 'choose one of {}'.format(sorted(matches))})
+                    return
+            elif len(models) == 1:
+                name = list(models)[0]
+            else:
+                self._send_json(400, {'error': 'choose one of {}'.format(sorted(models))})
+                return
+            if name not in models:
+                self._send_json(404, {'error': 'unknown model {}'.format(name)})
+                return
+            image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                k = int(parse_qs(url.query).get('top_k', [0])[0])
+            except ValueError:
+                self._send_json(400, {'error': 'top_k must be an integer'})
+                return
+            if not 0 <= k <= models[name].num_classes:
+                self._send_json(400, {'error': 'top_k must be between 0 and {}'.format(
+                    models[name].num_classes)})
+                return
+            try:
+                probs = models[name].predict(image_bytes)
+            except IOError:
+                self._send_json(400, {'error': 'cannot decode the image'})
+                return
+            except Exception as e:
+                self._send_json(500, {'error': 'prediction failed: {}'.format(e)})
+                return
+            body = {'model': name, 'probabilities': probs.tolist()}
+            if k:
+                labels, scores = top_k(probs[None], k)
+                body['top_k'] = {'labels': labels[0].tolist(), 'scores': scores[0].tolist()}
+            self._send_json(200, body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    views = TTA_VIEWS if args.num_crops == 12 else ['original']
+    sift_encoder = None
+    if args.sift_store is not None:
+        # decode_views builds 299x299 views
+        sift_encoder = SiftBowEncoder.open(args.sift_store, (299, 299))
+    duplicates = sorted(set(spec for spec in args.models if args.models.count(spec) > 1))
+    if duplicates:
+        parser.error('{} given more than once'.format(', '.join(duplicates)))
+    # keyed by the whole spec, several checkpoints of one model can be served
+    models = {}
+    for spec in args.models:
+        model_name, iteration = spec.split(':')
+        if iteration.isdigit():
+            model_path = 'checkpoint/{}/iter{}.hdf5'.format(model_name, iteration)
+        else:
+            model_path = 'checkpoint/{}/{}.hdf5'.format(model_name, iteration)
+        temperature = load_temperature(model_path, views) if args.calibrate else None
+        if args.calibrate and temperature is None:
+            print('No temperature cached for {}, run predict_tta.py --calibrate first'.format(
+                model_path))
+        print('Loading {}{}'.format(
+            model_path, '' if temperature is None else ', temperature {:.3f}'.format(temperature)))
+        try:
+            models[spec] = ServedModel(
+                model_path, views, args.max_batch_size, args.max_latency_ms / 1000.,
+                temperature, sift_encoder)
+        except ValueError as e:
+            parser.error(str(e))
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(models))
+    print('Serving {} on http://{}:{}'.format(', '.join(sorted(models)), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    for model in models.values():
+        model.batcher.close()
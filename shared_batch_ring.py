@@ -0,0 +1,107 @@
+import multiprocessing
+from collections import deque
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+def _aligned(nbytes, alignment=64):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+def batch_nbytes(arrays):
+    """Slot size needed to hold `arrays` with the ring's alignment."""
+    return sum(_aligned(np.asarray(array).nbytes) for array in arrays)
+
+
+class SharedBatchRing(object):
+    """Fixed number of shared memory slots, each holding the arrays of one
+    batch (images, SIFT features, labels, ...).
+
+    Producers fill a slot with `write` and pass the returned layout (offsets,
+    shapes, dtypes) to the consumer together with the slot index. The
+    consumer maps the arrays with `read` and hands the slot back with
+    `release` once it is done with them; until then no producer is given
+    that slot again.
+
+    Blocks come from `multiprocessing.shared_memory` when available and from
+    `RawArray` otherwise. Either way the ring has to be created before the
+    producer processes are forked.
+    """
+    def __init__(self, num_slots, slot_nbytes):
+        self.num_slots = num_slots
+        self.slot_nbytes = slot_nbytes
+        if shared_memory is not None:
+            self._blocks = [shared_memory.SharedMemory(create=True, size=slot_nbytes)
+                            for _ in range(num_slots)]
+            self._buffers = [np.frombuffer(block.buf, dtype=np.uint8, count=slot_nbytes)
+                             for block in self._blocks]
+        else:
+            self._blocks = []
+            self._buffers = [np.frombuffer(multiprocessing.RawArray('B', slot_nbytes),
+                                           dtype=np.uint8)
+                             for _ in range(num_slots)]
+        self._free = deque(range(num_slots))
+
+    def num_free(self):
+        return len(self._free)
+
+    def acquire(self):
+        """Return a free slot index, or None when every slot is in use."""
+        if not self._free:
+            return None
+        return self._free.popleft()
+
+    def release(self, slot):
+        self._free.append(slot)
+
+    def write(self, slot, arrays):
+        buf = self._buffers[slot]
+        layout = []
+        offset = 0
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            end = offset + array.nbytes
+            if end > self.slot_nbytes:
+                raise ValueError('Batch does not fit into a {} byte slot'.format(
+                    self.slot_nbytes))
+            buf[offset:end] = array.reshape(-1).view(np.uint8)
+            layout.append((offset, array.shape, array.dtype.str))
+            offset = _aligned(end)
+        return layout
+
+    def read(self, slot, layout, copy=False):
+        """Map the arrays described by `layout`. Without `copy` they are
+        views into the slot and only valid until it is released."""
+        buf = self._buffers[slot]
+        arrays = []
+        for offset, shape, dtype in layout:
+            dtype = np.dtype(dtype)
+            array = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)),
+                                  offset=offset).reshape(shape)
+            arrays.append(array.copy() if copy else array)
+        return arrays
+
+    def detach(self):
+        """Drop this process' mappings without freeing the blocks, for
+        producers that are shutting down."""
+        self._buffers = []
+        for block in self._blocks:
+            block.close()
+        self._blocks = []
+
+    def close(self):
+        """Free the blocks. Arrays read without copy should be dropped first,
+        otherwise their blocks stay mapped until the ring is collected."""
+        self._buffers = []
+        lingering = []
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                lingering.append(block)
+            block.unlink()
+        self._blocks = lingering
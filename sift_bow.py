@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import cv2
+import numpy as np
+
+
+def create_sift():
+    # SIFT moved out of xfeatures2d (opencv-contrib) in OpenCV 4.4
+    if hasattr(cv2, 'SIFT_create'):
+        return cv2.SIFT_create()
+    return cv2.xfeatures2d.SIFT_create()
+
+
+def image_descriptors(image, max_side=None, sift=None):
+    """(n, 128) float32 SIFT descriptors of a grayscale uint8 image,
+    downscaled first so its longer side is at most `max_side`."""
+    if max_side is not None:
+        scale = float(max_side) / max(image.shape)
+        if scale < 1:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, descriptors = (sift or create_sift()).detectAndCompute(image, None)
+    if descriptors is None:
+        return np.empty((0, 128), dtype=np.float32)
+    return descriptors
+
+
+def assign_words(descriptors, codebook, codebook_sq_norms=None):
+    """Index of the nearest codebook word of every descriptor, from
+    ||d||^2 - 2 d.c + ||c||^2 computed with one matrix product; ||d||^2 is
+    the same for every word and is left out."""
+    if codebook_sq_norms is None:
+        codebook_sq_norms = np.square(codebook).sum(axis=1)
+    return (codebook_sq_norms - 2 * np.dot(descriptors, codebook.T)).argmin(axis=1)
+
+
+def bow_histograms(descriptors, codebook, codebook_sq_norms=None):
+    """(len(descriptors), num_words) L1-normalised word histograms of a list
+    of per-image descriptor arrays. The descriptors of all images are
+    assigned together and counted with a single bincount; images without
+    descriptors get all zeros."""
+    counts = np.array([len(d) for d in descriptors], dtype=np.int64)
+    histograms = np.zeros((len(descriptors), len(codebook)), dtype=np.float32)
+    if counts.sum():
+        words = assign_words(np.concatenate([d for d in descriptors if len(d)]),
+                             codebook, codebook_sq_norms)
+        owners = np.repeat(np.arange(len(descriptors)), counts)
+        histograms += np.bincount(owners * len(codebook) + words,
+                                  minlength=histograms.size).reshape(histograms.shape)
+        histograms /= np.maximum(counts, 1)[:, None]
+    return histograms
+
+
+def loader_scaler_path(store_dir, input_shape):
+    return os.path.join(store_dir, 'loader_scaler_{}x{}.npz'.format(
+        input_shape[0], input_shape[1]))
+
+
+class SiftBowEncoder(object):
+    """Bag-of-visual-words features of image batches with a fixed codebook.
+
+    Meant to be called from the loader workers on the (augmented) uint8
+    batches, so the SIFT input matches the image the model sees. Each thread
+    builds its own SIFT detector, and forked loader processes inherit the
+    codebook without pickling it again.
+
+    Features of resized batches are distributed differently from the stored
+    rows, which come from the original images. So `open` standardises
+    them with the loader_scaler_{w}x{h}.npz that sift_extractor.py fits on
+    images resized to the batch shape, not with the store's scaler.npz. The
+    scaler is fitted without augmentation, like the fixed image
+    normalisation.
+    """
+    def __init__(self, codebook, mean=None, scale=None, max_side=None):
+        self.codebook = np.asarray(codebook, dtype=np.float32)
+        self.codebook_sq_norms = np.square(self.codebook).sum(axis=1)
+        self.mean = mean
+        self.scale = scale
+        self.max_side = max_side
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @classmethod
+    def open(cls, store_dir, input_shape):
+        """Return the encoder of a store built by sift_extractor.py for
+        batches of `input_shape`, or None when `store_dir` has no codebook
+        (e.g. a store converted from the CSVs) or no scaler for that shape."""
+        meta_path = os.path.join(store_dir, 'meta.json')
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        if 'codebook' not in meta or not os.path.exists(meta['codebook']):
+            print('No SIFT codebook for the store in {}, run sift_extractor.py first'.format(
+                store_dir))
+            return None
+        scaler_path = loader_scaler_path(store_dir, input_shape)
+        if not os.path.exists(scaler_path):
+            print('No scaler for {}x{} batches in {}, run sift_extractor.py '
+                  '--input-shape {} {}'.format(input_shape[0], input_shape[1], store_dir,
+                                               input_shape[0], input_shape[1]))
+            return None
+        scaler = np.load(scaler_path)
+        return cls(np.load(meta['codebook']), scaler['mean'], scaler['scale'],
+                   meta.get('max_side'))
+
+    @property
+    def num_features(self):
+        return len(self.codebook)
+
+    def _sift(self):
+        sift = getattr(self._local, 'sift', None)
+        if sift is None:
+            sift = self._local.sift = create_sift()
+        return sift
+
+    def encode(self, images, rgb=False):
+        """(len(images), num_words) float32 features of uint8 BGR (or RGB)
+        images."""
+        code = cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY
+        sift = self._sift()
+        descriptors = [image_descriptors(cv2.cvtColor(np.ascontiguousarray(image), code),
+                                         self.max_side, sift)
+                       for image in images]
+        features = bow_histograms(descriptors, self.codebook, self.codebook_sq_norms)
+        if self.mean is not None:
+            features -= self.mean
+            features /= self.scale
+        return features
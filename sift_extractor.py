@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy as np
+from multiprocessing import Pool
+from sklearn.cluster import MiniBatchKMeans
+
+from data import get_image_paths_and_labels
+from sift_bow import bow_histograms, create_sift, image_descriptors, loader_scaler_path
+from sift_store import finish_store
+
+parser = argparse.ArgumentParser(
+    description='Extract SIFT bag-of-visual-words features into a SIFT store')
+parser.add_argument(
+    '--data-dirs',
+    nargs='+',
+    default=['data/train', 'data/validation'],
+    type=str,
+    metavar='PATH',
+    help='class folders to encode, in the order of the store rows')
+parser.add_argument(
+    '--store-dir',
+    default='data/sift_store',
+    type=str,
+    metavar='PATH',
+    help='where to write the store, the codebook and the shards')
+parser.add_argument(
+    '--num-words',
+    default=512,
+    type=int,
+    metavar='N',
+    help='codebook size, i.e. the feature dimension')
+parser.add_argument(
+    '--codebook-images',
+    default=5000,
+    type=int,
+    metavar='N',
+    help='images whose descriptors are sampled to fit the codebook')
+parser.add_argument(
+    '--descriptors-per-image',
+    default=100,
+    type=int,
+    metavar='N',
+    help='descriptors sampled from each of those images')
+parser.add_argument(
+    '--max-side',
+    default=320,
+    type=int,
+    metavar='N',
+    help='images are downscaled so their longer side is at most N pixels')
+parser.add_argument(
+    '--input-shape',
+    nargs='+',
+    default=[299, 299],
+    type=int,
+    help='batch geometry of the SIFT encoder in the loader and server, whose '
+         'scaler is fitted on images resized to it')
+parser.add_argument(
+    '--scaler-images',
+    default=2000,
+    type=int,
+    metavar='N',
+    help='images the scaler for --input-shape is fitted on')
+parser.add_argument(
+    '--shard-size',
+    default=2000,
+    type=int,
+    metavar='N',
+    help='images per shard, the unit of work and of restarts')
+parser.add_argument(
+    '--num-workers',
+    default=4,
+    type=int,
+    metavar='N',
+    help='number of processes')
+parser.add_argument(
+    '--seed',
+    default=0,
+    type=int)
+
+
+def sift_descriptors(img_path, max_side=320, sift=None):
+    """SIFT descriptors of the image at `img_path`, none when it cannot be
+    read. The image is decoded in color and converted like the batches
+    `SiftBowEncoder` sees, IMREAD_GRAYSCALE gives slightly different pixels."""
+    image = cv2.imread(img_path)
+    if image is None:
+        return np.empty((0, 128), dtype=np.float32)
+    return image_descriptors(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), max_side, sift)
+
+
+# set in every worker by _init_worker
+_worker = {}
+
+
+def _init_worker(codebook_path, max_side):
+    # one image per process, OpenCV's own threads would only compete
+    cv2.setNumThreads(0)
+    _worker['sift'] = create_sift()
+    _worker['max_side'] = max_side
+    if codebook_path is not None:
+        codebook = np.load(codebook_path)
+        _worker['codebook'] = codebook
+        _worker['codebook_sq_norms'] = np.square(codebook).sum(axis=1)
+
+
+def _sample_descriptors(task):
+    img_path, num_descriptors, seed = task
+    descriptors = sift_descriptors(img_path, _worker['max_side'], _worker['sift'])
+    if len(descriptors) > num_descriptors:
+        rng = np.random.RandomState(seed)
+        descriptors = descriptors[rng.choice(len(descriptors), num_descriptors, replace=False)]
+    return descriptors
+
+
+def _encode_shard(task):
+    shard_path, paths = task
+    start = time.time()
+    histograms = np.empty((len(paths), len(_worker['codebook'])), dtype=np.float32)
+    for i, img_path in enumerate(paths):
+        descriptors = sift_descriptors(img_path, _worker['max_side'], _worker['sift'])
+        histograms[i] = bow_histograms([descriptors], _worker['codebook'],
+                                       _worker['codebook_sq_norms'])[0]
+    # np.save appends .npy to names without it
+    tmp_path = shard_path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, histograms)
+    os.rename(tmp_path, shard_path)
+    return shard_path, len(paths), time.time() - start, os.getpid()
+
+
+def _encode_resized(task):
+    img_path, input_shape = task
+    image = cv2.imread(img_path)
+    if image is None:
+        descriptors = np.empty((0, 128), dtype=np.float32)
+    else:
+        # resized the way data.read_images builds the batches
+        image = cv2.resize(image, (input_shape[0], input_shape[1]),
+                           interpolation=cv2.INTER_LINEAR)
+        descriptors = image_descriptors(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),
+                                        _worker['max_side'], _worker['sift'])
+    return bow_histograms([descriptors], _worker['codebook'],
+                          _worker['codebook_sq_norms'])[0]
+
+
+def fit_loader_scaler(paths, codebook_path, scaler_path, input_shape, num_images=2000,
+                      max_side=320, num_workers=4, seed=0):
+    """Mean and standard deviation of the features of `num_images` random
+    images resized to `input_shape` without keeping the aspect ratio, as
+    `SiftBowEncoder` sees them in the loader. They differ from the store's
+    scaler.npz, which describes the original images."""
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(len(paths), min(num_images, len(paths)), replace=False))
+    pool = Pool(num_workers, initializer=_init_worker, initargs=(codebook_path, max_side))
+    try:
+        features = np.array(pool.map(_encode_resized,
+                                     [(paths[i], input_shape) for i in sample], chunksize=16))
+    finally:
+        pool.close()
+        pool.join()
+    # same definition as StandardScaler, see sift_store.finish_store
+    scale = features.std(axis=0)
+    scale[scale == 0] = 1
+    np.savez(scaler_path, mean=features.mean(axis=0).astype(np.float32),
+             scale=scale.astype(np.float32))
+
+
+def fit_codebook(paths, codebook_path, num_words=512, num_images=5000,
+                 descriptors_per_image=100, max_side=320, num_workers=4, seed=0):
+    """Fit a `num_words` codebook with mini-batch k-means on descriptors
+    sampled from `num_images` random images and save it to `codebook_path`."""
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(len(paths), min(num_images, len(paths)), replace=False))
+    tasks = [(paths[i], descriptors_per_image, seed + int(i)) for i in sample]
+    pool = Pool(num_workers, initializer=_init_worker, initargs=(None, max_side))
+    try:
+        descriptors = np.concatenate(pool.map(_sample_descriptors, tasks, chunksize=16))
+    finally:
+        pool.close()
+        pool.join()
+    print('Fitting {} words on {} descriptors from {} images'.format(
+        num_words, len(descriptors), len(sample)))
+    kmeans = MiniBatchKMeans(n_clusters=num_words, random_state=seed,
+                             batch_size=max(1024, 4 * num_words))
+    kmeans.fit(descriptors)
+    np.save(codebook_path, kmeans.cluster_centers_.astype(np.float32))
+
+
+def encode_shards(paths, shard_dir, codebook_path, shard_size=2000, max_side=320,
+                  num_workers=4):
+    """Encode the images in shards of `shard_size` into
+    `{shard_dir}/shard_{i}.npy`. Finished shards are skipped, so an
+    interrupted run picks up where it stopped. Prints the images per second
+    of every shard and of every worker."""
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shard_paths = [os.path.join(shard_dir, 'shard_{:05d}.npy'.format(i))
+                   for i in range(int(np.ceil(len(paths) / float(shard_size))))]
+    tasks = [(shard_path, paths[i * shard_size:(i + 1) * shard_size])
+             for i, shard_path in enumerate(shard_paths) if not os.path.exists(shard_path)]
+    print('{} of {} shards left to encode'.format(len(tasks), len(shard_paths)))
+    workers = {}
+    if tasks:
+        pool = Pool(num_workers, initializer=_init_worker, initargs=(codebook_path, max_side))
+        try:
+            for shard_path, num_images, seconds, pid in pool.imap_unordered(_encode_shard, tasks):
+                images, total_seconds = workers.get(pid, (0, 0.))
+                workers[pid] = (images + num_images, total_seconds + seconds)
+                print('{}: {} images in {:.1f}s ({:.1f} images/s, worker {})'.format(
+                    os.path.basename(shard_path), num_images, seconds,
+                    num_images / seconds, pid))
+        finally:
+            pool.close()
+            pool.join()
+    for pid, (images, seconds) in sorted(workers.items()):
+        print('Worker {}: {} images, {:.1f} images/s'.format(pid, images, images / seconds))
+    return shard_paths
+
+
+def assemble_store(shard_paths, paths, labels, store_dir, meta):
+    """Concatenate the shards into the float32 features of a SIFT store,
+    with the same index and scaler files `build_sift_store` writes."""
+    num_words = np.load(shard_paths[0], mmap_mode='r').shape[1]
+    tmp_path = os.path.join(store_dir, 'features.tmp.npy')
+    features = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float32, shape=(len(paths), num_words))
+    total = np.zeros(num_words)
+    total_sq = np.zeros(num_words)
+    row = 0
+    for shard_path in shard_paths:
+        histograms = np.load(shard_path)
+        features[row:row + len(histograms)] = histograms
+        total += histograms.sum(axis=0, dtype=np.float64)
+        total_sq += np.square(histograms, dtype=np.float64).sum(axis=0)
+        row += len(histograms)
+    features.flush()
+    del features
+    finish_store(store_dir, tmp_path, np.asarray(paths, dtype=str),
+                 np.asarray(labels, dtype=np.int64), total, total_sq, meta)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    paths, labels = [], []
+    for data_dir in args.data_dirs:
+        x, y = get_image_paths_and_labels(data_dir)
+        paths.append(x)
+        labels.append(y)
+    paths, labels = np.concatenate(paths), np.concatenate(labels)
+    print('Found {} images in {}'.format(len(paths), ', '.join(args.data_dirs)))
+
+    if not os.path.exists(args.store_dir):
+        os.makedirs(args.store_dir)
+    config = {'data_dirs': args.data_dirs,
+              'num_images': len(paths),
+              'num_words': args.num_words,
+              'codebook_images': args.codebook_images,
+              'descriptors_per_image': args.descriptors_per_image,
+              'max_side': args.max_side,
+              'shard_size': args.shard_size,
+              'seed': args.seed}
+    shard_dir = os.path.join(args.store_dir, 'bow_shards')
+    config_path = os.path.join(shard_dir, 'config.json')
+    codebook_path = os.path.join(shard_dir, 'codebook.npy')
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) != config:
+                print('Settings changed, discarding the codebook and shards in {}'.format(
+                    shard_dir))
+                for filename in os.listdir(shard_dir):
+                    os.remove(os.path.join(shard_dir, filename))
+                for filename in os.listdir(args.store_dir):
+                    if filename.startswith('loader_scaler_'):
+                        os.remove(os.path.join(args.store_dir, filename))
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    if os.path.exists(codebook_path):
+        print('Using codebook {}'.format(codebook_path))
+    else:
+        fit_codebook(paths, codebook_path, args.num_words, args.codebook_images,
+                     args.descriptors_per_image, args.max_side, args.num_workers, args.seed)
+    shard_paths = encode_shards(paths, shard_dir, codebook_path, args.shard_size,
+                                args.max_side, args.num_workers)
+    assemble_store(shard_paths, paths, labels, args.store_dir,
+                   dict(config, codebook=codebook_path, num_features=args.num_words))
+    features_path = os.path.join(args.store_dir, 'features.npy')
+    print('Saved {} rows to {} ({:.2f} GB)'.format(
+        len(paths), features_path, os.path.getsize(features_path) / 1024 ** 3))
+
+    scaler_path = loader_scaler_path(args.store_dir, args.input_shape)
+    if not os.path.exists(scaler_path):
+        print('Fitting the scaler of {}x{} batches on {} images'.format(
+            args.input_shape[0], args.input_shape[1], min(args.scaler_images, len(paths))))
+        fit_loader_scaler(paths, codebook_path, scaler_path, args.input_shape,
+                          args.scaler_images, args.max_side, args.num_workers, args.seed)
+    print('Saved the scaler of the on-the-fly features to {}'.format(scaler_path))
@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser(
+    description='Convert SIFT feature CSVs into a float32 memmap store')
+parser.add_argument(
+    '--csv',
+    nargs='+',
+    default=['sift_train.csv', 'sift_valid.csv'],
+    type=str,
+    metavar='PATH',
+    help='CSV files with the image path in column 1, the label in column 2 '
+         'and the features from column 3 on')
+parser.add_argument(
+    '--store-dir',
+    default='data/sift_store',
+    type=str,
+    metavar='PATH',
+    help='where to write the store')
+parser.add_argument(
+    '--chunk-size',
+    default=10000,
+    type=int,
+    metavar='N',
+    help='CSV rows parsed at a time')
+
+
+def count_rows(csv_path):
+    with open(csv_path, 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+
+def build_sift_store(csv_paths, store_dir, chunk_size=10000):
+    """Write the features of `csv_paths` into `{store_dir}/features.npy`
+    (float32), the paths and 0-based labels into paths.npy / labels.npy and
+    the per-feature mean and standard deviation over all rows into
+    scaler.npz, parsing `chunk_size` rows at a time."""
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    header = pd.read_csv(csv_paths[0], nrows=0).columns
+    feature_columns = list(header[list(header).index('3'):])
+    num_rows = [count_rows(csv_path) for csv_path in csv_paths]
+
+    tmp_path = os.path.join(store_dir, 'features.tmp.npy')
+    features = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float32,
+        shape=(sum(num_rows), len(feature_columns)))
+    paths, labels = [], []
+    total = np.zeros(len(feature_columns))
+    total_sq = np.zeros(len(feature_columns))
+    row = 0
+    for csv_path in csv_paths:
+        print('Converting {}'.format(csv_path))
+        for chunk in pd.read_csv(csv_path, chunksize=chunk_size,
+                                 dtype={column: np.float32 for column in feature_columns}):
+            values = chunk[feature_columns].values
+            features[row:row + len(values)] = values
+            total += values.sum(axis=0, dtype=np.float64)
+            total_sq += np.square(values, dtype=np.float64).sum(axis=0)
+            paths.append(np.asarray(chunk['1'].values, dtype=str))
+            labels.append(chunk['2'].values.astype(np.int64) - 1)
+            row += len(values)
+    features.flush()
+    del features
+    finish_store(store_dir, tmp_path, np.concatenate(paths), np.concatenate(labels),
+                 total, total_sq, {'csv': csv_paths,
+                                   'num_rows': num_rows,
+                                   'num_features': len(feature_columns)})
+    return row
+
+
+def finish_store(store_dir, tmp_path, paths, labels, total, total_sq, meta):
+    """Save the index and scaler of the features written to `tmp_path`,
+    given their per-feature sum and sum of squares, and move them to
+    `{store_dir}/features.npy`."""
+    row = len(paths)
+    mean = total / row
+    # same definition as StandardScaler: population std, 1 for constant features
+    scale = np.sqrt(np.maximum(total_sq / row - mean ** 2, 0))
+    scale[scale == 0] = 1
+    np.save(os.path.join(store_dir, 'paths.npy'), paths)
+    np.save(os.path.join(store_dir, 'labels.npy'), labels)
+    np.savez(os.path.join(store_dir, 'scaler.npz'),
+             mean=mean.astype(np.float32), scale=scale.astype(np.float32))
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    # features.npy marks a complete store, see SiftStore.open
+    os.rename(tmp_path, os.path.join(store_dir, 'features.npy'))
+
+
+class StandardizedFeatures(object):
+    """Read-only view of the rows `rows` of the feature memmap, standardised
+    with the stored scaler statistics when indexed. Stands in for the
+    scaled float64 array the Sequences used to index with batch indices."""
+    def __init__(self, features, mean, scale, rows=None):
+        self.features = features
+        self.mean = mean
+        self.scale = scale
+        self.rows = np.arange(len(features)) if rows is None else np.asarray(rows)
+        self.shape = (len(self.rows), features.shape[1])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        rows = self.rows[idx]
+        if np.ndim(rows) == 0:
+            return (self.features[rows] - self.mean) / self.scale
+        # read the memmap rows in ascending order
+        order = np.argsort(rows)
+        batch = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        batch[order] = self.features[rows[order]]
+        batch -= self.mean
+        batch /= self.scale
+        return batch
+
+
+class SiftStore(object):
+    """Memory-mapped SIFT features written by `build_sift_store`."""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.features = np.load(os.path.join(store_dir, 'features.npy'), mmap_mode='r')
+        self.paths = np.load(os.path.join(store_dir, 'paths.npy'))
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'))
+        scaler = np.load(os.path.join(store_dir, 'scaler.npz'))
+        self.mean, self.scale = scaler['mean'], scaler['scale']
+
+    @classmethod
+    def open(cls, store_dir):
+        """Return a `SiftStore`, or None when `store_dir` holds none so
+        callers can fall back to parsing the CSVs."""
+        if not os.path.exists(os.path.join(store_dir, 'features.npy')):
+            print('No SIFT store in {}, parsing the CSVs instead'.format(store_dir))
+            return None
+        return cls(store_dir)
+
+    def standardized(self, rows=None):
+        return StandardizedFeatures(self.features, self.mean, self.scale, rows)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    num_rows = build_sift_store(args.csv, args.store_dir, args.chunk_size)
+    features_path = os.path.join(args.store_dir, 'features.npy')
+    print('Saved {} rows to {} ({:.2f} GB)'.format(
+        num_rows, features_path, os.path.getsize(features_path) / 1024 ** 3))
@@ -0,0 +1,63 @@
+import numpy as np
+
+SAMPLE_SUBMISSION = 'submission/sample_submission_randomlabel.csv'
+
+
+def read_sample_ids(sample_path=SAMPLE_SUBMISSION):
+    return np.loadtxt(sample_path, delimiter=',', skiprows=1, usecols=0, dtype=np.int64, ndmin=1)
+
+
+def build_submission(ids, labels, sample_ids, fallback):
+    """Sorted ids of the sample submission and of `ids`, and their labels:
+    the predicted one where there is a prediction and `fallback` for the
+    images that could not be downloaded.
+
+    Labels are scattered into a dense array indexed by id, so the lookup is
+    a single gather instead of a join.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int64)
+    all_ids = np.union1d(sample_ids, ids)
+    by_id = np.full(all_ids[-1] + 1, fallback, dtype=np.int64)
+    by_id[ids] = labels
+    return all_ids, by_id[all_ids]
+
+
+def write_submission(path, ids, labels):
+    np.savetxt(path, np.column_stack([ids, labels]), fmt='%d', delimiter=',',
+               header='id,predicted', comments='')
+
+
+def save_submission(path, ids, predictions, fallback, sample_path=SAMPLE_SUBMISSION):
+    """Write the argmax of the (num_images, 128) `predictions` of images
+    `ids` as 1-based furniture classes, completed with `fallback` for every
+    other id of the sample submission."""
+    if len(ids) != len(predictions):
+        raise ValueError('Got {} ids for {} predictions'.format(len(ids), len(predictions)))
+    labels = np.argmax(predictions, axis=1) + 1
+    all_ids, all_labels = build_submission(ids, labels, read_sample_ids(sample_path), fallback)
+    write_submission(path, all_ids, all_labels)
+
+
+def top_k(predictions, k):
+    """1-based labels and scores of the `k` best classes of every row, best
+    first. `np.argpartition` selects them in linear time, only the k
+    selected columns are sorted."""
+    predictions = np.asarray(predictions)
+    k = min(k, predictions.shape[1])
+    idx = np.argpartition(-predictions, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(predictions, idx, axis=1)
+    order = np.argsort(-scores, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    return idx + 1, scores
+
+
+def save_top_k(path, ids, predictions, k):
+    """Write ids, int16 labels and float16 scores of the top `k` classes to
+    an .npz file."""
+    labels, scores = top_k(predictions, k)
+    np.savez(path,
+             ids=np.asarray(ids, dtype=np.int64),
+             labels=labels.astype(np.int16),
+             scores=scores.astype(np.float16))
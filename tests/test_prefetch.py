@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+import pytest
+
+from prefetch import PrefetchLoader
+
+
+class RangeSequence(object):
+    """Stands in for a data.py Sequence: batch i is filled with i."""
+    def __init__(self, num_batches, batch_size=4):
+        self.num_batches = num_batches
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return self.num_batches
+
+    def __getitem__(self, idx):
+        x = np.full((self.batch_size, 8, 8, 3), idx, dtype=np.float32)
+        y = np.full((self.batch_size,), idx, dtype=np.int64)
+        return x, y
+
+    def on_epoch_end(self):
+        pass
+
+
+@pytest.mark.parametrize('copy', [False, True])
+def test_batches_in_order_with_more_batches_than_slots(copy):
+    sequence = RangeSequence(7)
+    loader = PrefetchLoader(sequence, num_workers=3, queue_size=2, seed=0, copy=copy)
+    try:
+        # several epochs, so every slot is reused many times
+        for step in range(3 * len(sequence)):
+            x, y = next(loader)
+            idx = step % len(sequence)
+            assert (x == idx).all() and (y == idx).all()
+        # views into a slot keep its block mapped, see SharedBatchRing.close
+        del x, y
+    finally:
+        loader.close()
+
+
+def test_held_batch_is_not_overwritten_before_the_next_request():
+    sequence = RangeSequence(9)
+    loader = PrefetchLoader(sequence, num_workers=2, queue_size=2, seed=0, copy=False)
+    try:
+        for step in range(2 * len(sequence)):
+            x, y = next(loader)
+            # give the workers time to fill every free slot
+            time.sleep(0.05)
+            idx = step % len(sequence)
+            assert (x == idx).all() and (y == idx).all()
+        # views into a slot keep its block mapped, see SharedBatchRing.close
+        del x, y
+    finally:
+        loader.close()
+
+
+def test_two_input_batches():
+    class TwoInputs(RangeSequence):
+        def __getitem__(self, idx):
+            x, y = RangeSequence.__getitem__(self, idx)
+            return [x, np.full((self.batch_size, 5), -idx, dtype=np.float32)], y
+
+    loader = PrefetchLoader(TwoInputs(5), num_workers=2, queue_size=2, seed=0, copy=False)
+    try:
+        for idx in range(5):
+            (x, sift), y = next(loader)
+            assert (x == idx).all() and (sift == -idx).all() and (y == idx).all()
+        del x, sift, y
+    finally:
+        loader.close()
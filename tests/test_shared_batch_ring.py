@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from shared_batch_ring import SharedBatchRing, batch_nbytes
+
+
+def make_batch(i):
+    return [np.full((4, 3), i, dtype=np.float32), np.arange(5, dtype=np.int64) + i]
+
+
+@pytest.fixture
+def ring():
+    ring = SharedBatchRing(3, batch_nbytes(make_batch(0)))
+    yield ring
+    ring.close()
+
+
+def test_read_returns_written_arrays(ring):
+    slot = ring.acquire()
+    layout = ring.write(slot, make_batch(7))
+    for array, expected in zip(ring.read(slot, layout, copy=True), make_batch(7)):
+        assert array.dtype == expected.dtype
+        np.testing.assert_array_equal(array, expected)
+
+
+def test_held_slot_is_not_handed_out_again(ring):
+    held = ring.acquire()
+    layout = ring.write(held, make_batch(1))
+    arrays = ring.read(held, layout)
+    # cycle the other slots many times while `held` is not released
+    for i in range(10):
+        slot = ring.acquire()
+        assert slot is not None and slot != held
+        ring.write(slot, make_batch(100 + i))
+        ring.release(slot)
+    np.testing.assert_array_equal(arrays[0], make_batch(1)[0])
+    np.testing.assert_array_equal(arrays[1], make_batch(1)[1])
+    del arrays
+
+
+def test_acquire_returns_none_when_full(ring):
+    slots = [ring.acquire() for _ in range(ring.num_slots)]
+    assert sorted(slots) == list(range(ring.num_slots))
+    assert ring.num_free() == 0
+    assert ring.acquire() is None
+    ring.release(slots[1])
+    assert ring.acquire() == slots[1]
+
+
+def test_data_intact_after_wrapping(ring):
+    pending = []
+    for i in range(4 * ring.num_slots):
+        if ring.num_free() == 0:
+            slot, layout, j = pending.pop(0)
+            arrays = ring.read(slot, layout, copy=True)
+            np.testing.assert_array_equal(arrays[0], make_batch(j)[0])
+            np.testing.assert_array_equal(arrays[1], make_batch(j)[1])
+            ring.release(slot)
+        slot = ring.acquire()
+        pending.append((slot, ring.write(slot, make_batch(i)), i))
+    for slot, layout, j in pending:
+        np.testing.assert_array_equal(ring.read(slot, layout, copy=True)[0], make_batch(j)[0])
+
+
+def test_oversized_batch_is_rejected(ring):
+    with pytest.raises(ValueError):
+        ring.write(ring.acquire(), make_batch(0) + [np.zeros(1000, dtype=np.float32)])
@@ -1,4 +1,5 @@
 import argparse
+import json
 import numpy as np
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
@@ -14,7 +15,12 @@ from sklearn.utils.class_weight import compute_class_weight
 from sklearn.model_selection import train_test_split
 
 from data import AugmentedDataset, Dataset, get_image_paths_and_labels
-from model_utils import build_xception, build_densenet_201, build_inception_v3, build_inception_resnet_v2
+from image_store import ImageStore
+from prefetch import PrefetchLoader
+from autotune import DEFAULT_CACHE, tuned_batch_size
+from calibration import load_holdout, save_holdout
+from feature_cache import FeatureDataset, backbone_of, cached_features, feature_rows, train_head
+from model_utils import build_model
 
 parser = argparse.ArgumentParser(
     description='Training')
@@ -39,6 +45,13 @@ parser.add_argument(
     default='False',
     type=str,
     help='indicate whether to continue training')
+parser.add_argument(
+    '--holdout-from',
+    default=None,
+    type=str,
+    metavar='MODEL',
+    help='hold out the images another model held out, so predictions of both '
+         'on the shared holdout can be blended with blend_weights.py')
 parser.add_argument(
     '--model-name',
     type=str,
@@ -53,26 +66,148 @@ parser.add_argument(
     '--scheme',
     default='trainval',
     type=str)
+parser.add_argument(
+    '--image-store',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='directory of pre-resized image shards built by image_store.py')
+parser.add_argument(
+    '--augmentation-backend',
+    default='imgaug',
+    choices=['imgaug', 'numpy'],
+    type=str,
+    help='imgaug: per-image imgaug pipeline, numpy: batched numpy/cv2 augmentation')
+parser.add_argument(
+    '--input-dtype',
+    default='float32',
+    choices=['float32', 'float16'],
+    type=str,
+    help='dtype of the preprocessed image batches')
+parser.add_argument(
+    '--reuse-buffers',
+    action='store_true',
+    help='assemble batches in a ring of preallocated buffers')
+parser.add_argument(
+    '--reduced-decode',
+    action='store_true',
+    help='decode JPEGs at the smallest DCT-scaled size covering the input shape')
+parser.add_argument(
+    '--loader',
+    default='keras',
+    choices=['keras', 'prefetch'],
+    type=str,
+    help='keras: fit_generator worker threads, prefetch: process pool with shared memory batches')
+parser.add_argument(
+    '--prefetch-queue-size',
+    default=8,
+    type=int,
+    metavar='N',
+    help='number of batches the prefetch loader may produce ahead')
+parser.add_argument(
+    '--sparse-labels',
+    action='store_true',
+    help='feed int32 class indices and use sparse losses instead of one-hot targets')
+parser.add_argument(
+    '--epoch-ordering',
+    default='random',
+    choices=['random', 'stratified', 'balanced'],
+    type=str,
+    help='order of the training samples within an epoch')
+parser.add_argument(
+    '--sampling',
+    default='none',
+    choices=['none', 'balanced', 'sqrt', 'custom'],
+    type=str,
+    help='draw training batches by class probability instead of class weights')
+parser.add_argument(
+    '--class-probs',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='JSON file of {class index: probability} for --sampling custom')
+parser.add_argument(
+    '--autotune',
+    action='store_true',
+    help='use the fastest batch size under --memory-limit, tuned once per model, input shape and host')
+parser.add_argument(
+    '--memory-limit',
+    default=0.8,
+    type=float,
+    help='peak RSS ceiling for --autotune as a fraction of the physical memory')
+parser.add_argument(
+    '--autotune-cache',
+    default=DEFAULT_CACHE,
+    type=str,
+    metavar='PATH',
+    help='JSON file of tuned batch sizes')
+parser.add_argument(
+    '--feature-cache',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='train the last Dense layer on backbone features cached in this folder')
+parser.add_argument(
+    '--feature-augmentations',
+    default=0,
+    type=int,
+    metavar='K',
+    help='cache K augmented copies of the training images instead of the plain ones')
+parser.add_argument(
+    '--feature-seed',
+    default=0,
+    type=int,
+    help='augmentation seed of the cached features')
 
 
 def train(batch_size, input_shape,
           x_train, y_train,
           x_valid, y_valid,
           model_name, num_workers,
-          resume):
+          resume, dataset_kwargs=None,
+          train_dataset_kwargs=None,
+          loader='keras', prefetch_queue_size=8,
+          feature_cache=None):
+    dataset_kwargs = dataset_kwargs or {}
+    train_dataset_kwargs = dict(dataset_kwargs, **(train_dataset_kwargs or {}))
     print('Found {} images belonging to {} classes'.format(len(x_train), 128))
     print('Found {} images belonging to {} classes'.format(len(x_valid), 128))
     train_generator = AugmentedDataset(
         x_train, y_train,
-        batch_size=batch_size, input_shape=input_shape)
-    valid_generator = FurnituresDatasetNoAugmentation(
+        batch_size=batch_size, input_shape=input_shape,
+        **train_dataset_kwargs)
+    valid_generator = Dataset(
         x_valid, y_valid,
-        batch_size=batch_size, input_shape=input_shape)
+        batch_size=batch_size, input_shape=input_shape,
+        **dataset_kwargs)
+    fit_kwargs = {'workers': num_workers}
+    prefetch_loaders = []
+    if loader == 'prefetch':
+        train_generator = PrefetchLoader(
+            train_generator, num_workers=num_workers,
+            queue_size=prefetch_queue_size, verbose=True, copy=False)
+        valid_generator = PrefetchLoader(
+            valid_generator, num_workers=num_workers,
+            queue_size=prefetch_queue_size, copy=False)
+        # batches are already produced in the background, keras must pull
+        # them from the main thread, which also guarantees a batch is done
+        # with before its shared memory slot is reused
+        fit_kwargs = {'steps_per_epoch': len(train_generator),
+                      'validation_steps': len(valid_generator),
+                      'workers': 0}
+        prefetch_loaders = [train_generator, valid_generator]
     class_weight = compute_class_weight(
         'balanced', np.unique(y_train), y_train)
     class_weight_dict = dict.fromkeys(np.unique(y_train))
     for key in class_weight_dict.keys():
         class_weight_dict.update({key: class_weight[key]})
+    if train_dataset_kwargs.get('sampling') is not None:
+        # the sampler already rebalances the classes
+        class_weight_dict = None
+    # 'acc' follows the loss and becomes sparse_categorical_accuracy
+    loss = 'categorical_crossentropy'
+    if dataset_kwargs.get('sparse_labels'):
+        loss = 'sparse_categorical_crossentropy'
 
 
     filepath = 'checkpoint/{}/iter1.hdf5'.format(model_name)
@@ -91,75 +226,156 @@ def train(batch_size, input_shape,
                                   verbose=1)
     callbacks = [save_best, save_on_train_end, reduce_lr]
 
-    if resume == 'True':
-        print('\nResume training from the last checkpoint')
-        model = load_model(filepath)
-        trainable_count = int(
-            np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
-        print('Trainable params: {:,}'.format(trainable_count))
-        model.fit_generator(generator=train_generator,
-                            epochs=args.epochs,
-                            callbacks=callbacks,
-                            validation_data=valid_generator,
-                            class_weight=class_weight_dict,
-                            workers=num_workers)
-    else:
-        print('\nTrain the last Dense layer')
-        if model_name == 'densenet_201':
-            model = build_densenet_201()
-        elif model_name == 'inception_v3':
-            model = build_inception_v3()
-        elif model_name == 'inception_resnet_v2':
-            model = build_inception_resnet_v2()
-        elif model_name == 'xception':
-            model = build_xception()
-        for layer in model.layers[:-1]:
-            layer.trainable = False
-            model.compile(optimizer=Adam(lr=0.001), loss='categorical_crossentropy',
-                          metrics=['acc'])
-        model.fit_generator(generator=train_generator,
-                            epochs=5,
-                            callbacks=callbacks,
-                            validation_data=valid_generator,
-                            class_weight=class_weight_dict,
-                            workers=num_workers)
-        K.clear_session()
+    try:
+        if resume == 'True':
+            print('\nResume training from the last checkpoint')
+            model = load_model(filepath)
+            trainable_count = int(
+                np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
+            print('Trainable params: {:,}'.format(trainable_count))
+            model.fit_generator(generator=train_generator,
+                                epochs=args.epochs,
+                                callbacks=callbacks,
+                                validation_data=valid_generator,
+                                class_weight=class_weight_dict,
+                                **fit_kwargs)
+        else:
+            print('\nTrain the last Dense layer')
+            model = build_model(model_name)
+            for layer in model.layers[:-1]:
+                layer.trainable = False
+                model.compile(optimizer=Adam(lr=0.001), loss=loss,
+                              metrics=['acc'])
+            if feature_cache is not None:
+                # the backbone is frozen, so run it once and fit the head on
+                # its pooled features; the cache covers every image in sorted
+                # order so it is reused whatever the train/validation split
+                backbone = backbone_of(model)
+                all_x = np.sort(np.concatenate((x_train, x_valid)))
+                all_y = np.concatenate((y_train, y_valid))[
+                    np.argsort(np.concatenate((x_train, x_valid)))]
+                num_passes = max(feature_cache['num_augmentations'], 1)
+                train_features, train_labels = cached_features(
+                    backbone, model_name, all_x, all_y, batch_size, input_shape,
+                    dataset_kwargs=dataset_kwargs, **feature_cache)
+                valid_features, valid_labels = train_features, train_labels
+                valid_x = all_x
+                if feature_cache['num_augmentations']:
+                    valid_x = np.sort(x_valid)
+                    valid_features, valid_labels = cached_features(
+                        backbone, model_name, valid_x, y_valid[np.argsort(x_valid)],
+                        batch_size, input_shape, cache_dir=feature_cache['cache_dir'],
+                        dataset_kwargs=dataset_kwargs)
+                sparse_labels = dataset_kwargs.get('sparse_labels', False)
+                train_head(
+                    model,
+                    FeatureDataset(train_features, train_labels, batch_size=256,
+                                   rows=feature_rows(all_x, x_train, num_passes),
+                                   sparse_labels=sparse_labels,
+                                   sampling=train_dataset_kwargs.get('sampling')),
+                    FeatureDataset(valid_features, valid_labels, batch_size=256,
+                                   rows=feature_rows(valid_x, x_valid),
+                                   shuffle=False, sparse_labels=sparse_labels),
+                    loss,
+                    head_path='checkpoint/{}/head.hdf5'.format(model_name),
+                    epochs=5,
+                    class_weight=class_weight_dict)
+                model.save(filepath)
+            else:
+                model.fit_generator(generator=train_generator,
+                                    epochs=5,
+                                    callbacks=callbacks,
+                                    validation_data=valid_generator,
+                                    class_weight=class_weight_dict,
+                                    **fit_kwargs)
+            K.clear_session()
 
-        print("\nFine-tune the network")
-        model = load_model(filepath)
-        for layer in model.layers:
-            layer.trainable = True
-            if hasattr(layer, 'kernel_regularizer'):
-                layer.kernel_regularizer = regularizers.l2(0.0001)
-        trainable_count = int(
-            np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
-        print('Trainable params: {:,}'.format(trainable_count))
-        model.compile(optimizer=Adam(lr=3e-5),
-                      loss='categorical_crossentropy',
-                      metrics=['acc'])
-        model.fit_generator(generator=train_generator,
-                            epochs=30,
-                            callbacks=callbacks,
-                            validation_data=valid_generator,
-                            class_weight=class_weight_dict,
-                            workers=num_workers)
-        K.clear_session()
+            print("\nFine-tune the network")
+            model = load_model(filepath)
+            for layer in model.layers:
+                layer.trainable = True
+                if hasattr(layer, 'kernel_regularizer'):
+                    layer.kernel_regularizer = regularizers.l2(0.0001)
+            trainable_count = int(
+                np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
+            print('Trainable params: {:,}'.format(trainable_count))
+            model.compile(optimizer=Adam(lr=3e-5),
+                          loss=loss,
+                          metrics=['acc'])
+            model.fit_generator(generator=train_generator,
+                                epochs=30,
+                                callbacks=callbacks,
+                                validation_data=valid_generator,
+                                class_weight=class_weight_dict,
+                                **fit_kwargs)
+            K.clear_session()
+    finally:
+        # stop the loader processes and free their shared memory, also
+        # when training is interrupted
+        for prefetch_loader in prefetch_loaders:
+            prefetch_loader.close()
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
+    batch_size = args.batch_size
+    if args.autotune:
+        batch_size = tuned_batch_size(
+            args.model_name, tuple(args.input_shape), mode='train',
+            cache_path=args.autotune_cache, memory_limit=args.memory_limit)
     x_train, y_train = get_image_paths_and_labels(
         data_dir='data/train/')
     x_valid, y_valid = get_image_paths_and_labels(
         data_dir='data/validation/')
     merged_x = np.concatenate((x_train, x_valid))
     merged_y = np.concatenate((y_train, y_valid))
-    x_train, x_valid, y_train, y_valid = train_test_split(merged_x, merged_y, test_size=0.01)
+    holdout = load_holdout(args.model_name) if args.resume == 'True' else None
+    if holdout is None and args.holdout_from is not None:
+        holdout = load_holdout(args.holdout_from)
+        if holdout is None:
+            parser.error('no holdout saved for {}'.format(args.holdout_from))
+    if holdout is not None:
+        # keep the images of the first run (or of --holdout-from) out of training
+        x_valid, y_valid = holdout
+        in_train = ~np.isin(merged_x, x_valid)
+        x_train, y_train = merged_x[in_train], merged_y[in_train]
+    else:
+        x_train, x_valid, y_train, y_valid = train_test_split(merged_x, merged_y, test_size=0.01)
+    save_holdout(args.model_name, x_valid, y_valid)
+    image_store = None
+    if args.image_store is not None:
+        image_store = ImageStore.open(
+            args.image_store, tuple(args.input_shape),
+            data_dirs=['data/train/', 'data/validation/'])
+    dataset_kwargs = {'image_store': image_store,
+                      'dtype': args.input_dtype,
+                      'reduced_decode': args.reduced_decode,
+                      'sparse_labels': args.sparse_labels}
+    train_dataset_kwargs = {'augmentation_backend': args.augmentation_backend,
+                            'ordering': args.epoch_ordering}
+    if args.sampling == 'custom':
+        with open(args.class_probs) as f:
+            train_dataset_kwargs['sampling'] = json.load(f)
+    elif args.sampling != 'none':
+        train_dataset_kwargs['sampling'] = args.sampling
+    if args.reuse_buffers:
+        # fit_generator keeps up to max_queue_size (10) batches queued while
+        # every worker fills another one and the model consumes one more
+        dataset_kwargs['num_buffers'] = 10 + args.num_workers + 2
+
+    feature_cache = None
+    if args.feature_cache is not None:
+        feature_cache = {'cache_dir': args.feature_cache,
+                         'num_augmentations': args.feature_augmentations,
+                         'seed': args.feature_seed}
 
-    train(args.batch_size, tuple(args.input_shape),
+    train(batch_size, tuple(args.input_shape),
             x_train, y_train,
             x_valid, y_valid,
             args.model_name, args.num_workers,
-            args.resume)
+            args.resume, dataset_kwargs,
+            train_dataset_kwargs,
+            args.loader, args.prefetch_queue_size,
+            feature_cache)
    
\ No newline at end of file
@@ -1,5 +1,6 @@
 import argparse
 import gc
+import json
 import numpy as np
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
@@ -12,6 +13,7 @@ from keras.layers import Input, Concatenate, Dense
 from keras.models import load_model, Model
 from keras.optimizers import Adam, SGD
 from keras import regularizers
+from keras.metrics import sparse_categorical_accuracy
 from keras_EMA import ExponentialMovingAverage
 
 from sklearn.utils.class_weight import compute_class_weight
@@ -19,6 +21,11 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 
 from data import AugmentedDatasetWithSiftFeatures, DatasetWithSiftFeatures, get_image_paths_and_labels
+from custom_losses import sparse_categorical_hinge
+from image_store import ImageStore
+from prefetch import PrefetchLoader
+from sift_bow import SiftBowEncoder
+from sift_store import SiftStore
 
 parser = argparse.ArgumentParser(
     description='Training')
@@ -57,6 +64,78 @@ parser.add_argument(
     '--scheme',
     default='trainval',
     type=str)
+parser.add_argument(
+    '--image-store',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='directory of pre-resized image shards built by image_store.py')
+parser.add_argument(
+    '--sift-store',
+    default='data/sift_store',
+    type=str,
+    metavar='PATH',
+    help='SIFT features converted by sift_store.py, the CSVs are parsed when missing')
+parser.add_argument(
+    '--sift-on-the-fly',
+    action='store_true',
+    help='compute the SIFT features of every (augmented) batch with the codebook '
+         'of the sift_extractor.py store instead of reading the stored ones, '
+         'standardised with the scaler fitted for --input-shape')
+parser.add_argument(
+    '--augmentation-backend',
+    default='imgaug',
+    choices=['imgaug', 'numpy'],
+    type=str,
+    help='imgaug: per-image imgaug pipeline, numpy: batched numpy/cv2 augmentation')
+parser.add_argument(
+    '--input-dtype',
+    default='float32',
+    choices=['float32', 'float16'],
+    type=str,
+    help='dtype of the preprocessed image batches')
+parser.add_argument(
+    '--reuse-buffers',
+    action='store_true',
+    help='assemble batches in a ring of preallocated buffers')
+parser.add_argument(
+    '--reduced-decode',
+    action='store_true',
+    help='decode JPEGs at the smallest DCT-scaled size covering the input shape')
+parser.add_argument(
+    '--loader',
+    default='keras',
+    choices=['keras', 'prefetch'],
+    type=str,
+    help='keras: fit_generator worker threads, prefetch: process pool with shared memory batches')
+parser.add_argument(
+    '--prefetch-queue-size',
+    default=8,
+    type=int,
+    metavar='N',
+    help='number of batches the prefetch loader may produce ahead')
+parser.add_argument(
+    '--sparse-labels',
+    action='store_true',
+    help='feed int32 class indices and use sparse losses instead of one-hot targets')
+parser.add_argument(
+    '--epoch-ordering',
+    default='random',
+    choices=['random', 'stratified', 'balanced'],
+    type=str,
+    help='order of the training samples within an epoch')
+parser.add_argument(
+    '--sampling',
+    default='none',
+    choices=['none', 'balanced', 'sqrt', 'custom'],
+    type=str,
+    help='draw training batches by class probability instead of class weights')
+parser.add_argument(
+    '--class-probs',
+    default=None,
+    type=str,
+    metavar='PATH',
+    help='JSON file of {class index: probability} for --sampling custom')
 
 
 def train_with_sift_features(batch_size, input_shape,
@@ -65,106 +144,175 @@ def train_with_sift_features(batch_size, input_shape,
                              sift_features_train,
                              sift_features_valid,
                              model_name, num_workers,
-                             resume):
+                             resume, dataset_kwargs=None,
+                             train_dataset_kwargs=None,
+                             loader='keras', prefetch_queue_size=8):
+    dataset_kwargs = dataset_kwargs or {}
+    train_dataset_kwargs = dict(dataset_kwargs, **(train_dataset_kwargs or {}))
     print('Found {} images belonging to {} classes'.format(len(x_train), 128))
     print('Found {} images belonging to {} classes'.format(len(x_valid), 128))
     train_generator = AugmentedDatasetWithSiftFeatures(
         x_train, y_train, sift_features_train,
-        batch_size=batch_size, input_shape=input_shape)
+        batch_size=batch_size, input_shape=input_shape,
+        **train_dataset_kwargs)
     valid_generator = DatasetWithSiftFeatures(
         x_valid, y_valid, sift_features_valid,
-        batch_size=batch_size, input_shape=input_shape)
+        batch_size=batch_size, input_shape=input_shape,
+        **dataset_kwargs)
+    fit_kwargs = {'workers': num_workers}
+    prefetch_loaders = []
+    if loader == 'prefetch':
+        train_generator = PrefetchLoader(
+            train_generator, num_workers=num_workers,
+            queue_size=prefetch_queue_size, verbose=True, copy=False)
+        valid_generator = PrefetchLoader(
+            valid_generator, num_workers=num_workers,
+            queue_size=prefetch_queue_size, copy=False)
+        # batches are already produced in the background, keras must pull
+        # them from the main thread, which also guarantees a batch is done
+        # with before its shared memory slot is reused
+        fit_kwargs = {'steps_per_epoch': len(train_generator),
+                      'validation_steps': len(valid_generator),
+                      'workers': 0}
+        prefetch_loaders = [train_generator, valid_generator]
     class_weight = compute_class_weight(
         'balanced', np.unique(y_train), y_train)
     class_weight_dict = dict.fromkeys(np.unique(y_train))
     for key in class_weight_dict.keys():
         class_weight_dict.update({key: class_weight[key]})
+    if train_dataset_kwargs.get('sampling') is not None:
+        # the sampler already rebalances the classes
+        class_weight_dict = None
+    loss, metrics, monitor = 'categorical_hinge', ['acc'], 'val_acc'
+    if dataset_kwargs.get('sparse_labels'):
+        loss, metrics = sparse_categorical_hinge, [sparse_categorical_accuracy]
+        monitor = 'val_sparse_categorical_accuracy'
+    custom_objects = {'sparse_categorical_hinge': sparse_categorical_hinge}
 
 
     filepath = 'checkpoint/{}/sift_iter1.hdf5'.format(model_name)
     save_best = ModelCheckpoint(filepath=filepath,
                                 verbose=1,
-                                monitor='val_acc',
+                                monitor=monitor,
                                 save_best_only=True,
                                 mode='max')
     save_on_train_end = ModelCheckpoint(filepath=filepath,
                                         verbose=1,
-                                        monitor='val_acc',
+                                        monitor=monitor,
                                         period=args.epochs)
-    reduce_lr = ReduceLROnPlateau(monitor='val_acc',
+    reduce_lr = ReduceLROnPlateau(monitor=monitor,
                                   factor=0.2,
                                   patience=2,
                                   verbose=1)
     callbacks = [save_best, save_on_train_end, reduce_lr]
 
-    if resume == 'True':
-        print('\nResume training from the last checkpoint')
-        model = load_model(filepath)
-        trainable_count = int(
-            np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
-        print('Trainable params: {:,}'.format(trainable_count))
-        model.fit_generator(generator=train_generator,
-                            epochs=args.epochs,
-                            callbacks=callbacks,
-                            validation_data=valid_generator,
-                            class_weight=class_weight_dict,
-                            workers=num_workers)
-    else:
-        model = Xception(include_top=False, pooling='max')
-        sift_features = Input(shape=(512, ))
-        x = Concatenate()([model.layers[-1].output, sift_features])
-        x = Dense(units=128, activation='linear', name='predictions', kernel_regularizer=regularizers.l2(0.0001))(x)
-        model = Model([model.layers[0].input, sift_features], x)
-
-        for layer in model.layers[:-1]:
-            layer.trainable = False
-
-        model.compile(optimizer=Adam(lr=0.001), loss='categorical_hinge',
-                      metrics=['acc'])
-        model.fit_generator(generator=train_generator,
-                            epochs=5,
-                            callbacks=callbacks,
-                            validation_data=valid_generator,
-                            class_weight=class_weight_dict,
-                            workers=num_workers)
-        K.clear_session()
-
-        print("\nFine-tune the network")
-        model = load_model(filepath)   
-        for layer in model.layers:
-            layer.trainable = True
-        trainable_count = int(
-            np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
-        print('Trainable params: {:,}'.format(trainable_count))
-        model.compile(optimizer=SGD(lr=0.0001, momentum=0.9),
-                      loss='categorical_hinge',
-                      metrics=['acc'])
-        model.fit_generator(generator=train_generator,
-                            epochs=30,
-                            callbacks=callbacks,
-                            validation_data=valid_generator,
-                            class_weight=class_weight_dict,
-                            workers=num_workers)
-        K.clear_session()
+    try:
+        if resume == 'True':
+            print('\nResume training from the last checkpoint')
+            model = load_model(filepath, custom_objects=custom_objects)
+            trainable_count = int(
+                np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
+            print('Trainable params: {:,}'.format(trainable_count))
+            model.fit_generator(generator=train_generator,
+                                epochs=args.epochs,
+                                callbacks=callbacks,
+                                validation_data=valid_generator,
+                                class_weight=class_weight_dict,
+                                **fit_kwargs)
+        else:
+            model = Xception(include_top=False, pooling='max')
+            sift_features = Input(shape=(sift_features_train.shape[1], ))
+            x = Concatenate()([model.layers[-1].output, sift_features])
+            x = Dense(units=128, activation='linear', name='predictions', kernel_regularizer=regularizers.l2(0.0001))(x)
+            model = Model([model.layers[0].input, sift_features], x)
+
+            for layer in model.layers[:-1]:
+                layer.trainable = False
+
+            model.compile(optimizer=Adam(lr=0.001), loss=loss,
+                          metrics=metrics)
+            model.fit_generator(generator=train_generator,
+                                epochs=5,
+                                callbacks=callbacks,
+                                validation_data=valid_generator,
+                                class_weight=class_weight_dict,
+                                **fit_kwargs)
+            K.clear_session()
+
+            print("\nFine-tune the network")
+            model = load_model(filepath, custom_objects=custom_objects)   
+            for layer in model.layers:
+                layer.trainable = True
+            trainable_count = int(
+                np.sum([K.count_params(p) for p in set(model.trainable_weights)]))
+            print('Trainable params: {:,}'.format(trainable_count))
+            model.compile(optimizer=SGD(lr=0.0001, momentum=0.9),
+                          loss=loss,
+                          metrics=metrics)
+            model.fit_generator(generator=train_generator,
+                                epochs=30,
+                                callbacks=callbacks,
+                                validation_data=valid_generator,
+                                class_weight=class_weight_dict,
+                                **fit_kwargs)
+            K.clear_session()
+    finally:
+        # stop the loader processes and free their shared memory, also
+        # when training is interrupted
+        for prefetch_loader in prefetch_loaders:
+            prefetch_loader.close()
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
-    train_df = pd.read_csv('sift_train.csv')
-    valid_df = pd.read_csv('sift_valid.csv')
-    merged_df = pd.concat([train_df, valid_df], ignore_index=True)
-    y = merged_df.pop('2')
-    y -= 1
-    train_idx, valid_idx, y_train, y_valid = train_test_split(merged_df.index, y, test_size=0.01)
-    x_train, sift_features_train = merged_df.iloc[train_idx]['1'].values, merged_df.iloc[train_idx].ix[:, '3':].values
-    x_valid, sift_features_valid = merged_df.iloc[valid_idx]['1'].values, merged_df.iloc[valid_idx].ix[:, '3':].values
-    del train_df, valid_df, merged_df, train_idx, valid_idx
-    gc.collect()
-    ss = StandardScaler()
-    ss.fit(sift_features_train)
-    sift_features_train = ss.transform(sift_features_train)
-    sift_features_valid = ss.transform(sift_features_valid)
+    sift_store = SiftStore.open(args.sift_store)
+    if sift_store is not None:
+        # memory-mapped float32 features, standardised batch by batch with
+        # the scaler statistics stored next to them
+        train_idx, valid_idx, y_train, y_valid = train_test_split(
+            np.arange(len(sift_store.labels)), sift_store.labels, test_size=0.01)
+        x_train, sift_features_train = sift_store.paths[train_idx], sift_store.standardized(train_idx)
+        x_valid, sift_features_valid = sift_store.paths[valid_idx], sift_store.standardized(valid_idx)
+    else:
+        train_df = pd.read_csv('sift_train.csv')
+        valid_df = pd.read_csv('sift_valid.csv')
+        merged_df = pd.concat([train_df, valid_df], ignore_index=True)
+        y = merged_df.pop('2')
+        y -= 1
+        train_idx, valid_idx, y_train, y_valid = train_test_split(merged_df.index, y, test_size=0.01)
+        x_train, sift_features_train = merged_df.iloc[train_idx]['1'].values, merged_df.iloc[train_idx].loc[:, '3':].values
+        x_valid, sift_features_valid = merged_df.iloc[valid_idx]['1'].values, merged_df.iloc[valid_idx].loc[:, '3':].values
+        del train_df, valid_df, merged_df, train_idx, valid_idx
+        gc.collect()
+        ss = StandardScaler()
+        ss.fit(sift_features_train)
+        sift_features_train = ss.transform(sift_features_train)
+        sift_features_valid = ss.transform(sift_features_valid)
+    image_store = None
+    if args.image_store is not None:
+        image_store = ImageStore.open(
+            args.image_store, tuple(args.input_shape),
+            data_dirs=['data/train/', 'data/validation/'])
+    dataset_kwargs = {'image_store': image_store,
+                      'dtype': args.input_dtype,
+                      'reduced_decode': args.reduced_decode,
+                      'sparse_labels': args.sparse_labels}
+    train_dataset_kwargs = {'augmentation_backend': args.augmentation_backend,
+                            'ordering': args.epoch_ordering}
+    if args.sampling == 'custom':
+        with open(args.class_probs) as f:
+            train_dataset_kwargs['sampling'] = json.load(f)
+    elif args.sampling != 'none':
+        train_dataset_kwargs['sampling'] = args.sampling
+    if args.sift_on_the_fly:
+        sift_encoder = SiftBowEncoder.open(args.sift_store, tuple(args.input_shape))
+        if sift_encoder is not None:
+            dataset_kwargs['sift_encoder'] = sift_encoder
+    if args.reuse_buffers:
+        # fit_generator keeps up to max_queue_size (10) batches queued while
+        # every worker fills another one and the model consumes one more
+        dataset_kwargs['num_buffers'] = 10 + args.num_workers + 2
 
     train_with_sift_features(args.batch_size, tuple(args.input_shape),
         x_train, y_train,
@@ -172,4 +320,6 @@ if __name__ == '__main__':
         sift_features_train,
         sift_features_valid,
         args.model_name, args.num_workers,
-        args.resume)
+        args.resume, dataset_kwargs,
+        train_dataset_kwargs,
+        args.loader, args.prefetch_queue_size)
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+from keras.utils import Sequence
+from PIL import Image, ImageOps
+
+# The 12 test-time views, matching the folders written by
+# data_utils/create_data_folders.py:preprocess_test_imgs plus the original
+# images. A crop name lists the sides that are cut off by `percent_cropped`
+# of the image size, e.g. 'top_right' drops the top rows and right columns.
+TTA_VIEWS = ['original', 'flip',
+             'top_right', 'top_right_flip',
+             'top_left', 'top_left_flip',
+             'bottom_right', 'bottom_right_flip',
+             'bottom_left', 'bottom_left_flip',
+             'center', 'center_flip']
+
+_CROPPED_SIDES = {'original': (),
+                  'top_right': ('top', 'right'),
+                  'top_left': ('top', 'left'),
+                  'bottom_right': ('bottom', 'right'),
+                  'bottom_left': ('bottom', 'left'),
+                  'center': ('top', 'right', 'bottom', 'left')}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm')
+
+
+def list_images(directory):
+    """Image paths below `directory` in the order `flow_from_directory`
+    yields them."""
+    paths = []
+    for root, _, files in sorted(os.walk(directory)):
+        for fname in sorted(files):
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, fname))
+    return paths
+
+
+def crop_box(view, width, height, percent_cropped=0.1):
+    """PIL crop box (left, upper, right, lower) of `view`, cut the same way
+    as the `iaa.Crop(px=...)` calls in preprocess_test_imgs."""
+    base = 'original' if view == 'flip' else view.replace('_flip', '')
+    sides = _CROPPED_SIDES[base]
+    dy, dx = int(percent_cropped * height), int(percent_cropped * width)
+    return (dx if 'left' in sides else 0,
+            dy if 'top' in sides else 0,
+            width - dx if 'right' in sides else width,
+            height - dy if 'bottom' in sides else height)
+
+
+def open_rgb(fp):
+    """Decode an image file (path or file object) into an upright RGB PIL
+    image. The EXIF orientation is applied like cv2.imread does for the view
+    folders and the training batches."""
+    image = ImageOps.exif_transpose(Image.open(fp))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.load()
+    return image
+
+
+def make_view(image, view, target_size, percent_cropped=0.1):
+    """Crop/flip a PIL image into `view` and resize it like keras' load_img
+    (nearest neighbour) to `target_size` (width, height)."""
+    box = crop_box(view, image.size[0], image.size[1], percent_cropped)
+    if box != (0, 0) + image.size:
+        image = image.crop(box)
+    if view.endswith('flip'):
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    if image.size != tuple(target_size):
+        image = image.resize(tuple(target_size), Image.NEAREST)
+    return image
+
+
+class TTADataset(Sequence):
+    """Decodes every test image once and yields all of its `views` next to
+    each other, rescaled by 1/255 like the ImageDataGenerator used for the
+    view folders. A batch holds `images_per_batch` images, i.e.
+    `images_per_batch * len(views)` rows, so predictions reshape to
+    (num_images, num_views, num_classes).
+    """
+    def __init__(
+            self,
+            paths,
+            images_per_batch,
+            views=TTA_VIEWS,
+            target_size=(299, 299),
+            percent_cropped=0.1):
+        self.paths = paths
+        self.images_per_batch = images_per_batch
+        self.views = views
+        self.target_size = target_size
+        self.percent_cropped = percent_cropped
+
+    def __len__(self):
+        return int(np.ceil(len(self.paths) / float(self.images_per_batch)))
+
+    def __getitem__(self, idx):
+        batch_paths = self.paths[idx * self.images_per_batch:(idx + 1) * self.images_per_batch]
+        batch = np.empty((len(batch_paths) * len(self.views),
+                          self.target_size[1], self.target_size[0], 3), dtype=np.float32)
+        row = 0
+        for path in batch_paths:
+            image = open_rgb(path)
+            for view in self.views:
+                batch[row] = np.asarray(
+                    make_view(image, view, self.target_size, self.percent_cropped))
+                row += 1
+        batch *= 1. / 255
+        return batch